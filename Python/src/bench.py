@@ -0,0 +1,324 @@
+"""
+
+Benchmarks of TS2DB.
+
+Builds synthetic sensor tables through DB/TABLEDEF/Table in a scratch
+directory and measures
+
+    ingest   - rows/s of Table.insert_many, a batch at a time
+    point    - p50/p99 latency of equality queries
+    range    - p50/p99 latency of time range and value range queries
+    fanout   - the range queries again with Startup(n) Indexers for each n
+               (0 runs the steps in this process)
+    cache    - the range queries answered from the result cache, then again
+               after a batch is appended (the cached results are extended)
+    catalog  - DB.list latency against the number of tables, cold and warm
+    codecs   - ratio and MB/s of each codec on the records ingested
+
+and writes the results as JSON. Run it on each commit (or box) to compare:
+
+    python bench.py --out new.json
+    python bench.py --compare old.json new.json
+
+Only the standard library is needed, so it runs wherever TS2DB does.
+"""
+from os.path import join, dirname, abspath
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# The ts2db modules import each other by their plain names.
+sys.path.insert(0, join(dirname(abspath(__file__)), 'ts2db'))
+
+from database import DB, Table, TABLEDEF
+from catalog import catalog
+from pgm import Startup, Shutdown
+from sql import SQL
+from user import User
+
+# Start of the synthetic data, and seconds between the readings of a device.
+BASE = 1700000000
+PERIOD = 10
+
+# A metric whose new value is this much worse than the old is a regression.
+THRESHOLD = 0.10
+
+
+def Percentiles(times:list):
+    """
+    Return the count, p50, p99 and mean of 'times' (seconds) in milliseconds.
+    """
+    times = sorted(times)
+    n = len(times)
+    if not n:
+        return {'n': 0}
+    pick = lambda q: times[min(n - 1, int(q * n))] * 1000
+    return {'n': n, 'p50': pick(0.50), 'p99': pick(0.99), 'mean': sum(times) / n * 1000}
+
+
+def Timed(f, *args):
+    start = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - start
+
+
+def MakeRows(r:random.Random, n:int, devices:int, first:int = 0):
+    """
+    Return 'n' readings of 'devices' sensors, rows 'first' on, in time order.
+    """
+    rows = []
+    for i in range(first, first + n):
+        ts = BASE + (i // devices) * PERIOD
+        rows.append([ts, 'd%d' % (i % devices), round(20 + 5 * r.random(), 2), r.randrange(100)])
+    return rows
+
+
+def MakeTable(t:Table, name:str, args):
+    td = TABLEDEF(name)
+    td.AddCol('ts', 'int', args.ordered)
+    td.AddCol('dev', 'str')
+    td.AddCol('temp', 'float', args.ordered)
+    td.AddCol('humid', 'int')
+    opts = {'timecol': 'ts'}
+    if args.partition:
+        opts['partition'] = args.partition
+    if args.codec:
+        opts['codec'] = args.codec
+    t.create(name, td, opts)
+
+
+def Ingest(t:Table, args):
+    """
+    Insert args.rows rows into table 'sensors', args.batch at a time.
+    """
+    r = random.Random(args.seed)
+    MakeTable(t, 'sensors', args)
+    times = []
+    for first in range(0, args.rows, args.batch):
+        rows = MakeRows(r, min(args.batch, args.rows - first), args.devices, first)
+        times.append(Timed(t.insert_many, 'sensors', rows))
+    t.checkpoint('sensors')
+    total = sum(times)
+    return {'rows': args.rows, 'batch': args.batch, 'seconds': total,
+            'rows_per_s': args.rows / total, 'batch_ms': Percentiles(times)}
+
+
+def Queries(args):
+    """
+    Return the statements of each query benchmark, the same for every run
+    with the same arguments.
+    """
+    r = random.Random(args.seed + 1)
+    span = args.rows // args.devices * PERIOD
+    width = max(PERIOD, span // 100)
+    point = ["SELECT * FROM sensors WHERE dev = 'd%d' AND ts = %d"
+             % (r.randrange(args.devices), BASE + r.randrange(span // PERIOD) * PERIOD)
+             for i in range(args.queries)]
+    ranges = []
+    for i in range(args.queries):
+        low = BASE + r.randrange(max(1, span - width))
+        ranges.append("SELECT * FROM sensors WHERE ts >= %d AND ts < %d" % (low, low + width))
+    values = []
+    for i in range(args.queries):
+        low = round(20 + 4.9 * r.random(), 2)
+        values.append("SELECT ts FROM sensors WHERE temp >= %s AND temp < %s LIMIT 100" % (low, low + 0.05))
+    return {'point': point, 'range': ranges, 'value': values}
+
+
+def RunQueries(s:SQL, statements:list):
+    times = []
+    rows = 0
+    for q in statements:
+        start = time.perf_counter()
+        rows += len(s.execute(q))
+        times.append(time.perf_counter() - start)
+    result = Percentiles(times)
+    result['rows'] = rows
+    result['qps'] = len(times) / sum(times)
+    return result
+
+
+def Search(db:DB, args):
+    """
+    Point and range latency, then the range queries again for each number
+    of Indexers. The result cache is off: every query is run.
+    """
+    queries = Queries(args)
+    results = {}
+    nocache = {'cachesize': 0}
+    t = Table(db, nocache)
+    s = SQL(t)
+    for kind, statements in queries.items():
+        # Once through to warm the caches, then measured.
+        RunQueries(s, statements[:10])
+        results[kind] = RunQueries(s, statements)
+
+    fanout = {}
+    for n in args.workers:
+        queues = Startup(n) if n else None
+        try:
+            s = SQL(Table(db, nocache, queues=queues))
+            RunQueries(s, queries['range'][:10])
+            fanout[str(n)] = {kind: RunQueries(s, queries[kind]) for kind in ('range', 'value')}
+        finally:
+            if queues:
+                Shutdown(queues)
+    results['fanout'] = fanout
+    return results
+
+
+def Cache(db:DB, args):
+    """
+    Range query latency with the result cache: first run, repeated, and
+    repeated after a batch of rows is appended to the table.
+    """
+    statements = Queries(args)['range']
+    t = Table(db)
+    s = SQL(t)
+    results = {'cold': RunQueries(s, statements), 'hit': RunQueries(s, statements)}
+    r = random.Random(args.seed + 2)
+    t.insert_many('sensors', MakeRows(r, args.batch, args.devices, args.rows))
+    results['extend'] = RunQueries(s, statements)
+    return results
+
+
+def Catalog(home:str, args):
+    """
+    DB.list(None, True) latency with each number of tables, with the catalog
+    emptied before each call (cold) and not (warm).
+    """
+    u = User()
+    u.home = home
+    u.idxsize = 1 << 16
+    db = DB('catalog', u)
+    t = Table(db)
+    results = {}
+    made = 0
+    for n in sorted(args.tables):
+        for i in range(made, n):
+            td = TABLEDEF('t%d' % i)
+            td.AddCol('ts', 'int')
+            td.AddCol('v', 'float')
+            t.create('t%d' % i, td)
+        made = n
+        cold = []
+        for i in range(args.repeat):
+            for name in catalog.tables(db.path):
+                catalog.invalidate(join(db.path, name))
+            catalog.invalidate(db.path)
+            cold.append(Timed(db.list, None, True))
+        warm = [Timed(db.list, None, True) for i in range(args.repeat)]
+        results[str(n)] = {'cold': Percentiles(cold), 'warm': Percentiles(warm)}
+    return results
+
+
+def Describe(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=dirname(abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(), 'platform': platform.platform(),
+            'machine': platform.machine(), 'cpus': os.cpu_count(),
+            'args': {k: v for k, v in vars(args).items() if k not in ('out', 'compare')}}
+
+
+def Run(args):
+    home = args.home or tempfile.mkdtemp(prefix='ts2db-bench-')
+    try:
+        u = User()
+        u.home = home
+        u.idxsize = args.idxsize
+        db = DB('bench', u)
+        results = {'ingest': Ingest(Table(db), args)}
+        results.update(Search(db, args))
+        results['cache'] = Cache(db, args)
+        results['catalog'] = Catalog(home, args)
+        results['codecs'] = {c.pop('codec'): c for c in Table(db).codecs('sensors')}
+    finally:
+        if not args.keep:
+            shutil.rmtree(home, ignore_errors=True)
+    return {'meta': Describe(args), 'results': results}
+
+
+def _leaves(d:dict, prefix:str = ''):
+    for k, v in d.items():
+        if isinstance(v, dict):
+            yield from _leaves(v, prefix + k + '.')
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            yield prefix + k, v
+
+
+def Compare(old:dict, new:dict):
+    """
+    Print every metric of two result files side by side and return the
+    number that got worse by more than THRESHOLD. Rates and throughputs
+    (rows_per_s, qps, *_mbs) are better higher, times lower; counts aren't
+    compared.
+    """
+    before = dict(_leaves(old['results']))
+    worse = 0
+    print('%-40s %12s %12s %8s' % ('metric', (old['meta'].get('commit') or 'old')[:12],
+                                   (new['meta'].get('commit') or 'new')[:12], 'change'))
+    for key, value in _leaves(new['results']):
+        if key not in before or key.endswith(('.n', '.rows', '.batch')):
+            continue
+        was = before[key]
+        change = (value - was) / was if was else 0.0
+        higher = key.endswith(('rows_per_s', 'qps', '_mbs'))
+        bad = change < -THRESHOLD if higher else change > THRESHOLD
+        worse += bad
+        print('%-40s %12.3f %12.3f %+7.1f%%%s' % (key, was, value, change * 100, '  <<' if bad else ''))
+    return worse
+
+
+def _ints(text:str):
+    return [int(x) for x in text.split(',') if x]
+
+
+def main(argv:list|None = None):
+    parser = argparse.ArgumentParser(description='Benchmark TS2DB.')
+    parser.add_argument('--rows', type=int, default=100000, help='rows to ingest')
+    parser.add_argument('--batch', type=int, default=1000, help='rows per insert_many')
+    parser.add_argument('--devices', type=int, default=100, help='distinct sensors')
+    parser.add_argument('--queries', type=int, default=200, help='queries of each kind')
+    parser.add_argument('--workers', type=_ints, default=[0, 1, 2, 4], help='Indexer counts, e.g. 0,1,2,4')
+    parser.add_argument('--tables', type=_ints, default=[1, 10, 100], help='table counts for DB.list')
+    parser.add_argument('--repeat', type=int, default=50, help='DB.list calls per table count')
+    parser.add_argument('--idxsize', type=int, default=1 << 20, help='initial index file size')
+    parser.add_argument('--partition', choices=['hour', 'day'], default=None)
+    parser.add_argument('--codec', default=None, help="codec of the records, e.g. 'zlib:6'")
+    parser.add_argument('--ordered', action='store_true', help='keep ordered indices of ts and temp')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--home', default=None, help='scratch directory, a new temporary one if not given')
+    parser.add_argument('--keep', action='store_true', help="don't remove the scratch directory")
+    parser.add_argument('--out', default=None, help='write the results here, else to stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as fp:
+            old = json.load(fp)
+        with open(args.compare[1]) as fp:
+            new = json.load(fp)
+        return 1 if Compare(old, new) else 0
+
+    report = json.dumps(Run(args), indent=2)
+    if args.out:
+        with open(args.out, 'w') as fp:
+            fp.write(report + '\n')
+    else:
+        print(report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,16 +2,35 @@
 
 This is the top of the TS2DB 
 """
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 import logging
 import asyncio
 import json
+import sys
+from os.path import join, dirname, abspath
 
 
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse, PlainTextResponse
 import uvicorn
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
 
-from ts2db.database import createdb
+# The ts2db modules import each other by their plain names, and raise the
+# exceptions of the plain 'exceptions' module.
+sys.path.insert(0, join(dirname(abspath(__file__)), 'ts2db'))
+
+from database import DB, Table, TABLEDEF, Compactor
+from replicate import Replicator, DirectorySink
+from feed import feeds
+from user import User
+from sql import SQL
+from pgm import Startup, Shutdown
+from metrics import metrics
+import exceptions
 
 # Valid Logging Le(...,vel flags
 class LOGENUM(str, Enum):
@@ -26,9 +45,131 @@ class LOGENUM(str, Enum):
 DEF_IP = "127.0.0.1"
 DEF_PORT = 8000
 
+# Default number of query threads and of requests each executor admits,
+# running or waiting.
+DEF_READERS = 4
+DEF_BACKLOG = 64
+
+# Batches of matches a subscriber may fall behind by before it is dropped,
+# and seconds between keep alive comments on an idle subscription.
+SUBBACKLOG = 256
+KEEPALIVE = 15
+
 
 app = FastAPI()
 
+# Where the databases live, and the Table handle and SQL processor of each
+# database opened so far.
+user = User()
+tables = {}
+processors = {}
+
+# Nothing that touches the disk or waits on the Indexers runs on the event
+# loop. Writes go through a single thread, so the inserts into a table never
+# interleave; queries have threads of their own, so an ingest burst doesn't
+# hold them up. 'queues' are the Indexers, if any were started.
+readpool = ThreadPoolExecutor(DEF_READERS, thread_name_prefix='read')
+writepool = ThreadPoolExecutor(1, thread_name_prefix='write')
+queues = None
+
+# Seconds between index compactions of the tables of each database, 0 for none.
+compact = 0
+compactors = []
+
+# Directory the change feeds of the tables made with the 'feed' option are
+# shipped to, a directory per database, None for no replication.
+replicateto = None
+replicators = {}
+
+
+class Admission:
+    """
+    Bound on the requests admitted to an executor. A request over the bound
+    is turned away at once with 'status' rather than queued without limit.
+    Only used from the event loop, so no lock is needed.
+    """
+
+    def __init__(self, limit:int, status:int):
+        self._limit = limit
+        self._status = status
+        self._count = 0
+
+    def get_count(self):
+        return self._count
+    count = property(get_count)
+
+    def __enter__(self):
+        if self._count >= self._limit:
+            metrics.count('rejected')
+            raise HTTPException(self._status, "Server is busy, try again later.",
+                                headers={"Retry-After": "1"})
+        self._count += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._count -= 1
+
+
+# Too many inserts is the client's doing (429), too many queries is ours (503).
+writes = Admission(DEF_BACKLOG, 429)
+reads = Admission(DEF_BACKLOG, 503)
+
+
+def gettable(dbname:str):
+    """
+    Return the Table handle of database 'dbname', opening it the first time.
+    """
+    if dbname not in tables:
+        table = tables.setdefault(dbname, Table(DB(dbname, user), queues=queues))
+        if compact and table not in [c.table for c in compactors]:
+            c = Compactor(table, compact)
+            compactors.append(c)
+            c.start()
+    if replicateto:
+        # Tables with a feed may have been made since.
+        table = tables[dbname]
+        for name in feeds.names(table.db.path):
+            if (dbname, name) not in replicators:
+                r = Replicator(table, name, DirectorySink(join(replicateto, dbname)))
+                replicators[(dbname, name)] = r
+                r.start()
+    return tables[dbname]
+
+
+def getsql(dbname:str):
+    """
+    Return the SQL processor of database 'dbname', keeping its compiled
+    statements across requests.
+    """
+    if dbname not in processors:
+        processors[dbname] = SQL(gettable(dbname))
+    return processors[dbname]
+
+
+def createtable(req:dict):
+    """
+    Create a table.
+    
+    {
+      "database": <database name, made if need be>,
+      "table": <table name>,
+      "columns": {<column>: <"str", "int" or "float">, ...},
+      "ordered": [<int or float column kept in an ordered index too>, ...],
+      "opts": {<table option>: <value>, ...}
+    }
+    
+    The options are those of Table.create.
+    """
+    for i in ['database', 'table', 'columns']:
+        if i not in req:
+            raise exceptions.TableError("'%s' is missing on create table request!" % (i))
+    tbl = TABLEDEF(req['table'])
+    ordered = req.get('ordered', [])
+    for col, coltype in req['columns'].items():
+        tbl.AddCol(col, coltype, col in ordered)
+    gettable(req['database']).create(req['table'], tbl, req.get('opts'))
+    return {"created": req['table']}
+
 
 @app.get("/login",
          description="Log into the service.")
@@ -50,7 +191,7 @@ def logout():
 
 @app.post("/create",
           description="Create some resource, database etc..")
-def create_request(creq):
+async def create_request(creq):
     """
     Input into this function is a JSON document that detauls exactly
     what is being created.
@@ -64,8 +205,10 @@ def create_request(creq):
     <what-op> is "table", for create a database table.
     """
     
-    opstable = {"table":createdb}
-    jreq = json.loads(creq)
+    opstable = {"table":createtable}
+    metrics.count('requests')
+    with metrics.stage('parse'):
+        jreq = json.loads(creq)
     if 'operation' not in jreq:
         raise HTTPException(400, "Operation to perform is missing!")
     op = jreq["operation"]
@@ -73,17 +216,268 @@ def create_request(creq):
         raise HTTPException(400, "Invalid operations '%s' specified!" % (op))    
     if 'request' not in jreq:
         raise HTTPException(400, "Request data missing on create %s operation!" % (op))
-    rc = opstable[op](jreq["request"])
+    try:
+        with writes:
+            rc = await asyncio.get_running_loop().run_in_executor(writepool, opstable[op], jreq["request"])
+    except (exceptions.TableError, exceptions.NameError, exceptions.TypeError) as e:
+        raise HTTPException(400, e.args[0])
     return rc
 
 
+@app.post("/insert",
+          description="Insert a batch of rows into a table.")
+async def insert_request(ireq):
+    """
+    Input into this function is a JSON document with the rows to insert. The
+    whole batch is validated, written and made durable together.
+    
+    {
+      "database": <database name>,
+      "table": <table name>,
+      "rows": [
+         {<column>: <value>, ...},
+         ...
+      ]
+    }
+    """
+    metrics.count('requests')
+    with metrics.stage('parse'):
+        jreq = json.loads(ireq)
+    for i in ['database', 'table', 'rows']:
+        if i not in jreq:
+            raise HTTPException(400, "'%s' is missing on insert request!" % (i))
+    def insert():
+        return gettable(jreq['database']).insert_many(jreq['table'], jreq['rows'])
+    try:
+        with writes:
+            offsets = await asyncio.get_running_loop().run_in_executor(writepool, insert)
+    except (exceptions.TableError, exceptions.NameError, exceptions.TypeError, exceptions.IndexError) as e:
+        raise HTTPException(400, e.args[0])
+    return {"inserted": len(offsets)}
+
+
+# Media type of each streamed result format.
+STREAMTYPES = {"ndjson": "application/x-ndjson",
+               "arrow": "application/vnd.apache.arrow.stream"}
+
+
+async def batches(gen):
+    """
+    Hand out the batches of a Table.stream generator, each one read in the
+    query threads. The next batch is only read once the last one has been
+    sent, so a slow client holds the query back rather than the server
+    holding the result.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            batch = await loop.run_in_executor(readpool, next, gen, None)
+            if batch is None:
+                break
+            yield batch
+    finally:
+        reads.__exit__()
+
+
+async def ndjson(gen):
+    """
+    One JSON document per row, one line per document.
+    """
+    async for batch in batches(gen):
+        yield "".join(json.dumps(row) + "\n" for row in batch).encode("utf-8")
+
+
+class Chunks:
+    """
+    File for the Arrow IPC writer that keeps what is written until taken.
+    """
+
+    closed = False
+
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+async def arrow(gen):
+    """
+    An Arrow IPC stream, one record batch per batch of rows.
+    """
+    sink = Chunks()
+    writer = schema = None
+    async for batch in batches(gen):
+        if writer is None:
+            rb = pa.RecordBatch.from_pylist(batch)
+            schema = rb.schema
+            writer = pa.ipc.new_stream(sink, schema)
+        else:
+            rb = pa.RecordBatch.from_pylist(batch, schema=schema)
+        writer.write_batch(rb)
+        yield sink.take()
+    if writer is None:
+        writer = pa.ipc.new_stream(sink, pa.schema([]))
+    writer.close()
+    yield sink.take()
+
+
 @app.post("/sql",
           description="Execute a single SQL request")
-def sql_request(sqlreq):
+async def sql_request(sqlreq, request: Request):
     """
     Handle all SQL requests here!
+    
+    {
+      "database": <database name>,
+      "statement": <SQL SELECT, DELETE or UPDATE statement>,
+      "format": <"json", "ndjson" or "arrow">
+    }
+    
+    "json", the default, returns {"rows": [...]}. "ndjson" and "arrow" stream
+    the rows as they are read, as newline delimited JSON or an Arrow IPC
+    stream, so the result is never held whole. Without a "format" an Accept
+    header naming one of the streamed media types picks it.
+    
+    A statement starting with EXPLAIN ANALYZE returns the stages it went
+    through and the time each took rather than its rows. A DELETE or UPDATE
+    runs on the write thread, as an insert does, and returns the number of
+    rows it changed; the queries running meanwhile aren't held up by it.
+    """
+    metrics.count('requests')
+    with metrics.stage('parse'):
+        jreq = json.loads(sqlreq)
+    for i in ['database', 'statement']:
+        if i not in jreq:
+            raise HTTPException(400, "'%s' is missing on sql request!" % (i))
+    fmt = jreq.get('format')
+    if fmt is None:
+        accept = request.headers.get('accept', '')
+        fmt = ([f for f, t in STREAMTYPES.items() if t in accept] or ['json'])[0]
+    if fmt != 'json' and fmt not in STREAMTYPES:
+        raise HTTPException(400, "Invalid format '%s' specified!" % (fmt))
+    if fmt == 'arrow' and pa is None:
+        raise HTTPException(400, "Arrow output needs pyarrow installed!")
+    if fmt in STREAMTYPES:
+        # The read slot is held until the stream ends, see batches().
+        reads.__enter__()
+        try:
+            loop = asyncio.get_running_loop()
+            proc = await loop.run_in_executor(readpool, getsql, jreq['database'])
+            await loop.run_in_executor(readpool, proc.compile, jreq['statement'])
+        except (exceptions.SQLError, exceptions.TableError) as e:
+            reads.__exit__()
+            raise HTTPException(400, e.args[0])
+        except BaseException:
+            reads.__exit__()
+            raise
+        gen = proc.stream(jreq['statement'])
+        body = ndjson(gen) if fmt == 'ndjson' else arrow(gen)
+        return StreamingResponse(body, media_type=STREAMTYPES[fmt])
+    try:
+        loop = asyncio.get_running_loop()
+        proc = await loop.run_in_executor(readpool, getsql, jreq['database'])
+        if await loop.run_in_executor(readpool, proc.modifies, jreq['statement']):
+            # A DELETE or UPDATE is a write like an insert.
+            with writes:
+                rows = await loop.run_in_executor(writepool, proc.execute, jreq['statement'])
+        else:
+            with reads:
+                rows = await proc.execute_async(jreq['statement'], readpool)
+    except (exceptions.SQLError, exceptions.TableError, exceptions.IndexError,
+            exceptions.NameError, exceptions.TypeError) as e:
+        raise HTTPException(400, e.args[0])
+    return {"rows": rows}
+
+
+@app.get("/subscribe",
+         description="Push the rows inserted from now on that a SELECT selects, as server sent events")
+async def subscribe_request(subreq, request: Request):
+    """
+    Subscribe to the rows inserted into a table that a statement selects,
+    rather than polling /sql for them.
+    
+    {
+      "database": <database name>,
+      "statement": <SQL SELECT statement, without ORDER BY, LIMIT or aggregates>
+    }
+    
+    The response is a text/event-stream: an event "subscribed" with the id
+    of the subscription, then an event "rows" per inserted batch holding
+    matches, its data the JSON list of the rows. A subscriber that falls
+    SUBBACKLOG batches behind gets an event "lagging" and the stream ends.
+    The subscription ends when the client goes away.
     """
-    return{"Hello": "sql"}
+    metrics.count('requests')
+    with metrics.stage('parse'):
+        jreq = json.loads(subreq)
+    for i in ['database', 'statement']:
+        if i not in jreq:
+            raise HTTPException(400, "'%s' is missing on subscribe request!" % (i))
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    
+    def put(rows):
+        # Room is kept for the marker that the subscriber is lagging.
+        if queue.qsize() < SUBBACKLOG:
+            queue.put_nowait(rows)
+        elif queue.qsize() == SUBBACKLOG:
+            queue.put_nowait(None)
+    
+    def deliver(rows):
+        # Called by the write thread, see Subscriptions.publish.
+        loop.call_soon_threadsafe(put, rows)
+    
+    try:
+        proc = await loop.run_in_executor(readpool, getsql, jreq['database'])
+        subid = await loop.run_in_executor(readpool, proc.subscribe, jreq['statement'], deliver)
+    except (exceptions.SQLError, exceptions.TableError) as e:
+        raise HTTPException(400, e.args[0])
+    
+    async def events():
+        try:
+            yield "event: subscribed\ndata: %d\n\n" % (subid)
+            while True:
+                try:
+                    rows = await asyncio.wait_for(queue.get(), KEEPALIVE)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keepalive\n\n"
+                    continue
+                if rows is None:
+                    yield "event: lagging\ndata: %d\n\n" % (subid)
+                    break
+                yield "event: rows\ndata: %s\n\n" % (json.dumps(rows))
+        finally:
+            proc.unsubscribe(subid)
+    
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/metrics",
+         description="Counters and timings of every stage, in the Prometheus text format.")
+def metrics_request():
+    """
+    The stage timings, counters and catalog hit rate of this server, see
+    ts2db/metrics.py.
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 
 async def serverapp(serverip:str, port:int, loglevel:LOGENUM):
@@ -93,15 +487,42 @@ async def serverapp(serverip:str, port:int, loglevel:LOGENUM):
 
 
 if __name__ == "__main__":
-    import sys
     import typer
 
     def main(serverip:str = typer.Argument(DEF_IP, help="IP address of server", metavar='IPaddress'),
              port:int = typer.Argument(DEF_PORT, help="PORT of control message server", metavar='int'),
-             logLevel:LOGENUM =  LOGENUM.info):
+             logLevel:LOGENUM =  LOGENUM.info,
+             home:str = typer.Option('.', help="Directory holding the databases"),
+             idxsize:int = typer.Option(1<<24, help="Initial size of new index files, in bytes"),
+             readers:int = typer.Option(DEF_READERS, help="Threads running queries"),
+             backlog:int = typer.Option(DEF_BACKLOG, help="Requests admitted per executor before 429/503"),
+             indexers:int = typer.Option(0, help="Indexer processes, 0 to search in the query threads"),
+             compactevery:float = typer.Option(0, help="Seconds between index compactions, 0 for none"),
+             replicate:str = typer.Option(None, help="Directory to ship the change feeds of the tables to")):
+            global readpool, writes, reads, queues, compact, replicateto
+            
+            user.home = home
+            user.idxsize = idxsize
+            compact = compactevery
+            replicateto = replicate
+            readpool = ThreadPoolExecutor(readers, thread_name_prefix='read')
+            writes = Admission(backlog, 429)
+            reads = Admission(backlog, 503)
+            
+            # The Indexers are forked before the server starts any threads.
+            if indexers:
+                queues = Startup(indexers)
             
             # Spin up the server!
-            asyncio.run(serverapp(serverip, port, logLevel))
+            try:
+                asyncio.run(serverapp(serverip, port, logLevel))
+            finally:
+                for c in compactors:
+                    c.stop()
+                for r in replicators.values():
+                    r.stop()
+                if queues:
+                    Shutdown(queues)
 
     typer.run(main)
     
\ No newline at end of file
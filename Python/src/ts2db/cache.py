@@ -0,0 +1,127 @@
+"""
+class ResultCache - in process cache of query results.
+
+Dashboards run the same queries every few seconds against tables that are
+only appended to. Table.execute looks each program up here first, keyed on
+the table and the program itself (the parallel steps and the common
+program, see pgm.py), so the same statement always finds its result.
+
+Every table connection keeps a write generation (see PERCONNECT) that is
+bumped whenever the table is written, and an epoch bumped only when rows
+go away rather than being added. An entry is returned as is while the
+generation it was computed at is still the table's. When only the
+generation moved, an entry holding the records of each segment (a program
+fetching records, with no order, limit or aggregate, such as a time range
+query) is extended with the records appended to each segment since; any
+other entry is computed again.
+
+The cache holds at most a number of bytes, estimated from the results,
+and drops the least recently used entries to stay under it.
+"""
+from collections import OrderedDict
+from array import array
+import sys
+import threading
+
+# Bytes of results cached by default.
+CACHESIZE = 64 << 20
+
+
+def Sizeof(result):
+    """
+    Return an estimate of the bytes held by a query result: offsets, records,
+    columns or aggregates, or a dict of bucket to one of those.
+    """
+    if isinstance(result, array):
+        return sys.getsizeof(result)
+    if isinstance(result, dict):
+        return sys.getsizeof(result) + sum(sys.getsizeof(k) + Sizeof(v) for k, v in result.items())
+    if isinstance(result, (list, tuple)):
+        return sys.getsizeof(result) + sum(Sizeof(v) for v in result)
+    return sys.getsizeof(result)
+
+
+class ResultCache:
+    """
+    Least recently used cache of query results, bounded in bytes.
+
+    Methods:
+
+          ResultCache(size) - an empty cache of at most 'size' bytes
+                get(key) - return the entry of 'key', None if there is none
+      put(key, entry, n) - keep 'entry', of about 'n' bytes, as 'key'
+       invalidate(name) - drop the entries of table 'name', every entry if None
+
+    Attributes:
+
+         size - most bytes the entries may hold
+        bytes - bytes the entries hold now
+      entries - number of entries
+         hits - lookups that found an entry, current or not
+       misses - lookups that didn't
+    """
+
+    def __init__(self, size:int = CACHESIZE):
+        self._size = size
+        self._bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get_size(self):
+        return self._size
+    size = property(get_size)
+
+    def get_bytes(self):
+        return self._bytes
+    bytes = property(get_bytes)
+
+    def get_entries(self):
+        return len(self._entries)
+    entries = property(get_entries)
+
+    def get_hits(self):
+        return self._hits
+    hits = property(get_hits)
+
+    def get_misses(self):
+        return self._misses
+    misses = property(get_misses)
+
+    def get(self, key:tuple):
+        """
+        Return the entry of 'key', the most recently used from now on, or
+        None. Keys start with the table name.
+        """
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._entries.move_to_end(key)
+            return item[0]
+
+    def put(self, key:tuple, entry, n:int):
+        """
+        Keep 'entry' as 'key', dropping the least recently used entries to
+        make room. An entry larger than the whole cache isn't kept.
+        """
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            if n > self._size:
+                return
+            self._entries[key] = (entry, n)
+            self._bytes += n
+            while self._bytes > self._size:
+                k, (e, m) = self._entries.popitem(last=False)
+                self._bytes -= m
+
+    def invalidate(self, name:str|None = None):
+        with self._lock:
+            for key in list(self._entries):
+                if name is None or key[0] == name:
+                    self._bytes -= self._entries.pop(key)[1]
@@ -0,0 +1,125 @@
+"""
+class Catalog - in process cache of database and table definitions.
+
+Every database and table directory holds an info.json.bz2. Decompressing
+and parsing it on every call is what the catalog avoids: each file is
+loaded once and then only stat()ed. An entry is reloaded when the file's
+modification time, size or inode change, or when it was invalidated by a
+create or delete made through this process.
+
+Whatever the name, an info.json.bz2 may be compressed with any codec (or
+none), see codec.py; WriteInfo writes one with the codec chosen for the
+database or table, and the codec is told from the data when it is read.
+
+The table names of a database are kept the same way, keyed by the
+modification time of the database directory (which changes whenever a
+table directory is made or removed), so listing the tables doesn't walk
+the tree.
+
+'catalog' is the catalog shared by everything in the process.
+"""
+from os.path import join, exists
+from os import listdir, stat
+import json
+import threading
+
+from codec import Compress, Unpack, INFOCODEC
+from metrics import metrics
+
+INFO = 'info.json.bz2'
+
+
+def WriteInfo(path:str, info, codec:str|None = None):
+    """
+    Write 'info' as the info.json.bz2 of directory 'path', compressed with
+    'codec' (INFOCODEC if None).
+    """
+    with open(join(path, INFO), 'wb') as fp:
+        fp.write(Compress(json.dumps(info).encode('utf-8'), codec or INFOCODEC))
+
+
+class Catalog:
+    """
+    Cache of info.json.bz2 contents and table names.
+
+    Methods:
+
+             info(path) - return the parsed info.json.bz2 of directory 'path'
+         tables(dbpath) - return the names of the tables of database 'dbpath'
+       invalidate(path) - forget what is cached for directory 'path'
+
+    Attributes:
+
+         hits - lookups answered from the cache
+       misses - lookups that had to read the disk
+    """
+
+    def __init__(self):
+        self._info = {}
+        self._tables = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get_hits(self):
+        return self._hits
+    hits = property(get_hits)
+
+    def get_misses(self):
+        return self._misses
+    misses = property(get_misses)
+
+    def info(self, path:str):
+        """
+        Return the parsed info.json.bz2 of the database or table directory
+        'path'. The result is shared, don't change it.
+
+        Exceptions:
+            FileNotFoundError - there is no info.json.bz2 in 'path'
+        """
+        st = stat(join(path, INFO))
+        key = (st.st_mtime_ns, st.st_size, st.st_ino)
+        with self._lock:
+            entry = self._info.get(path)
+            if entry and entry[0] == key:
+                self._hits += 1
+                return entry[1]
+            self._misses += 1
+        with metrics.stage('catalog_load'):
+            with open(join(path, INFO), 'rb') as fp:
+                info = json.loads(Unpack(fp.read()))
+        with self._lock:
+            self._info[path] = (key, info)
+        return info
+
+    def tables(self, dbpath:str):
+        """
+        Return the sorted names of the tables in database directory 'dbpath'.
+        """
+        key = stat(dbpath).st_mtime_ns
+        with self._lock:
+            entry = self._tables.get(dbpath)
+            if entry and entry[0] == key:
+                self._hits += 1
+                return entry[1]
+            self._misses += 1
+        names = sorted(d for d in listdir(dbpath) if exists(join(dbpath, d, INFO)))
+        with self._lock:
+            self._tables[dbpath] = (key, names)
+        return names
+
+    def invalidate(self, path:str):
+        """
+        Forget the info of 'path' and, if 'path' is a database, its table names.
+        """
+        with self._lock:
+            self._info.pop(path, None)
+            self._tables.pop(path, None)
+
+
+catalog = Catalog()
+
+metrics.gauge('catalog_hits', lambda: catalog.hits, 'Catalog lookups answered from the cache')
+metrics.gauge('catalog_misses', lambda: catalog.misses, 'Catalog lookups that read the disk')
+metrics.gauge('catalog_hit_ratio', lambda: catalog.hits / max(1, catalog.hits + catalog.misses),
+              'Share of catalog lookups answered from the cache')
@@ -0,0 +1,169 @@
+"""
+The compression codecs records and info files can be stored with.
+
+A codec is picked with the 'codec' option of a database or of a table, a
+name optionally followed by a level:
+
+    none        - stored as is
+    zlib[:1-9]  - zlib, level 1 unless given
+    bz2[:1-9]   - bz2, level 9 unless given; slow, kept for old data
+    lzma[:0-9]  - lzma (xz), preset 1 unless given
+    lz4[:0-16]  - lz4 frames, if the lz4 package is installed
+    zstd[:1-22] - zstandard, level 3 unless given, if the zstandard
+                  package is installed
+
+Every codec has a fixed id, recorded in each record frame (see records.py),
+so data written with any codec reads back whatever the table uses now.
+Blobs read back with Unpack, the info.json.bz2 files, need no id: every
+compressed format starts with magic bytes of its own and JSON with '{'.
+
+Benchmark compresses samples of real data with each codec and reports the
+ratio against the speed, see Table.codecs.
+"""
+import bz2
+import lzma
+import time
+import zlib
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import exceptions
+
+
+def _zlibmagic(data:bytes):
+    return len(data) >= 2 and data[0] & 0x0f == 8 and (data[0] << 8 | data[1]) % 31 == 0
+
+
+def _zstdcompress(data:bytes, level:int):
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def _zstddecompress(data:bytes):
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+# name: (id, compress(data, level), decompress(data), default level,
+#        (lowest, highest) level, test for the magic bytes, available)
+CODECS = {
+    'none': (0, None, None, 0, (0, 0), None, True),
+    'zlib': (1, zlib.compress, zlib.decompress, 1, (1, 9), _zlibmagic, True),
+    'bz2':  (2, bz2.compress, bz2.decompress, 9, (1, 9), lambda d: d[:3] == b'BZh', True),
+    'lzma': (3, lambda d, l: lzma.compress(d, preset=l), lzma.decompress, 1, (0, 9),
+             lambda d: d[:6] == b'\xfd7zXZ\x00', True),
+    'lz4':  (4, lambda d, l: lz4frame.compress(d, compression_level=l),
+             lambda d: lz4frame.decompress(d), 0, (0, 16),
+             lambda d: d[:4] == b'\x04\x22\x4d\x18', lz4frame is not None),
+    'zstd': (5, _zstdcompress, _zstddecompress, 3, (1, 22),
+             lambda d: d[:4] == b'\x28\xb5\x2f\xfd', zstandard is not None),
+}
+_BYID = {v[0]: name for name, v in CODECS.items()}
+
+# Codec of the info.json.bz2 files of databases and tables not given one.
+INFOCODEC = 'zlib'
+
+
+def Available():
+    """
+    Return the names of the codecs usable here.
+    """
+    return [name for name, c in CODECS.items() if c[6]]
+
+
+def Parse(spec:str):
+    """
+    Return (name, level) of codec 'spec', 'name' or 'name:level'.
+
+    Exceptions:
+        TypeError - the codec is unknown, not installed or the level is out of range
+    """
+    name, _, level = str(spec).partition(':')
+    if name not in CODECS:
+        raise exceptions.TypeError("Codec '%s' is invalid." % (spec))
+    codec = CODECS[name]
+    if not codec[6]:
+        raise exceptions.TypeError("Codec '%s' isn't installed." % (name))
+    if not level:
+        return name, codec[3]
+    try:
+        level = int(level)
+    except ValueError:
+        raise exceptions.TypeError("Codec '%s' has an invalid level." % (spec))
+    if not codec[4][0] <= level <= codec[4][1]:
+        raise exceptions.TypeError("Codec '%s' takes levels %d to %d." % (name, *codec[4]))
+    return name, level
+
+
+def Compress(data:bytes, spec:str):
+    name, level = Parse(spec)
+    compress = CODECS[name][1]
+    return compress(data, level) if compress else data
+
+
+def Decompress(cid:int, data:bytes):
+    """
+    Decompress 'data' compressed by the codec with id 'cid'.
+    """
+    name = _BYID.get(cid)
+    if name is None:
+        raise exceptions.TypeError("Codec id %d is unknown." % (cid))
+    codec = CODECS[name]
+    if not codec[6]:
+        raise exceptions.TypeError("Reading this data needs codec '%s' installed." % (name))
+    return codec[2](data) if codec[2] else data
+
+
+def Unpack(data:bytes):
+    """
+    Decompress 'data' compressed by Compress, telling the codec from the
+    data itself; data that isn't compressed is returned as is.
+    """
+    for name, codec in CODECS.items():
+        if codec[5] and codec[5](data):
+            return Decompress(codec[0], data)
+    return data
+
+
+def Benchmark(samples:list, specs:list|None = None, seconds:float = 0.2):
+    """
+    Compress and decompress each of 'samples' (bytes) with each codec of
+    'specs' (every available codec at its default level if None), each for
+    about 'seconds'. The samples are compressed one at a time, as record
+    frames are.
+
+    Return:
+        list of {'codec', 'ratio', 'compress_mbs', 'decompress_mbs'}, best
+        ratio first
+    """
+    if specs is None:
+        specs = [name for name in Available() if name != 'none']
+    total = sum(len(s) for s in samples)
+    results = []
+    for spec in specs:
+        name, level = Parse(spec)
+        cid = CODECS[name][0]
+        packed = [Compress(s, spec) for s in samples]
+        size = sum(len(p) for p in packed)
+        rates = []
+        for f, data in ((lambda s: Compress(s, spec), samples), (lambda p: Decompress(cid, p), packed)):
+            n = 0
+            start = time.perf_counter()
+            while True:
+                for d in data:
+                    f(d)
+                n += 1
+                elapsed = time.perf_counter() - start
+                if elapsed >= seconds or not total:
+                    break
+            rates.append(total * n / max(elapsed, 1e-9) / 1e6)
+        results.append({'codec': '%s:%d' % (name, level) if name != 'none' else name,
+                        'ratio': total / size if size else 1.0,
+                        'compress_mbs': rates[0], 'decompress_mbs': rates[1]})
+    results.sort(key=lambda r: -r['ratio'])
+    return results
@@ -0,0 +1,302 @@
+"""
+class ColumnFile - the values of one column of a segment, stored by type.
+
+Beside each XXXXX.idx a segment keeps XXXXX.col holding the column's values
+in record order, plus _offsets.col holding the record offset of each row,
+so a query that only needs a column or two reads those files and never
+decodes whole records.
+
+A column file is
+
+    <header>  - 'TS2C', version, column type, 8 bytes
+    <block>   - repeated, one per insert batch:
+                <values> <payload bytes> <payload crc32>, then the payload
+
+and the payload encoding depends on the type of the column:
+
+    int   - delta of delta: the first value, the first delta, then the
+            change of each delta, each zigzag varint encoded. Timestamps
+            and counters arriving at a steady rate cost about a byte each.
+    float - Gorilla XOR: each value is XORed with the one before; an
+            unchanged value costs one bit and a close one only its
+            meaningful bits.
+    str   - the dictionary id the column's index gave the value (its first
+            tier), varint encoded.
+
+Since every column of a segment is written a batch at a time, block n of
+each column file holds the same rows, which lets a reader skip the blocks
+holding none of the rows it wants without decoding them.
+"""
+from os.path import exists
+import os
+import struct
+import zlib
+
+import exceptions
+
+_HDR = struct.Struct('<4sHH')
+_MAGIC = b'TS2C'
+_VERSION = 1
+_BLOCK = struct.Struct('<III')
+
+_TYPES = {'str': 0, 'int': 1, 'float': 2, 'offset': 3}
+
+# Name of the column file holding the record offset of each row.
+OFFSETS = '_offsets'
+
+
+def _varints(values, out:bytearray):
+    for v in values:
+        while v > 0x7f:
+            out.append((v & 0x7f) | 0x80)
+            v >>= 7
+        out.append(v)
+
+
+def _unvarints(data:bytes, n:int):
+    values = []
+    pos = 0
+    for i in range(n):
+        v = shift = 0
+        while True:
+            b = data[pos]
+            pos += 1
+            v |= (b & 0x7f) << shift
+            if b < 0x80:
+                break
+            shift += 7
+        values.append(v)
+    return values
+
+
+def _zigzag(v:int):
+    return (v << 1) if v >= 0 else ((-v) << 1) - 1
+
+
+def _unzigzag(v:int):
+    return (v >> 1) if not v & 1 else -((v + 1) >> 1)
+
+
+def EncodeInts(values:list):
+    """
+    Delta of delta, zigzag varint encoding of a list of ints.
+    """
+    out = bytearray()
+    prev = delta = 0
+    codes = []
+    for i, v in enumerate(values):
+        if i == 0:
+            codes.append(_zigzag(v))
+        elif i == 1:
+            delta = v - prev
+            codes.append(_zigzag(delta))
+        else:
+            d = v - prev
+            codes.append(_zigzag(d - delta))
+            delta = d
+        prev = v
+    _varints(codes, out)
+    return bytes(out)
+
+
+def DecodeInts(data:bytes, n:int):
+    values = []
+    prev = delta = 0
+    for i, c in enumerate(_unvarints(data, n)):
+        c = _unzigzag(c)
+        if i == 0:
+            prev = c
+        elif i == 1:
+            delta = c
+            prev += delta
+        else:
+            delta += c
+            prev += delta
+        values.append(prev)
+    return values
+
+
+def EncodeFloats(values:list):
+    """
+    Gorilla XOR encoding of a list of floats.
+    """
+    out = bytearray()
+    acc = nbits = 0
+    prev = 0
+    lead = trail = -1
+
+    def put(v, n):
+        nonlocal acc, nbits
+        acc = (acc << n) | v
+        nbits += n
+        while nbits >= 8:
+            nbits -= 8
+            out.append((acc >> nbits) & 0xff)
+        acc &= (1 << nbits) - 1
+
+    for i, f in enumerate(values):
+        bits = struct.unpack('<Q', struct.pack('<d', f))[0]
+        if i == 0:
+            put(bits, 64)
+        else:
+            x = bits ^ prev
+            if x == 0:
+                put(0, 1)
+            else:
+                lz = min(64 - x.bit_length(), 31)
+                tz = (x & -x).bit_length() - 1
+                if lead >= 0 and lz >= lead and tz >= trail:
+                    # Fits the window of the last value.
+                    put(0b10, 2)
+                    put(x >> trail, 64 - lead - trail)
+                else:
+                    lead, trail = lz, tz
+                    put(0b11, 2)
+                    put(lead, 5)
+                    put(64 - lead - trail - 1, 6)
+                    put(x >> trail, 64 - lead - trail)
+        prev = bits
+    if nbits:
+        out.append((acc << (8 - nbits)) & 0xff)
+    return bytes(out)
+
+
+def DecodeFloats(data:bytes, n:int):
+    values = []
+    pos = 0
+    prev = 0
+    lead = trail = 0
+
+    def get(k):
+        nonlocal pos
+        first = pos >> 3
+        last = (pos + k + 7) >> 3
+        chunk = int.from_bytes(data[first:last], 'big')
+        shift = (last << 3) - pos - k
+        pos += k
+        return (chunk >> shift) & ((1 << k) - 1)
+
+    for i in range(n):
+        if i == 0:
+            bits = get(64)
+        elif get(1) == 0:
+            bits = prev
+        else:
+            if get(1) == 1:
+                lead = get(5)
+                trail = 64 - lead - (get(6) + 1)
+            bits = prev ^ (get(64 - lead - trail) << trail)
+        values.append(struct.unpack('<d', struct.pack('<Q', bits))[0])
+        prev = bits
+    return values
+
+
+class ColumnFile:
+    """
+    One column file of a segment.
+
+    Methods:
+
+    ColumnFile(path, coltype) - open (or create) the column file
+           append(values, ids) - encode 'values' as a new block, 'ids' is
+                                 the dictionary id of each value of a str column
+          counts() - return the number of values in each block
+    read(blocks, index) - return the values of each block, None for the
+                          blocks not in 'blocks'; 'index' turns str ids into values
+      refresh() - see the blocks other processes appended
+        flush() - make the file durable
+        close() - close the file
+
+    Attributes:
+
+        path - file path of the column file
+        size - size of the file, in bytes
+    """
+
+    def __init__(self, path:str, coltype:str):
+        self._path = path
+        self._coltype = coltype
+        if not exists(path):
+            with open(path, 'wb') as fp:
+                fp.write(_HDR.pack(_MAGIC, _VERSION, _TYPES[coltype]))
+        self._fd = os.open(path, os.O_RDWR)
+        hdr = os.pread(self._fd, _HDR.size, 0)
+        if len(hdr) != _HDR.size or _HDR.unpack(hdr)[0] != _MAGIC:
+            self.close()
+            raise exceptions.TableError("'%s' is not a column file." % (path))
+        self._end = os.fstat(self._fd).st_size
+        self._blocks = None
+
+    def _index(self):
+        """
+        Return [(values, payload position, payload bytes, crc)] of every
+        block. Only the headers of blocks appended since the last call are read.
+        """
+        if self._blocks is None:
+            self._blocks = []
+            self._scanned = _HDR.size
+        pos = self._scanned
+        while pos + _BLOCK.size <= self._end:
+            n, nbytes, crc = _BLOCK.unpack(os.pread(self._fd, _BLOCK.size, pos))
+            if pos + _BLOCK.size + nbytes > self._end:
+                # Still being written by another process.
+                break
+            self._blocks.append((n, pos + _BLOCK.size, nbytes, crc))
+            pos += _BLOCK.size + nbytes
+        self._scanned = pos
+        return self._blocks
+
+    def refresh(self):
+        self._end = os.fstat(self._fd).st_size
+        if self._blocks is not None and self._end < self._scanned:
+            self._blocks = None
+
+    def get_path(self):
+        return self._path
+    path = property(get_path)
+
+    def get_size(self):
+        return self._end
+    size = property(get_size)
+
+    def append(self, values:list, ids:list|None = None):
+        if self._coltype in ('int', 'offset'):
+            payload = EncodeInts(values)
+        elif self._coltype == 'float':
+            payload = EncodeFloats([float(v) for v in values])
+        else:
+            out = bytearray()
+            _varints(ids, out)
+            payload = bytes(out)
+        block = _BLOCK.pack(len(values), len(payload), zlib.crc32(payload)) + payload
+        os.pwrite(self._fd, block, self._end)
+        self._end += len(block)
+
+    def counts(self):
+        return [b[0] for b in self._index()]
+
+    def read(self, blocks=None, index=None):
+        result = []
+        for i, (n, pos, nbytes, crc) in enumerate(self._index()):
+            if blocks is not None and i not in blocks:
+                result.append(None)
+                continue
+            payload = os.pread(self._fd, nbytes, pos)
+            if zlib.crc32(payload) != crc:
+                raise exceptions.TableError("Block %d of '%s' is damaged." % (i, self._path))
+            if self._coltype in ('int', 'offset'):
+                result.append(DecodeInts(payload, n))
+            elif self._coltype == 'float':
+                result.append(DecodeFloats(payload, n))
+            else:
+                names = index.domain()
+                result.append([names[i] for i in _unvarints(payload, n)])
+        return result
+
+    def flush(self):
+        os.fsync(self._fd)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -11,17 +11,35 @@ The following files are part of a "database"
             XXXXX.idx - Index file associate with column XXXXX (see the table
                         definitions for what columns have indices,)
          record talbe - the file that holds the records of the database. Actual
-                        name is records.bz2
+                        name is records.dat
+     write ahead log - wal.log and checkpoint.json, see wal.py
 """
-from os.path import join, exists, getsize
-from os import mkdir, rmdir, walk, listdir
-import bz2
+from os.path import join, exists, basename, dirname, splitext
+from os import mkdir, listdir
+from array import array
+from bisect import bisect_left
+import asyncio
+import copy
 import json
+import logging
 import shutil
+import threading
+import time
 
 from user import User
 import exceptions
-from pgm import Dispatch, Complete
+from pgm import Dispatch, Collect, CollectAsync, Complete, Batches, Step, Record, Test, Evict, BATCHSIZE
+from catalog import catalog, WriteInfo
+from cache import ResultCache, Sizeof, CACHESIZE
+from subscribe import Subscriptions
+from codec import Parse, Benchmark
+from metrics import metrics
+from segment import Segment, MakeSegment, Bucket, BUCKETS
+from stats import Statistics
+from planner import Plan
+from rollup import Rollup, Results, GRANULARITY
+from wal import Wal, ReadCheckpoint, WriteCheckpoint
+from feed import feeds
 
 class DB:
     """
@@ -47,23 +65,22 @@ class DB:
         # If the database exists, we don't need to do anything.
         self._name = dbname
         self._dbpath = join(user.home, dbname)
-        ipath = join(self._dbpath, "info.json.bz2")
         if not exists(self._dbpath):
-            # Make the root directory of the database.
-            mkdir(self._dbpath)
-            
-            # Create the composite dboptions.
+            # Create the composite dboptions. The codec, if any, is the
+            # default of the tables and compresses the info files.
             if not dbopts:
                 dbopts = {}
             self._opts = dbopts | { 'idxsize': user.idxsize }
+            Parse(self._opts.get('codec', 'none'))
+            
+            # Make the root directory of the database.
+            mkdir(self._dbpath)
             
             # Fill in the various defaults for the database.
-            with bz2.open(ipath, "wb", compresslevel=9) as fp:
-                fp.write(json.dumps(self._opts).encode('utf-8'))
+            WriteInfo(self._dbpath, self._opts, self._opts.get('codec'))
         else:
             # The database already exists, so get the info options.
-            with bz2.open(ipath, 'rb', compresslevel=9) as fp:
-                self._opts = json.loads(fp.read())
+            self._opts = catalog.info(self._dbpath)
                 
     def get_opts(self):
         return self._opts
@@ -89,30 +106,18 @@ class DB:
             list of present table names, if full == False
             dict of present table names plus their column definitions, if full == True
         """
-        
-        def enumerateDir():
-            dirlist = []
-            for r,d,f in walk(self._dbpath):
-                for dir in d:
-                    dirlist.append(join(r,dir))
-            return dirlist
-                    
-        
         # Buidl the list of databases, just in case we haven't been given one.
         if name and isinstance(name, str) :
             name = [name]
             
-        nlist = name if name else enumerateDir()
+        known = catalog.tables(self._dbpath)
+        nlist = [i for i in name if i in known] if name else known
         answer = {} if full else []
         for i in nlist:
-            path = join(self._dbpath, i, 'info.json.bz2')
-            if exists(path):
-                if not full:
-                    answer.append(i)
-                else:
-                    with bz2.open(path, 'rb', compresslevel=9) as fp:
-                        info = json.loads(fp.read())
-                        answer[i] = info['table']
+            if not full:
+                answer.append(i)
+            else:
+                answer[i] = catalog.info(join(self._dbpath, i))['table']
         return(answer)
     
     
@@ -128,11 +133,13 @@ class DB:
              False - Nothing deleted
               True - Database deleted  
         """
-        citems = listdir(self._dbpath)
-        del citems['info.json.bz2']
+        citems = catalog.tables(self._dbpath)
         rc = False
         if (len(citems) and iffull) or not len(citems):
             shutil.rmtree(self._dbpath)
+            for i in citems:
+                catalog.invalidate(join(self._dbpath, i))
+            catalog.invalidate(self._dbpath)
             rc = True
         return(rc)
             
@@ -143,19 +150,22 @@ class TABLEDEF:
     
     Method:
               TableDef(name) - create an empty database table, and give the table 'name'
-    AddCol(colname, coltype) - add a column named 'colname' and type 'coltype' to the table
+    AddCol(colname, coltype, ordered) - add a column named 'colname' and type 'coltype' to the table,
+                               kept in an ordered index too if 'ordered'
                      reset() - reset table name and column definition
            
            
     Attributes:
                       table - get the table columns defined
+                    ordered - get the names of the ordered columns
                        name - set and get table name
     """
-    def _init__(self, name:str):
+    def __init__(self, name:str):
         self._table = {}
+        self._ordered = []
         self._name = name
         
-    def AddCol(self, name, coltype):
+    def AddCol(self, name, coltype, ordered:bool = False):
         
         # Validate name and type
         if not name.isalnum():
@@ -164,15 +174,24 @@ class TABLEDEF:
             raise exceptions.NameError("'%s' is an alredy known name." % (name))
         if coltype not in ['str', 'int', 'float']:
             raise exceptions.TypeError("Type '%s' is invalid." % (coltype))
+        if ordered and coltype == 'str':
+            raise exceptions.TypeError("Only int and float columns can be ordered.")
         self._table[name] = coltype
+        if ordered:
+            self._ordered.append(name)
         
     def reset(self):
         self._table = self._name = None
+        self._ordered = []
     
     def get_table(self):
         return self._table
     table = property(get_table)
     
+    def get_ordered(self):
+        return self._ordered
+    ordered = property(get_ordered)
+    
     def get_name(self):
         return self._name
     def set_name(self, name):
@@ -180,10 +199,115 @@ class TABLEDEF:
     name = property(get_name)
 
 
+# Python types accepted for each column type.
+_PYTYPES = {'str': (str,), 'int': (int,), 'float': (float, int)}
+
+# Bytes of write ahead log that trigger a checkpoint, unless the table
+# option 'walsize' says otherwise.
+WALSIZE = 1 << 24
+
+# Share of the pointers of an index that are tombstones before it is compacted.
+COMPACTRATIO = 0.25
+
+# Bytes of change feed its slowest reader may fall behind before writes to
+# the table wait, and how many seconds they wait, unless the table options
+# 'feedlag' and 'feedwait' say otherwise.
+FEEDLAG = 1 << 28
+FEEDWAIT = 30
+
+# Bounds of the times of an unpartitioned table, for rollups computed again.
+_FOREVER = 1 << 62
+
+
+def _appendable(common:list):
+    """
+    Return True if the result of common program 'common' is the records of
+    each segment in offset order, so the records appended to a segment only
+    add to the end of its part of the result: it fetches the records and
+    doesn't order, limit or aggregate them.
+    """
+    ops = [ins[0] for ins in common if ins[0] != 'timerange']
+    return 'fetch' in ops and not {'columns', 'order', 'limit', 'aggregate'} & set(ops)
+
+
+def _checkrows(cols:dict, rows:list):
+    """
+    Check a batch of rows against the column definitions 'cols', a column at
+    a time. Rows may be dicts or lists of values in column order; the rows
+    are returned as dicts.
+    """
+    names = list(cols)
+    if rows and not isinstance(rows[0], dict):
+        if any(len(r) != len(names) for r in rows):
+            raise exceptions.NameError("Rows must have %d values." % (len(names)))
+        rows = [dict(zip(names, r)) for r in rows]
+    elif any(len(r) != len(names) for r in rows):
+        raise exceptions.NameError("Rows must have exactly the columns %s." % (names))
+    for c in names:
+        try:
+            values = [r[c] for r in rows]
+        except KeyError:
+            raise exceptions.NameError("Column '%s' is missing." % (c))
+        types = _PYTYPES[cols[c]]
+        if not all(type(v) in types for v in values):
+            bad = next(v for v in values if type(v) not in types)
+            raise exceptions.TypeError("Value '%s' is invalid for '%s' column '%s'." % (bad, cols[c], c))
+    return rows
+
+
 class PERCONNECT:
-    def __init__(self, name:str, tbl:TABLEDEF):
+    """
+    Per table state kept while a table is connected: the definition, the
+    options the table was made with and its open segments.
+    
+    Methods:
+         segment(start) - return the segment of bucket 'start', making it if needed
+            drop(start) - remove the segment of bucket 'start'
+              removed() - note that rows were taken away from the table
+               commit() - note that a change to the table is complete, so
+                          the readers pinning it from now on see it
+                  pin() - pin the table as of the last change completed,
+                          for a reader
+        unpin(snapshot) - release what pin() returned
+         horizon(start) - the deletes of segment 'start' no pinned reader
+                          may still see through
+                 close() - close every open segment and the log
+    
+    Attributes:
+         name - name of the table
+     tabledef - definition of the table
+         opts - options of the table
+     segments - dict of bucket start to Segment, the only key is None
+                if the table isn't partitioned
+      rollups - dict of (column, width) to Rollup, opened on first use
+        stats - the Statistics of the segments, loaded on first use
+          wal - the write ahead log of the table, opened on first use
+         feed - the change feed of the table, None unless it has the
+                'feed' option
+         path - directory of the table
+      applied - lsn of the last log entry applied to the segments
+         lock - held while the table is written, checkpointed or compacted
+   generation - write generation, bumped before and after every change to
+                the table, so it is odd while one is being made
+        epoch - bumped whenever rows are taken away rather than added
+    """
+    def __init__(self, name:str, tbl:TABLEDEF, path:str|None = None, opts:dict|None = None):
         self._name = name
         self._tabledef = tbl
+        self._path = path
+        self._opts = opts if opts else {}
+        self._segments = None
+        self._rollups = None
+        self._stats = None
+        self._wal = None
+        self._feed = None
+        self._applied = 0
+        self._lock = threading.RLock()
+        self._generation = 0
+        self._epoch = 0
+        self._snapshot = None
+        self._pins = []
+        self._pinlock = threading.Lock()
         
     def get_name(self):
         return self._name
@@ -197,20 +321,192 @@ class PERCONNECT:
         self._tabledef = tbldef
     tabledef = property(get_def, set_def)
     
+    def get_opts(self):
+        return self._opts
+    opts = property(get_opts)
+    
+    def get_segments(self):
+        if self._segments is None:
+            # Filled before it is set, so another thread never sees it part way.
+            segments = {}
+            cols = self._tabledef.table
+            if self._opts.get('partition'):
+                for d in listdir(self._path):
+                    try:
+                        start = int(d)
+                    except ValueError:
+                        continue
+                    segments[start] = Segment(join(self._path, d), cols, self._opts)
+            else:
+                segments[None] = Segment(self._path, cols, self._opts)
+            self._segments = segments
+        return self._segments
+    segments = property(get_segments)
+    
+    def get_rollups(self):
+        if self._rollups is None:
+            rollups = {}
+            for col, grans in self._opts.get('rollups', {}).items():
+                for g in grans:
+                    width = GRANULARITY[g]
+                    path = join(self._path, '%s.%d.rollup' % (col, width))
+                    rollups[(col, width)] = Rollup(path, width)
+            self._rollups = rollups
+        return self._rollups
+    rollups = property(get_rollups)
+    
+    def get_stats(self):
+        if self._stats is None:
+            self._stats = Statistics(self._path, self._tabledef.table, self._lock)
+        return self._stats
+    stats = property(get_stats)
+    
+    def get_wal(self):
+        if self._wal is None:
+            ckpt = ReadCheckpoint(self._path)
+            lsn = ckpt['lsn'] if ckpt else 0
+            if self.feed:
+                # The feed may have kept changes a log not synced lost: carry
+                # on past them, so the lsns of the feed stay increasing.
+                lsn = max(lsn, self.feed.lsn)
+            self._wal = Wal(join(self._path, 'wal.log'), lsn)
+        return self._wal
+    wal = property(get_wal)
+    
+    def get_feed(self):
+        if self._feed is None and self._opts.get('feed'):
+            self._feed = feeds.get(dirname(self._path), self._name)
+        return self._feed
+    feed = property(get_feed)
+    
+    def get_path(self):
+        return self._path
+    path = property(get_path)
+    
+    def get_applied(self):
+        return self._applied
+    def set_applied(self, lsn):
+        self._applied = lsn
+    applied = property(get_applied, set_applied)
+    
+    def get_lock(self):
+        return self._lock
+    lock = property(get_lock)
+    
+    def get_generation(self):
+        return self._generation
+    def set_generation(self, generation):
+        self._generation = generation
+    generation = property(get_generation, set_generation)
+    
+    def get_epoch(self):
+        return self._epoch
+    epoch = property(get_epoch)
+    
+    def removed(self):
+        """
+        Note that rows were taken away from the table.
+        """
+        self._epoch += 1
+        self._generation += 2
+    
+    def commit(self):
+        """
+        Note that a change to the table is complete: the snapshot readers pin
+        from now on is the end of the records and the number of records
+        deleted of every segment as they are now.
+        """
+        self._snapshot = {k: (s.records.size, s.tombstones.count) for k, s in self.segments.items()}
+    
+    def pin(self):
+        """
+        Pin the table as of the last change completed, so a reader sees it
+        whatever is changed while it reads.
+        
+        Return:
+            dict of bucket start to (end of the records, records deleted);
+            a segment made since has no entry and shows nothing
+        """
+        if self._snapshot is None:
+            with self._lock:
+                self.commit()
+        with self._pinlock:
+            snapshot = self._snapshot
+            self._pins.append(snapshot)
+        return snapshot
+    
+    def unpin(self, snapshot:dict):
+        with self._pinlock:
+            self._pins.remove(snapshot)
+    
+    def horizon(self, start:int|None):
+        """
+        Return the number of deletes of segment 'start' whose records no
+        pinned reader may still see.
+        """
+        count = self.segments[start].tombstones.count
+        with self._pinlock:
+            return min([count] + [p[start][1] for p in self._pins if start in p])
+    
+    def segment(self, start:int|None):
+        segs = self.segments
+        if start not in segs:
+            path = join(self._path, str(start))
+            MakeSegment(path, self._tabledef.table, self._opts, start, self._tabledef.ordered)
+            segs[start] = Segment(path, self._tabledef.table, self._opts)
+        return segs[start]
+    
+    def drop(self, start:int):
+        self.removed()
+        self.stats.drop(start)
+        seg = self.segments.pop(start)
+        seg.close()
+        shutil.rmtree(seg.path)
+            
+    def close(self):
+        for seg in (self._segments or {}).values():
+            seg.close()
+        self._segments = None
+        for r in (self._rollups or {}).values():
+            r.close()
+        self._rollups = None
+        if self._wal:
+            self._wal.close()
+            self._wal = None
+    
     
 class Table:
     """
     Create/Delete/Open a table in the database
     
     Methods:
-           Table(DB, opts) - Setup a database
-    create(name, TABLEDEF) - create a new table in the database
+   Table(DB, opts, queues) - Setup a database, 'queues' is what pgm.Startup returned
+                             (None runs the steps in this process)
+create(name, TABLEDEF, opts) - create a new table in the database
              connect(name) - Connect a known table in the database
+          connection(name) - Connect a table and return its PERCONNECT
               delete(name) - Delete a table from the database
               execute(pgm) - Execute, in parallel, the 'pgm' against the database
+        execute_async(pgm) - execute from a coroutine
+        plan(ppgm, common) - how the steps of a program would be run, see planner.py
+         stream(pgm, size) - execute, yielding the result 'size' rows at a time
+   insert_many(name, rows) - Insert a batch of rows into a table
+   delete_many(ppgm, common) - Delete the rows a program selects
+update_many(ppgm, common, changes) - Set columns of the rows a program selects
+      expire(name, before) - Drop the time partitions of a table older than 'before'
+          checkpoint(name) - Make a table durable and empty its write ahead log
+       compact(name, ratio) - Rebuild the indices of a table holding many tombstones
+  codecs(name, records, specs) - Compare the codecs on records of a table
+ subscribe(ppgm, common, deliver) - Hand the inserted rows 'pgm' selects to 'deliver'
+        unsubscribe(subid) - End a subscription
+    
+    The results of programs are cached, see cache.py; the 'cachesize' option
+    is the most bytes of results kept (CACHESIZE by default, 0 for none).
     
     Attributes:
                          opts - get per database options
+                      results - the ResultCache of this Table
+                subscriptions - the Subscriptions of this Table
                          cols - get data column definition
                          name - get name of the table
                            db - get DB for this table
@@ -219,26 +515,63 @@ class Table:
     
     """
         
-    def __init__(self, db:DB, dbopts:dict|None = None):
+    def __init__(self, db:DB, dbopts:dict|None = None, queues:list|None = None):
         self._db = db
-        self._dbopts = db.opts | dbopts
+        self._dbopts = db.opts | (dbopts if dbopts else {})
         self._connectDict = {}
+        self._connectlock = threading.RLock()
+        self._queues = queues
+        self._indexcache = {}
+        self._synced = {}
+        self._timers = {}
+        self._results = ResultCache(self._dbopts.get('cachesize', CACHESIZE))
+        self._subscriptions = Subscriptions()
         
     def get_opts(self):
         return self._dbopts
     opts = property(get_opts)
     
+    def get_results(self):
+        return self._results
+    results = property(get_results)
+    
+    def get_subscriptions(self):
+        return self._subscriptions
+    subscriptions = property(get_subscriptions)
+    
     def get_db(self):
         return self._db
     db = property(get_db)
     
-    def create(self, name:str, table:TABLEDEF):
+    def create(self, name:str, table:TABLEDEF, tblopts:dict|None = None):
         """
         Create a new table in the database.
         
         Input:
           name - name of table to create
          table - definition of table
+       tblopts - per table options, added to the database options. To
+                 partition the table by time:
+                   partition - 'hour' or 'day'
+                     timecol - int column holding the time, in seconds
+                   retention - optional, seconds of data to keep
+                 To keep per minute/hour/day aggregates of numeric columns
+                 up to date as rows are inserted (needs 'timecol'):
+                     rollups - dict of column to list of 'minute', 'hour', 'day'
+                 Inserts are logged before they are applied, see wal.py:
+                     walsync - seconds a change may stay in the log unsynced,
+                               after which a timer syncs it, so a crash
+                               loses at most that many seconds of changes;
+                               0 (the default) syncs every batch
+                     walsize - bytes of log that trigger a checkpoint
+                 Records, and the table's info file, are compressed with:
+                       codec - a codec.py spec such as 'zlib:6', 'lzma' or
+                               'zstd:3', by default the database's or 'none'
+                 To keep a change feed of the table for replicas, see feed.py:
+                        feed - True
+                     feedlag - bytes the slowest reader of the feed may fall
+                               behind before writes wait for it
+                    feedwait - seconds a write waits, before it fails
                  
         Return:
         None
@@ -249,22 +582,39 @@ class Table:
         """
         
         # Create the per-connect structure
-        tblcnt = PERCONNECT(name, table)
+        path = join(self.db.path, name)
+        opts = self._dbopts | (tblopts if tblopts else {})
+        tblcnt = PERCONNECT(name, table, path, opts)
          
         # Make certian the table doesn't already exist
-        path = join(self.db.path, name)
         if exists(path):
             raise exceptions.TableError("Table '%s' already exists!" % (table._name))
+        Parse(opts.get('codec', 'none'))
+        if opts.get('partition') or opts.get('rollups'):
+            if opts.get('partition') and opts['partition'] not in BUCKETS:
+                raise exceptions.TableError("Partition '%s' is invalid." % (opts['partition']))
+            if table.table.get(opts.get('timecol')) != 'int':
+                raise exceptions.TableError("A partitioned or rolled up table needs an int 'timecol' column.")
+            for col, grans in opts.get('rollups', {}).items():
+                if table.table.get(col) not in ('int', 'float'):
+                    raise exceptions.TableError("Rollup column '%s' must be int or float." % (col))
+                for g in grans:
+                    if g not in GRANULARITY:
+                        raise exceptions.TableError("Rollup granularity '%s' is invalid." % (g))
         
         # Make the database table
-        self.make(name, table)
+        self.make(name, table, opts)
+        catalog.invalidate(self.db.path)
+        if tblcnt.feed:
+            tblcnt.feed.append(0, {'create': {'table': table.table, 'ordered': table.ordered, 'opts': opts}})
+            tblcnt.feed.sync()
         
         # Tables exists. add ot tp tje cpmmectopm table
-        self._connectDict = {name:tblcnt}
+        self._connectDict[name] = tblcnt
     
     def _isEmpty(self, name:str):
-        path = join(self.db.path, name, "records.dat")
-        return getsize(path) == 0
+        segs = self.connection(name).segments.values()
+        return all(s.records.empty for s in segs)
     
     def delete(self, name:str, iffull:bool):
         """
@@ -286,13 +636,22 @@ class Table:
             # Yes, delete everything.
             path = join(self.db.path, name)
             if exists(path):
+                # Remove the information from the connection table.
+                if name in self._connectDict:
+                    self._connectDict.pop(name).close()
+                Evict(self._indexcache, path)
+                self._results.invalidate(name)
+                if catalog.info(path)['opts'].get('feed'):
+                    feed = feeds.get(self.db.path, name)
+                    feed.append(feed.lsn, {'drop': True})
+                    feed.sync()
+                    
                 # Remove the all the table information
                 shutil.rmtree(path)
-                
-                # Remove the information from the connection table.
-                del self._connectDict[name]
+                catalog.invalidate(path)
+                catalog.invalidate(self.db.path)
             else:
-                raise exceptions.TableError("'%s' doesn't exist.")
+                raise exceptions.TableError("'%s' doesn't exist." % (name))
     
     def connect(self, name:str):
         """
@@ -308,18 +667,36 @@ class Table:
         TableError - excepti0on thrown if table doesn't exist.
 
         """
-        # Makw certain we don't know about the table.
-        if name not in self._connectDict:
-            # Make certain we have a "real" table already defined
-            path = join(self.db.path, name)
-            if exists(path):
-                # We have a real table!
-                with bz2.open(join(path, "info.json.bz2"), "rb", compresslevel=9) as fp:
-                    info = json.loads(fp.read())
-                    perc = PERCONNECT(name, info)
-                    self._connectDict = {name:perc}
-            else:
-                raise exceptions.TabkeError("'%s' doesn't exist." % (name))
+        # Requests run in threads: a table is connected, and recovered, once,
+        # and no other thread sees it before it is.
+        with self._connectlock:
+            # Makw certain we don't know about the table.
+            if name not in self._connectDict:
+                # Make certain we have a "real" table already defined
+                path = join(self.db.path, name)
+                if exists(path):
+                    # We have a real table!
+                    info = catalog.info(path)
+                    tbl = TABLEDEF(name)
+                    ordered = info.get('ordered', [])
+                    for col, coltype in info['table'].items():
+                        tbl.AddCol(col, coltype, col in ordered)
+                    perc = PERCONNECT(name, tbl, path, info['opts'])
+                    self._connectDict[name] = perc
+                    try:
+                        self._recover(perc)
+                    except BaseException:
+                        self._connectDict.pop(name).close()
+                        raise
+                else:
+                    raise exceptions.TableError("'%s' doesn't exist." % (name))
+            
+    def connection(self, name:str):
+        """
+        Connect table 'name' if need be and return its PERCONNECT.
+        """
+        self.connect(name)
+        return self._connectDict[name]
             
     def execute(self, ppgm:list, common:list):
         """
@@ -332,12 +709,898 @@ class Table:
         
         The common thread will take the results of the various parallel threadss and combine
         them into a result.
+        
+        Each parallel step is (index file, predicate, op), see pgm.py. The index
+        files are named as if the table had a single segment; the steps are run
+        against every segment of the table. The common program may also hold
+        
+            ('timerange', low, high) - only segments that may hold times in
+                                       [low, high] are searched
+        
+        A common program starting with
+        
+            ('rollup', table, low, high, width, [(function, column, rollup width), ...])
+            
+        is answered from the rollup files of the table rather than the records,
+        see rollup.py.
+        
+        Everything up to and including the 'fetch' (or 'columns') of the common
+        program is run per segment, the rest once over the records (or column
+        values) of all the segments. A program without either returns the
+        result of the single segment, or a dict of bucket start to result for
+        a partitioned table.
+        
+        The steps are planned first from the statistics of the table: the
+        steps whose result is already known are dropped and the others
+        ordered, run against the index or the column blocks, or answered from
+        the candidates of the most selective step, see planner.py.
+        
+        A program run before against the table as it is now is answered from
+        the result cache, see _lookup.
+        
+        The program reads the table as it was when it started, whatever is
+        inserted, deleted or updated while it runs, see PERCONNECT.pin.
+        """
+        ticket, cached = self._lookup(ppgm, common)
+        if cached is not None:
+            return cached
+        if common and common[0][0] == 'rollup':
+            return self._finish(None, common, None, ticket)
+        plan, common, notes = self._plan(ppgm, common)
+        try:
+            return self._finish(plan, common, self._run(plan), ticket)
+        finally:
+            self._release(plan)
+
+    async def execute_async(self, ppgm:list, common:list, executor=None):
+        """
+        Execute a pgm from a coroutine. The disk work runs in 'executor' (the
+        loop's default if None) and the Indexers are awaited rather than
+        waited on, so the event loop keeps serving while the program runs.
+        See execute.
+        """
+        loop = asyncio.get_running_loop()
+        ticket, cached = await loop.run_in_executor(executor, self._lookup, ppgm, common)
+        if cached is not None:
+            return cached
+        if common and common[0][0] == 'rollup':
+            return await loop.run_in_executor(executor, self._finish, None, common, None, ticket)
+        plan, common, notes = await loop.run_in_executor(executor, self._plan, ppgm, common)
+        try:
+            steps = self._dispatched(plan)
+            if self._queues:
+                inque, outque = self._queues[0:2]
+                found = await CollectAsync(Dispatch(steps, inque), outque)
+            else:
+                found = await loop.run_in_executor(executor, self._search, steps)
+            intermediate = await loop.run_in_executor(executor, self._resolve, plan, found)
+            return await loop.run_in_executor(executor, self._finish, plan, common, intermediate, ticket)
+        finally:
+            self._release(plan)
+
+    def stream(self, ppgm:list, common:list, size:int = BATCHSIZE):
+        """
+        Execute a pgm, yielding the result in lists of at most 'size' rows.
+        
+        A program whose common part only limits and projects the records it
+        fetches is streamed: the segments are read one after the other, 'size'
+        records at a time (see Batches), so the memory used doesn't grow with
+        the result. Any other program is executed and its result handed out
+        in batches.
+        """
+        ops = [ins[0] for ins in common]
+        if 'fetch' not in ops or not set(ops[ops.index('fetch')+1:]) <= {'limit', 'project'}:
+            result = self.execute(ppgm, common)
+            for i in range(0, len(result), size):
+                yield result[i:i+size]
+            return
+        
+        plan, common, notes = self._plan(ppgm, common)
+        conn, segs, steps, deferred, snapshot = plan
+        try:
+            intermediate = self._run(plan)
+            common = [ins for ins in common if ins[0] != 'timerange']
+            limits = [ins[1] for ins in common if ins[0] == 'limit']
+            left = limits[-1] if limits else None
+            nsteps = len(steps) // len(segs) if segs else 0
+            for n, (k, s) in enumerate(segs):
+                part = intermediate[n*nsteps:(n+1)*nsteps]
+                for batch in Batches(common, part, lambda name, s=s: s, size):
+                    if left is not None:
+                        batch = batch[:left]
+                        left -= len(batch)
+                    if batch:
+                        yield batch
+                    if left == 0:
+                        return
+        finally:
+            self._release(plan)
+
+    def subscribe(self, ppgm:list, common:list, deliver):
+        """
+        Subscribe to the rows inserted from now on that a program selects,
+        see subscribe.py. Every batch inserted into the table through this
+        Table is matched, and 'deliver' called with the rows selected.
+        
+        Return:
+        the id of the subscription
+        
+        Exceptions:
+        TableError - table doesn't exist
+        IndexError - the program orders, limits or aggregates
+        """
+        name = self._name(ppgm, common)
+        self.connect(name)
+        return self._subscriptions.add(name, ppgm, common, deliver)
+    
+    def unsubscribe(self, subid:int):
+        self._subscriptions.remove(subid)
+
+    def _name(self, ppgm:list, common:list):
+        """
+        Return the name of the table a program runs against.
+        """
+        if common and common[0][0] == 'rollup':
+            return common[0][1]
+        fetch = [ins[1] for ins in common if ins[0] in ('fetch', 'columns')]
+        return fetch[0] if fetch else basename(dirname(ppgm[0][0]))
+
+    def _lookup(self, ppgm:list, common:list):
+        """
+        Look a program up in the result cache.
+        
+        Return:
+            (ticket, result) - 'result' is a copy of the cached result if the
+                               table hasn't been written since it was
+                               computed, else None and the program has to be
+                               run; 'ticket' goes to _finish, which caches
+                               what it computes (and extends the cached
+                               result, if it can, rather than start over)
+        """
+        if not self._results.size:
+            return None, None
+        conn = self.connection(self._name(ppgm, common))
+        key = (conn.name, repr(ppgm), repr(common))
+        generation, epoch = conn.generation, conn.epoch
+        entry = self._results.get(key)
+        if entry is not None and entry['generation'] == generation:
+            metrics.count('result_hits')
+            return None, copy.copy(entry['result'])
+        if entry is not None and entry['parts'] is not None and entry['epoch'] == epoch:
+            metrics.count('result_extends')
+        else:
+            metrics.count('result_misses')
+            entry = None
+        return (conn, key, generation, epoch, entry), None
+
+    def _store(self, ticket:tuple, result, parts:dict|None = None):
+        """
+        Cache the 'result' of the program of 'ticket', unless the table was
+        written while it ran. Return a copy of it.
+        """
+        conn, key, generation, epoch, entry = ticket
+        if not generation % 2 and conn.generation == generation:
+            self._results.put(key, {'generation': generation, 'epoch': epoch, 'result': result,
+                                    'parts': parts}, Sizeof(result))
+        return copy.copy(result)
+
+    def plan(self, ppgm:list, common:list):
+        """
+        Return how the steps of a program would be run now, a dict per step
+        (see planner.Plan), without running it.
+        """
+        if common and common[0][0] == 'rollup':
+            return []
+        plan, common, notes = self._plan(ppgm, common)
+        self._release(plan)
+        return notes
+
+    def _plan(self, ppgm:list, common:list):
+        """
+        Plan a program against the segments that may hold its time range,
+        see planner.py, pinning the table as it is (see PERCONNECT.pin)
+        until _release is called with the plan.
+        
+        Return:
+            (plan, common, notes) - 'plan' is (connection, segments searched,
+                                    steps, deferred, snapshot), the steps
+                                    being those of the program planned for
+                                    every segment; 'common' is the common
+                                    program planned and 'notes' what became
+                                    of each step
+        """
+        low = high = None
+        for ins in common:
+            if ins[0] == 'timerange':
+                low, high = ins[1:3]
+        conn = self.connection(self._name(ppgm, common))
+        snapshot = conn.pin()
+        
+        def removed(k, s):
+            # Rows were deleted since the snapshot, which still sees them. The
+            # segment metadata and statistics are read before this is asked,
+            # so a delete they reflect is always noticed.
+            return k in snapshot and s.tombstones.count > snapshot[k][1]
+        segs = sorted(conn.segments.items(), key=lambda i: i[0] or 0)
+        segs = [(k, s) for k, s in segs
+                if low is None and high is None or s.overlaps(low, high) or removed(k, s)]
+        
+        with metrics.stage('plan', {'steps': len(ppgm)}) as detail:
+            segstats = [conn.stats.get(k, s) for k, s in segs]
+            for (k, s), stats in zip(segs, segstats):
+                if removed(k, s):
+                    stats['removed'] = True
+            ppgm, common, deferred, notes = Plan(ppgm, common, segs, segstats, conn.tabledef.table)
+            methods = [n['method'] for n in notes]
+            for method in ('skipped', 'scan', 'filter'):
+                detail[method] = methods.count(method)
+        metrics.count('steps_pruned', methods.count('skipped'))
+        
+        # Every segment's steps are handed out together.
+        steps = [(join(s.path, basename(path)), pred, op) for k, s in segs for path, pred, op in ppgm]
+        return (conn, segs, steps, deferred, snapshot), common, notes
+
+    def _release(self, plan):
+        conn, segs, steps, deferred, snapshot = plan
+        conn.unpin(snapshot)
+
+    def _dispatched(self, plan):
+        """
+        Return the steps of 'plan' that are run against the indices, those
+        not answered from the candidates of another step.
+        """
+        conn, segs, steps, deferred, snapshot = plan
+        if not deferred:
+            return steps
+        nsteps = len(steps) // len(segs)
+        return [step for i, step in enumerate(steps) if i % nsteps not in deferred]
+
+    def _run(self, plan):
+        """
+        Run the steps of 'plan', in the Indexers if there are any, and return
+        the sorted offsets each found.
+        """
+        steps = self._dispatched(plan)
+        if self._queues:
+            inque, outque = self._queues[0:2]
+            found = Collect(Dispatch(steps, inque), outque)
+        else:
+            found = self._search(steps)
+        return self._resolve(plan, found)
+
+    def _resolve(self, plan, found:list):
+        """
+        Return the offsets found by every step of 'plan', given those found
+        by the steps dispatched. The offsets the snapshot of the plan doesn't
+        see, records appended or deleted since, are dropped first. A
+        deferred step is answered by checking the records of the candidates
+        its driving step found, unless there are more of them than the
+        planner expected, when it is run after all.
+        """
+        conn, segs, steps, deferred, snapshot = plan
+        nsteps = len(steps) // len(segs) if segs else 0
+        found = iter(found)
+        intermediate = []
+        for k, s in segs:
+            end, count = snapshot.get(k, (0, 0))
+            for j in range(nsteps):
+                intermediate.append(None if j in deferred else
+                                    s.tombstones.visible(next(found), end, count))
+        if not deferred:
+            return intermediate
+        with metrics.stage('filter', {'steps': len(deferred) * len(segs)}):
+            for n, (k, s) in enumerate(segs):
+                for j, (driver, limits) in deferred.items():
+                    path, pred, op = steps[n*nsteps + j]
+                    candidates = intermediate[n*nsteps + driver]
+                    if len(candidates) <= limits[n]:
+                        col = splitext(basename(path))[0]
+                        intermediate[n*nsteps + j] = s.filter(col, candidates, Test(*pred))
+                        metrics.count('steps_filtered')
+                    else:
+                        result, stats = Step(self._indexcache, path, pred)
+                        Record(stats, len(result))
+                        end, count = snapshot.get(k, (0, 0))
+                        intermediate[n*nsteps + j] = s.tombstones.visible(result, end, count)
+        return intermediate
+
+    def _search(self, steps:list):
         """
+        Run the steps here rather than in the Indexers.
+        """
+        results = []
+        for path, pred, op in steps:
+            result, stats = Step(self._indexcache, path, pred)
+            Record(stats, len(result))
+            results.append(result)
+        return results
+
+    def _finish(self, plan, common:list, intermediate:list, ticket:tuple|None = None):
+        """
+        Run the common program over the results of the steps of 'plan',
+        caching the result if there is a 'ticket' from _lookup.
+        """
+        with metrics.stage('complete', {'segments': len(plan[1]) if plan else 0}):
+            if ticket is None:
+                return self._complete(plan, common, intermediate)
+            if plan is not None and _appendable(common):
+                return self._extend(plan, common, intermediate, ticket)
+            return self._store(ticket, self._complete(plan, common, intermediate))
+
+    def _extend(self, plan, common:list, intermediate:list, ticket:tuple):
+        """
+        Complete a program that fetches the records of each segment in offset
+        order, see _appendable, keeping them per segment. The records of
+        each segment a cached entry already holds are taken from it and only
+        those appended to the segment since are fetched: every offset at or
+        past the end of the segment pinned when the entry was made is new.
+        """
+        conn, segs, steps, deferred, snapshot = plan
+        entry = ticket[4]
+        old = entry['parts'] if entry else {}
+        common = [ins for ins in common if ins[0] != 'timerange']
+        nsteps = len(steps) // len(segs) if segs else 0
+        parts = {}
+        result = []
+        for n, (k, s) in enumerate(segs):
+            end = snapshot.get(k, (0, 0))[0]
+            part = intermediate[n*nsteps:(n+1)*nsteps]
+            mark, records = old.get(k, (0, []))
+            if mark:
+                part = [a[bisect_left(a, mark):] for a in part]
+            if mark < end:
+                records = records + Complete(common, part, lambda name, s=s: s)
+            parts[k] = (end, records)
+            result.extend(records)
+        return self._store(ticket, result, parts)
+
+    def _complete(self, plan, common:list, intermediate:list):
+        if plan is None:
+            rows = self._rollup(*common[0][1:])
+            return( Complete([('push', 0)] + common[1:], [rows]))
+        
+        conn, segs, steps, deferred, snapshot = plan
+        common = [ins for ins in common if ins[0] != 'timerange']
+        nsteps = len(steps) // len(segs) if segs else 0
+        parts = [(k, s, intermediate[n*nsteps:(n+1)*nsteps]) for n, (k, s) in enumerate(segs)]
+        ops = [ins[0] in ('fetch', 'columns') for ins in common]
+        
+        if True not in ops:
+            result = {k: Complete(common, part) for k, s, part in parts}
+            if conn.opts.get('partition'):
+                return result
+            return result.get(None, array('Q'))
         
-        return( Complete(common, Dispatch(ppgm)))
+        n = ops.index(True)
+        pre, post = common[:n+1], common[n+1:]
+        if common[n][0] == 'columns':
+            values = {col: [] for col in common[n][2]}
+            for k, s, part in parts:
+                for col, v in Complete(pre, part, lambda name, s=s: s).items():
+                    values[col].extend(v)
+            return( Complete([('push', 0)] + post, [values]))
+        limits = [ins for ins in pre if ins[0] == 'limit']
+        records = []
+        for k, s, part in parts:
+            records.extend(Complete(pre, part, lambda name, s=s: s))
+            if limits and len(records) >= limits[-1][1]:
+                break
+        return( Complete([('push', 0)] + limits + post, [records]))
 
+    def _rollup(self, name:str, low, high, width, aggs:list):
+        """
+        Compute aggregates over [low, high) from the rollups of a table.
+        """
+        conn = self.connection(name)
+        stats = {}
+        for func, col, rwidth in aggs:
+            if col not in stats:
+                stats[col] = conn.rollups[(col, rwidth)].query(low, high, width)
+        return Results(stats, [(f, c) for f, c, w in aggs], conn.opts['timecol'] if width else None)
+
+    def insert_many(self, name:str, rows:list):
+        """
+        Insert a batch of rows into a table.
+        
+        The batch is checked against the table definition once and made
+        durable with one fsync of the write ahead log; then all of the
+        records are appended to the record store with a single write and
+        each column index is updated in one pass. The table files themselves
+        are synced at the next checkpoint.
+        
+        Input:
+          name - name of the table to insert into
+          rows - list of rows, each a dict of column:value or a list of
+                 values in column definition order
+                 
+        Return:
+        list of the record offsets of the rows, in the order given; in a
+        partitioned table each offset is within the segment of its row
+        
+        Exceptions:
+        TableError - table doesn't exist
+         NameError - a row is missing a column or has an unknown one
+         TypeError - a value doesn't match its column type
+        """
+        conn = self.connection(name)
+        rows = _checkrows(conn.tabledef.table, rows)
+        if not rows:
+            return []
+        self._throttle(conn)
+        
+        with conn.lock:
+            # Make room in the indices first, so applying the batch can't run
+            # out of space half way. A rebuilt index invalidates the checkpoint.
+            if self._reserve(conn, rows):
+                self._checkpoint(conn)
+            
+            # Log the batch before touching the table. Unless the table asks for
+            # the log to be synced less often, this is the batch's only fsync.
+            lsn = self._log(conn, {'rows': rows})
+            offsets = self._apply(conn, rows, lsn)
+            if conn.feed:
+                conn.feed.append(lsn, {'insert': rows})
+            conn.commit()
+            self._retain(conn, rows)
+            if conn.wal.size >= conn.opts.get('walsize', WALSIZE):
+                self._checkpoint(conn)
+        
+        # The batch is durable: push it to the subscribers.
+        self._subscriptions.publish(name, rows)
+        return offsets
     
-    def make(self, name):
+    def delete_many(self, ppgm:list, common:list):
+        """
+        Delete the rows of a table a program selects.
+        
+        The rows are found as execute would, and their record offsets logged
+        and added to the tombstones of their segments (see tombstones.py);
+        nothing already written is changed. Queries running meanwhile read
+        the table as it was when they started, see PERCONNECT.pin. The index
+        pointers to the rows deleted are removed later by compact.
+        
+        Input:
+          ppgm, common - a program whose common part only combines the
+                         results of its steps, see _matching
+        
+        Return:
+        number of rows deleted
+        
+        Exceptions:
+        TableError - table doesn't exist
+        IndexError - the program does more than select rows
+        """
+        conn = self.connection(self._name(ppgm, common))
+        self._throttle(conn)
+        with conn.lock:
+            found = self._matching(conn, ppgm, common)
+            if not found:
+                return 0
+            lsn = self._log(conn, {'delete': found})
+            gone = self._remove(conn, found, lsn)
+            if conn.feed:
+                conn.feed.append(lsn, {'delete': gone})
+            conn.commit()
+            if conn.wal.size >= conn.opts.get('walsize', WALSIZE):
+                self._checkpoint(conn)
+        return sum(len(offsets) for start, offsets in found)
+    
+    def update_many(self, ppgm:list, common:list, changes:dict):
+        """
+        Set columns of the rows of a table a program selects.
+        
+        Each row is deleted, as by delete_many, and its new version appended
+        as a new record, both in one log entry and seen by queries together.
+        A new version may move to another time partition. The new versions
+        aren't pushed to the subscribers, which only see rows inserted.
+        
+        Input:
+          ppgm, common - a program selecting rows, see delete_many
+               changes - dict of column name to its new value
+        
+        Return:
+        number of rows updated
+        
+        Exceptions:
+        TableError - table doesn't exist
+        IndexError - the program does more than select rows
+         NameError - a column of 'changes' doesn't exist
+         TypeError - a value doesn't match its column type
+        """
+        conn = self.connection(self._name(ppgm, common))
+        cols = conn.tabledef.table
+        for c, v in changes.items():
+            if c not in cols:
+                raise exceptions.NameError("Column '%s' doesn't exist." % (c))
+            if type(v) not in _PYTYPES[cols[c]]:
+                raise exceptions.TypeError("Value '%s' is invalid for '%s' column '%s'." % (v, cols[c], c))
+        self._throttle(conn)
+        with conn.lock:
+            found = self._matching(conn, ppgm, common)
+            if not found:
+                return 0
+            rows = []
+            for start, offsets in found:
+                rows.extend(dict(r, **changes) for r in conn.segments[start].records.read_many(offsets))
+            if self._reserve(conn, rows):
+                self._checkpoint(conn)
+            lsn = self._log(conn, {'delete': found, 'rows': rows})
+            gone = self._remove(conn, found, lsn)
+            self._apply(conn, rows, lsn)
+            if conn.feed:
+                conn.feed.append(lsn, {'delete': gone, 'insert': rows})
+            conn.commit()
+            self._retain(conn, rows)
+            if conn.wal.size >= conn.opts.get('walsize', WALSIZE):
+                self._checkpoint(conn)
+        return len(rows)
+    
+    def _matching(self, conn:PERCONNECT, ppgm:list, common:list):
+        """
+        Run a program selecting rows of a table, its common part no more than
+        a time range and the set instructions combining its steps, against
+        the table as it is. Called with the table lock held.
+        
+        Return:
+            [(bucket start, [record offsets])] of the segments with rows
+            selected
+        """
+        if any(ins[0] not in ('push', 'and', 'or', 'not', 'timerange') for ins in common):
+            raise exceptions.IndexError("Only rows can be deleted or updated, not fetched, ordered, limited or aggregated.")
+        plan, common, notes = self._plan(ppgm, common)
+        try:
+            intermediate = self._run(plan)
+        finally:
+            self._release(plan)
+        conn, segs, steps, deferred, snapshot = plan
+        common = [ins for ins in common if ins[0] != 'timerange']
+        nsteps = len(steps) // len(segs) if segs else 0
+        found = []
+        for n, (k, s) in enumerate(segs):
+            offsets = Complete(common, intermediate[n*nsteps:(n+1)*nsteps])
+            if len(offsets):
+                found.append((k, list(offsets)))
+        return found
+    
+    def _log(self, conn:PERCONNECT, payload:dict):
+        """
+        Append a change to the write ahead log of a table, syncing it unless
+        the table asks for the log to be synced less often. Returns its lsn.
+        """
+        wal = conn.wal
+        every = conn.opts.get('walsync', 0)
+        lsn = wal.append(payload, sync=not every)
+        if every and time.monotonic() - self._synced.get(conn.name, 0) >= every:
+            wal.sync()
+            self._synced[conn.name] = time.monotonic()
+        elif every and conn.name not in self._timers:
+            # Sync the change within 'every' seconds even if no other change
+            # comes along to do it.
+            timer = self._timers[conn.name] = threading.Timer(every, self._walsync, (conn,))
+            timer.daemon = True
+            timer.start()
+        return lsn
+    
+    def _walsync(self, conn:PERCONNECT):
+        """
+        Sync the write ahead log of a table, if it is still connected.
+        """
+        with conn.lock:
+            self._timers.pop(conn.name, None)
+            if self._connectDict.get(conn.name) is conn:
+                conn.wal.sync()
+                self._synced[conn.name] = time.monotonic()
+    
+    def _throttle(self, conn:PERCONNECT):
+        """
+        Hold a write to a table back while the slowest reader of its change
+        feed is more than 'feedlag' bytes behind, so a replica on a slow link
+        slows the writers down rather than the feed growing without end.
+        """
+        feed = conn.feed
+        if feed is None:
+            return
+        lag = conn.opts.get('feedlag', FEEDLAG)
+        if not feed.wait(lag, conn.opts.get('feedwait', FEEDWAIT)):
+            raise exceptions.TableError("The change feed of '%s' is %d bytes behind." % (conn.name, feed.backlog))
+    
+    def _groups(self, conn:PERCONNECT, rows:list):
+        """
+        Return dict of bucket start (None if the table isn't partitioned) to
+        the indices of the rows in that bucket.
+        """
+        partition = conn.opts.get('partition')
+        if not partition:
+            return {None: range(len(rows))}
+        timecol = conn.opts['timecol']
+        groups = {}
+        for i, r in enumerate(rows):
+            groups.setdefault(Bucket(partition, r[timecol]), []).append(i)
+        return groups
+    
+    def _reserve(self, conn:PERCONNECT, rows:list):
+        """
+        Make room in the segments the rows go to. Returns True if an index
+        was rebuilt.
+        """
+        rebuilt = False
+        for start, which in self._groups(conn, rows).items():
+            rebuilt |= conn.segment(start).reserve([rows[i] for i in which])
+        return rebuilt
+    
+    def _apply(self, conn:PERCONNECT, rows:list, lsn:int, replay:bool = False):
+        """
+        Apply the batch of checked rows logged as 'lsn' to the segments and,
+        unless this is a 'replay' in recovery, the rollups of a table.
+        Nothing is synced.
+        """
+        # Queries that start or end while the generation is odd don't cache.
+        conn.generation += 1
+        try:
+            # Sort the rows into the time partitions they belong to.
+            groups = self._groups(conn, rows)
+            
+            # Append the records then point every index at them.
+            offsets = [0] * len(rows)
+            for start, which in groups.items():
+                seg = conn.segment(start)
+                conn.stats.update(start, [rows[i] for i in which])
+                for i, o in zip(which, seg.append([rows[i] for i in which])):
+                    offsets[i] = o
+                conn.stats.counted(start, seg)
+            
+            conn.applied = lsn
+            if replay:
+                return offsets
+            
+            # Keep the rollups current.
+            if conn.rollups:
+                times = [r[conn.opts['timecol']] for r in rows]
+                for (col, width), r in conn.rollups.items():
+                    r.update(times, [row[col] for row in rows])
+            return offsets
+        finally:
+            conn.generation += 1
+    
+    def _retain(self, conn:PERCONNECT, rows:list):
+        """
+        Drop the partitions of a table with the 'retention' option that the
+        times of 'rows' put out of it, see expire. Only once the change of
+        'rows' is in the feed: expire checkpoints and empties the log, after
+        which recovery can't add the change to the feed.
+        """
+        if rows and conn.opts.get('partition') and conn.opts.get('retention'):
+            timecol = conn.opts['timecol']
+            self.expire(conn.name, max(r[timecol] for r in rows) - conn.opts['retention'])
+    
+    def _remove(self, conn:PERCONNECT, deletes:list, lsn:int, replay:bool = False):
+        """
+        Delete the records logged as 'lsn', [(bucket start, [record offsets])],
+        from the segments, their statistics and, unless this is a 'replay'
+        in recovery, the rollups of the table. Nothing is synced.
+        
+        Return:
+            list of the rows deleted
+        """
+        conn.generation += 1
+        try:
+            # Cached results can't just be extended any more.
+            conn.removed()
+            rows = []
+            for start, offsets in deletes:
+                seg = conn.segments.get(start)
+                if seg is None:
+                    # Expired since.
+                    continue
+                gone = seg.records.read_many(offsets)
+                seg.delete(offsets)
+                conn.stats.remove(start, gone)
+                rows.extend(gone)
+            conn.applied = lsn
+            if not replay:
+                metrics.count('rows_deleted', len(rows))
+                self._rerollup(conn, rows)
+            return rows
+        finally:
+            conn.generation += 1
+    
+    def checkpoint(self, name:str):
+        """
+        Make everything applied to a table durable, record the state of its
+        segments in checkpoint.json and empty its write ahead log.
+        """
+        conn = self.connection(name)
+        with conn.lock:
+            self._checkpoint(conn)
+    
+    def _checkpoint(self, conn:PERCONNECT):
+        """
+        Checkpoint the log entries applied so far. The log is only emptied
+        if they are all of it, which they aren't part way through recovery.
+        """
+        wal = conn.wal
+        wal.sync()
+        if conn.feed:
+            # The log emptied can't bring back changes the feed lost.
+            conn.feed.sync()
+        for seg in conn.segments.values():
+            seg.sync()
+        for r in conn.rollups.values():
+            r.flush()
+        segs = [[k, s.state()] for k, s in conn.segments.items()]
+        conn.stats.save(conn.applied, conn.segments)
+        WriteCheckpoint(conn.path, {'lsn': conn.applied, 'segments': segs})
+        if conn.applied == wal.lsn:
+            wal.truncate()
+    
+    def compact(self, name:str, ratio:float = COMPACTRATIO):
+        """
+        Remove from the indices of a table the pointers to the records
+        deleted that no query may still see (see Segment.reclaim), then
+        rebuild the indices in which at least 'ratio' of the pointers are
+        tombstones, see Index.rebuild, and take a checkpoint since neither
+        can be rolled back.
+        
+        Return:
+        number of indices rebuilt
+        """
+        conn = self.connection(name)
+        with conn.lock:
+            upto = {k: conn.horizon(k) for k in conn.segments}
+            upto = {k: n for k, n in upto.items() if n > conn.segments[k].meta.get('reclaimed', 0)}
+            if upto:
+                # The deletes reclaimed must not be lost in a crash.
+                self._checkpoint(conn)
+                reclaimed = sum(conn.segments[k].reclaim(n) for k, n in upto.items())
+                metrics.count('rows_reclaimed', reclaimed)
+            n = sum(seg.compact(ratio) for seg in conn.segments.values())
+            if n or upto:
+                self._checkpoint(conn)
+        return n
+    
+    def _recover(self, conn:PERCONNECT):
+        """
+        Bring a table being connected back to a consistent state: if there
+        are log entries past the checkpoint, or a segment was written since
+        it, the segments are put back to the checkpoint, the entries
+        (inserts, deletes or both, for an update) are applied again, and the
+        rollup buckets they and the segments written cover are computed
+        again from the columns. The entries the change feed doesn't have yet
+        are appended to it.
+        """
+        ckpt = ReadCheckpoint(conn.path)
+        if ckpt is None:
+            # A table made before it had a log.
+            conn.applied = conn.wal.lsn
+            self._checkpoint(conn)
+            return
+        conn.applied = ckpt['lsn']
+        tail = list(conn.wal.entries(ckpt['lsn']))
+        # A batch whose log entry was lost with the log not synced may still
+        # have reached the segments, so those that differ from the checkpoint
+        # are put back even with nothing to apply again.
+        states = {k: state for k, state in ckpt['segments']}
+        changed = [k for k, seg in conn.segments.items()
+                   if k not in states or json.loads(json.dumps(seg.state())) != states[k]]
+        if not tail and not changed:
+            return
+        
+        conn.removed()
+        conn.stats.load(ckpt['lsn'])
+        for k in list(conn.segments) if tail else changed:
+            if k in states:
+                conn.segments[k].rollback(states[k])
+            else:
+                # Made after the checkpoint.
+                self._drop(conn, k)
+        # The rollups may still hold rows of those segments that are gone.
+        partition = conn.opts.get('partition')
+        spans = [(k, k + BUCKETS[partition]) if k is not None else (-_FOREVER, _FOREVER)
+                 for k in changed]
+        applied = []
+        for lsn, payload in tail:
+            rows = payload.get('rows', [])
+            if rows and self._reserve(conn, rows):
+                # The rollups have to be right for the checkpoint too.
+                self._rerollup(conn, applied, spans)
+                self._checkpoint(conn)
+            change = {}
+            if 'delete' in payload:
+                change['delete'] = self._remove(conn, payload['delete'], lsn, replay=True)
+                applied.extend(change['delete'])
+            if rows:
+                self._apply(conn, rows, lsn, replay=True)
+                change['insert'] = rows
+            applied.extend(rows)
+            if conn.feed and lsn > conn.feed.lsn:
+                conn.feed.append(lsn, change)
+        self._rerollup(conn, applied, spans)
+        self._checkpoint(conn)
+        conn.commit()
+        self._retain(conn, applied)
+    
+    def _rerollup(self, conn:PERCONNECT, rows:list, spans:list = ()):
+        """
+        Compute the rollup buckets holding the times of 'rows', and those
+        overlapping the [low, high) time 'spans', again from the columns of
+        the segments.
+        """
+        if not conn.rollups or not (rows or spans):
+            return
+        timecol = conn.opts['timecol']
+        spans = list(spans)
+        if rows:
+            times = [r[timecol] for r in rows]
+            spans.append((min(times), max(times) + 1))
+        for (col, width), r in conn.rollups.items():
+            # Whole buckets, merged so none is counted twice.
+            merged = []
+            for low, high in sorted((low - low % width, high - 1 - (high - 1) % width + width)
+                                    for low, high in spans):
+                if merged and low <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], high)
+                else:
+                    merged.append([low, high])
+            for low, high in merged:
+                r.reset(low, high)
+                for seg in conn.segments.values():
+                    if seg.overlaps(low, high - 1):
+                        # Only the blocks the zone map allows are read.
+                        between = [low, high, True, False]
+                        offsets = seg.scan(timecol, 'range', between, Test('range', between))
+                        vals = seg.read_columns([timecol, col], offsets)
+                        r.update(vals[timecol], vals[col])
+    
+    def _drop(self, conn:PERCONNECT, start:int):
+        """
+        Remove the segment of bucket 'start' and let go of the index files
+        of it mapped here.
+        """
+        path = conn.segments[start].path
+        conn.drop(start)
+        Evict(self._indexcache, path)
+    
+    def expire(self, name:str, before:int):
+        """
+        Drop the time partitions of a table that only hold times before 'before'.
+        
+        Return:
+        number of partitions dropped
+        """
+        conn = self.connection(name)
+        with conn.lock:
+            old = [k for k, s in conn.segments.items() if k is not None and s.meta['end'] <= before]
+            for k in old:
+                self._drop(conn, k)
+            if old:
+                # A checkpoint can't put back a dropped partition, so take a new one.
+                self._checkpoint(conn)
+        return len(old)
+
+    
+    def codecs(self, name:str, records:int = 1000, specs:list|None = None):
+        """
+        Compress up to 'records' records of table 'name' with each codec of
+        'specs' (every codec installed if None) and report how well and how
+        fast each did, see codec.Benchmark. The records are taken from the
+        start of every segment, as they are before compression.
+        
+        Return:
+            list of {'codec', 'ratio', 'compress_mbs', 'decompress_mbs'}
+        """
+        conn = self.connection(name)
+        segs = list(conn.segments.values())
+        samples = []
+        for seg in segs:
+            want = max(1, records // len(segs))
+            for offset, record in seg.records.scan():
+                samples.append(json.dumps(record, separators=(',', ':')).encode('utf-8'))
+                want -= 1
+                if not want:
+                    break
+        return Benchmark(samples, specs)
+    
+    def make(self, name:str, table:TABLEDEF, opts:dict):
         """
         Make the root directory of this database. This is the where all 
         the table definitions are stored. Every file in the database 
@@ -353,123 +1616,59 @@ class Table:
         # Build the JSON structure we will write out
         j = {'table': table.table}
         j['name'] = name
-        j['opts'] = self._dbopts
-        with bz2.open(join(self._tbldir, "info.json.bz2"), "wb", compresslevel=9) as fp:
-            fp.write(json.dumps(j).encode('utf-8'))
-
-        """
-        This is a file that contains the unique complete records stored in the table.
-        The format is one record following another. Each record looks like thisL
-        
-        <size of record>
-        <record, in JSON format, compressed with bz2>
-        """
-        with bz2.open(join(self._tbldir, "records.dat"), "wb", compresslevel=9) as fp:
-            # There's nothing yet recorded in the file.
-            fp.write(bytes(0))
-    
-        """
-        There is one index file for each index that is defined. Each of the index files are composed 
-        of two tiers. The first tier maps the actual record field to an index (32-bit number). The 
-        second tier of the file takes the numeric index and maps it to one or more record pointers.  
-        The record pointers are 64 bit offsets into a records file, and point to a JSON representation 
-        of the record. This second tier is real a B-Tree with the key being the index value from 
-        the first tier.
-        """        
-        for i in table.table.keys():
-            # Preallocate the index files. We do this to make certain that we can map each index
-            # file into the memory map.
-            with open(join(self._tbldir, i+'.idx'),'wb') as fp:
-                fp.seek(self._dbopts['idxsize']+1,0)
-                fp.write(bytes(0))
-                
-    def delete(self):
-        """
-        Delete the table from the database.
-        """
-        if exists(self._tbldir):
-            # Remove the database of table.
-            shutil.rmtree(self._tbldir)
-
-    
-if __name__ == '__main__':
-    
-    # Place all database tables in the subdirectory test. The
-    # index files must be 10,000 bytes long.
-    user = User()
-    user.home = './test'
-    user.idxsize = 10000
-    
-    # Make test database area..required for testing...
-    if exists('test'):
-        shutil.rmtree('test')
-    mkdir('test')
-
-    # Various tests...
-    tests = {}
-    tests['name error'] = {
-                             'name':'TESTIT',
-                             'table': {
-                                 'col1': 'int',
-                                 'col2': 'str',
-                                 'col3': 'float',
-                                 'illegal-name': 'int'
-                                 }
-                          }
-    tests['type error'] = {
-                             'name':'TESTIT',
-                             'table': {
-                                 'col1': 'int',
-                                 'col2': 'str',
-                                 'col3': 'floating'
-                                 }
-                          }
-    tests['no error'] = {
-                             'name':'TESTIT',
-                             'table': {
-                                 'col1': 'int',
-                                 'col2': 'str',
-                                 'col3': 'float'
-                                 }
-                          }
-    tests['table error'] = {
-                             'name':'TESTIT',
-                             'table': {
-                                 'col1': 'int',
-                                 'col2': 'str',
-                                 'col3': 'int'
-                                 }
-                          }    
-    for i in tests:
-        try:
-            which_err = i
-            createdb(tests[i], user)
-        except exceptions.TableError as e:
-            if which_err == 'table error':
-                print('Duplicate table test ok')
-            else:
-                print(e.args)
-        except exceptions.NameError as e:
-            if which_err == 'name error':
-                print('Column name error test ok')
-            else:
-                print(e.args)
-        except exceptions.TypeError as e:
-            if which_err == 'type error':
-                print('Column type error test ok')
-            else:
-                print(e.args)
-                
-                
-    # Get the recorded information
-    table = listTables('TESTIT', user)
-    if not (table['TESTIT'] ==  tests['no error']['table']):
-        print('Table differences!')
-    else:
-        print('Tables match!')
-
-    # Clean up test directory
-    deletedb("TESTIT", user)
-    rmdir("test")
-    
-    print("All tests complete")
+        j['opts'] = opts
+        j['ordered'] = table.ordered
+        WriteInfo(self._tbldir, j, opts.get('codec'))
+
+        # An unpartitioned table is a single segment, the table directory. The
+        # segments of a partitioned table are made as data arrives for them.
+        if not opts.get('partition'):
+            MakeSegment(self._tbldir, table.table, opts, None, table.ordered)
+        
+        # The first checkpoint, of the empty table.
+        segs = []
+        if not opts.get('partition'):
+            seg = Segment(self._tbldir, table.table, opts)
+            segs.append([None, seg.state()])
+            seg.close()
+        WriteCheckpoint(self._tbldir, {'lsn': 0, 'segments': segs})
+
+
+    
+class Compactor(threading.Thread):
+    """
+    Background thread compacting the indices of the connected tables of a
+    Table every 'interval' seconds, see Table.compact. Writes to a table
+    wait (its lock is held) for the whole of a pass that has work to do:
+    the checkpoints, the reclaim and every index rebuilt. A pass with
+    nothing to reclaim or rebuild takes the lock only to find that out.
+    
+    Methods:
+        Compactor(table, interval, ratio) - make the thread, start() runs it
+                                  stop() - stop the thread and wait for it
+    
+    Attributes:
+        table - the Table whose tables are compacted
+    """
+    def __init__(self, table:Table, interval:float = 60, ratio:float = COMPACTRATIO):
+        super().__init__(name='Compactor', daemon=True)
+        self._table = table
+        self._interval = interval
+        self._ratio = ratio
+        self._done = threading.Event()
+    
+    def get_table(self):
+        return self._table
+    table = property(get_table)
+        
+    def run(self):
+        while not self._done.wait(self._interval):
+            for name in list(self._table._connectDict):
+                try:
+                    self._table.compact(name, self._ratio)
+                except (exceptions.TableError, exceptions.IndexError, OSError) as e:
+                    logging.warning("Compacting '%s' failed: %s", name, e)
+    
+    def stop(self):
+        self._done.set()
+        self.join()
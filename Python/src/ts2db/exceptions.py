@@ -15,3 +15,15 @@ class TypeError(Exception):
     Column type error.
     """
     pass
+
+class IndexError(Exception):
+    """
+    Index file error.
+    """
+    pass
+
+class SQLError(Exception):
+    """
+    SQL statement error.
+    """
+    pass
@@ -0,0 +1,351 @@
+"""
+class Feed  - the change feed of a table.
+class Feeds - the feeds of the process, one Feed per table.
+
+A table made with the 'feed' option keeps, besides its write ahead log,
+a feed of every change made to it, for replicas to follow (see
+replicate.py): the rows inserted, the rows deleted (an update is both, in
+one change) and its creation and deletion. Unlike the log, which is
+emptied at every checkpoint, the feed keeps a change until every reader
+of it has taken it.
+
+The feeds of a database are kept apart from its tables, so the deletion
+of a table can be told and a table made again under the same name
+continues the feed:
+
+    <database>/.feed/<table>/<first seq>.feed
+    <database>/.feed/<table>/cursors.json
+
+A feed file is
+
+    <header>  - 'TS2F', version, 8 bytes
+    <entry>   - repeated: <payload bytes> <payload crc32> <seq>, 16 bytes,
+                then the payload, the change in JSON
+
+Each change has a sequence number (seq) one greater than the change
+before, and holds the lsn of the log entry that made it, 0 for the
+creation of the table. A file is started every FEEDFILE bytes, named by
+the seq of its first change.
+
+A cursor is a named position in the feed, the seq of the last change its
+reader has taken, kept in cursors.json. A reader that stops and starts
+again carries on from its cursor. The files whose changes every cursor
+has passed are removed; a feed without cursors keeps everything, for the
+replicas yet to come.
+
+A change is appended to the feed once it is applied, and the feed synced
+at every checkpoint before the log is emptied; a change that was logged
+but didn't make it to the feed before a crash is appended again by
+recovery, which tells from the lsn of the last change what is missing
+(see Table._recover). Time partitions dropped by retention aren't
+changes: a replica keeps its own retention.
+"""
+from array import array
+from bisect import bisect_right
+from os.path import join, exists
+from os import listdir
+import json
+import os
+import struct
+import threading
+import zlib
+
+import exceptions
+
+_HDR = struct.Struct('<4sHxx')
+_MAGIC = b'TS2F'
+_VERSION = 1
+_ENTRY = struct.Struct('<IIQ')
+
+# Directory of the feeds of a database, and the cursors file of a feed.
+FEEDS = '.feed'
+CURSORS = 'cursors.json'
+
+# Bytes of changes after which a new feed file is started.
+FEEDFILE = 1 << 22
+
+
+def _fsyncdir(path:str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Feed:
+    """
+    The change feed of one table. Shared by everything in the process
+    using the table, see Feeds.
+
+    Methods:
+
+            Feed(path) - open (or create) the feed in directory 'path'
+    append(lsn, change) - add the change made by log entry 'lsn', returns its seq
+    read(after, nbytes) - the [(seq, change)] past seq 'after', about 'nbytes' of them
+        cursor(name) - the seq cursor 'name' is at, 0 for a new one
+    commit(name, seq) - durably move cursor 'name' to 'seq' and remove the
+                        files every cursor has passed
+    wait(limit, timeout) - wait until the backlog is at most 'limit' bytes
+              sync() - make every change appended durable
+             close() - close the feed
+
+    Attributes:
+
+        path - directory of the feed
+         seq - seq of the last change
+         lsn - lsn of the last change
+     backlog - bytes of changes past the slowest cursor, 0 if there is none
+    """
+
+    def __init__(self, path:str):
+        self._path = path
+        if not exists(path):
+            os.makedirs(path)
+        self._cond = threading.Condition()
+        self._cursors = {}
+        if exists(join(path, CURSORS)):
+            with open(join(path, CURSORS), 'rb') as fp:
+                self._cursors = json.loads(fp.read())
+        self._files = sorted(int(f[:-len('.feed')]) for f in listdir(path) if f.endswith('.feed'))
+        self._fd = None
+        self._seq = self._lsn = 0
+        self._pending = False
+        # The seq and the bytes written up to and including it, of every
+        # change past the slowest cursor.
+        self._seqs = array('Q')
+        self._ends = array('Q')
+        self._total = 0
+        low = min(self._cursors.values(), default=0)
+        for i, first in enumerate(self._files):
+            last = i == len(self._files) - 1
+            if not last and self._files[i + 1] - 1 <= low:
+                continue
+            for seq, lsn, nbytes in self._scan(first, last):
+                self._seq, self._lsn = seq, lsn
+                if seq > low:
+                    self._total += nbytes
+                    self._seqs.append(seq)
+                    self._ends.append(self._total)
+        if self._files:
+            self._fd = os.open(self._file(self._files[-1]), os.O_RDWR)
+            self._seq = max(self._seq, self._files[-1] - 1)
+
+    def _file(self, first:int):
+        return join(self._path, '%020d.feed' % (first))
+
+    def _scan(self, first:int, last:bool):
+        """
+        Iterate over (seq, lsn, bytes) of the changes of the file starting at
+        'first'. A torn change at the end of the 'last' file is dropped, and
+        a torn header of it written again.
+        """
+        with open(self._file(first), 'rb') as fp:
+            data = fp.read()
+        if last and len(data) < _HDR.size:
+            # A file started just before a crash whose header never reached
+            # the disk holds no changes.
+            with open(self._file(first), 'wb') as fp:
+                fp.write(_HDR.pack(_MAGIC, _VERSION))
+                fp.flush()
+                os.fsync(fp.fileno())
+            return
+        if data[:4] != _MAGIC:
+            raise exceptions.TableError("'%s' is not a feed file." % (self._file(first)))
+        pos = _HDR.size
+        while pos + _ENTRY.size <= len(data):
+            n, crc, seq = _ENTRY.unpack_from(data, pos)
+            payload = data[pos + _ENTRY.size:pos + _ENTRY.size + n]
+            if len(payload) < n or zlib.crc32(payload) != crc:
+                break
+            pos += _ENTRY.size + n
+            yield seq, json.loads(payload)['lsn'], _ENTRY.size + n
+        if last and pos < len(data):
+            os.truncate(self._file(first), pos)
+
+    def get_path(self):
+        return self._path
+    path = property(get_path)
+
+    def get_seq(self):
+        return self._seq
+    seq = property(get_seq)
+
+    def get_lsn(self):
+        return self._lsn
+    lsn = property(get_lsn)
+
+    def get_backlog(self):
+        with self._cond:
+            if not self._cursors:
+                return 0
+            return self._total - self._passed(min(self._cursors.values()))
+    backlog = property(get_backlog)
+
+    def _passed(self, seq:int):
+        """
+        Return the bytes written up to and including change 'seq'.
+        """
+        i = bisect_right(self._seqs, seq)
+        return self._ends[i - 1] if i else 0
+
+    def append(self, lsn:int, change:dict):
+        """
+        Append 'change', made by log entry 'lsn', to the feed. Nothing is
+        synced.
+
+        Return:
+            seq of the change
+        """
+        data = json.dumps(dict(change, lsn=lsn), separators=(',', ':')).encode('utf-8')
+        with self._cond:
+            seq = self._seq + 1
+            if self._fd is None or os.fstat(self._fd).st_size >= FEEDFILE:
+                self._roll(seq)
+            os.pwrite(self._fd, _ENTRY.pack(len(data), zlib.crc32(data), seq) + data,
+                      os.fstat(self._fd).st_size)
+            self._seq, self._lsn = seq, lsn
+            self._pending = True
+            self._total += _ENTRY.size + len(data)
+            self._seqs.append(seq)
+            self._ends.append(self._total)
+            self._cond.notify_all()
+        return seq
+
+    def _roll(self, first:int):
+        """
+        Start a new feed file, its first change being 'first'.
+        """
+        if self._fd is not None:
+            os.fsync(self._fd)
+            os.close(self._fd)
+        path = self._file(first)
+        with open(path, 'wb') as fp:
+            fp.write(_HDR.pack(_MAGIC, _VERSION))
+            fp.flush()
+            os.fsync(fp.fileno())
+        _fsyncdir(self._path)
+        self._fd = os.open(path, os.O_RDWR)
+        self._files.append(first)
+        self._pending = False
+
+    def read(self, after:int, nbytes:int):
+        """
+        Return [(seq, change)] of the changes past seq 'after', stopping
+        once about 'nbytes' were read. A cursor at 'after' that the files
+        removed have passed starts at the first change kept.
+        """
+        with self._cond:
+            files = list(self._files)
+            end = self._seq
+        i = max(0, bisect_right(files, after) - 1)
+        changes = []
+        size = 0
+        for first in files[i:]:
+            with open(self._file(first), 'rb') as fp:
+                data = fp.read()
+            pos = _HDR.size
+            while pos + _ENTRY.size <= len(data):
+                n, crc, seq = _ENTRY.unpack_from(data, pos)
+                payload = data[pos + _ENTRY.size:pos + _ENTRY.size + n]
+                if seq > end or len(payload) < n or zlib.crc32(payload) != crc:
+                    # Being appended.
+                    return changes
+                pos += _ENTRY.size + n
+                if seq > after:
+                    changes.append((seq, json.loads(payload)))
+                    size += _ENTRY.size + n
+                    if size >= nbytes:
+                        return changes
+        return changes
+
+    def cursor(self, name:str):
+        with self._cond:
+            return self._cursors.get(name, 0)
+
+    def commit(self, name:str, seq:int):
+        """
+        Durably move cursor 'name' to change 'seq', then remove the files
+        whose changes every cursor has passed.
+        """
+        with self._cond:
+            self._cursors[name] = seq
+            data = json.dumps(self._cursors).encode('utf-8')
+            tmp = join(self._path, CURSORS + '.tmp')
+            with open(tmp, 'wb') as fp:
+                fp.write(data)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp, join(self._path, CURSORS))
+            low = min(self._cursors.values())
+            # The last file is being appended to, and stays.
+            while len(self._files) > 1 and self._files[1] - 1 <= low:
+                os.remove(self._file(self._files.pop(0)))
+            i = bisect_right(self._seqs, low)
+            if i:
+                passed = self._ends[i - 1]
+                del self._seqs[:i]
+                self._ends = array('Q', [e - passed for e in self._ends[i:]])
+                self._total -= passed
+            self._cond.notify_all()
+
+    def wait(self, limit:int, timeout:float):
+        """
+        Wait until the backlog is at most 'limit' bytes, at most 'timeout'
+        seconds. Returns False if it isn't by then.
+        """
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._cursors or
+                        self._total - self._passed(min(self._cursors.values())) <= limit,
+                timeout)
+
+    def sync(self):
+        with self._cond:
+            if self._pending:
+                os.fsync(self._fd)
+                self._pending = False
+
+    def close(self):
+        with self._cond:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+
+class Feeds:
+    """
+    The change feeds opened by the process, so a table and the replicas
+    reading its feed share one Feed.
+
+    Methods:
+
+           get(dbpath, name) - the Feed of table 'name' of database 'dbpath'
+             names(dbpath) - the tables of database 'dbpath' with a feed
+    """
+
+    def __init__(self):
+        self._feeds = {}
+        self._lock = threading.Lock()
+
+    def get(self, dbpath:str, name:str):
+        path = join(dbpath, FEEDS, name)
+        with self._lock:
+            feed = self._feeds.get(path)
+            if feed is not None and not exists(path):
+                # The database was deleted.
+                feed.close()
+                feed = None
+            if feed is None:
+                feed = self._feeds[path] = Feed(path)
+            return feed
+
+    def names(self, dbpath:str):
+        path = join(dbpath, FEEDS)
+        if not exists(path):
+            return []
+        return sorted(listdir(path))
+
+
+# The feeds of the process.
+feeds = Feeds()
@@ -0,0 +1,747 @@
+"""
+class Index - the two tier index file associated with a single column.
+
+An index file is mapped into memory in its entirety and every operation
+(lookup, insert, delete) is done in place against the mapping. Nothing is
+ever read or parsed as a whole, so a point lookup touches only the pages
+holding the hash slot, the dictionary entry and the posting blocks of the
+value being looked for.
+
+The layout of the file is:
+
+    header  - fixed 64 bytes, see _HDR below.
+    slots   - the hash table of the first tier. 'nslots' 32-bit entries,
+              each holding (id + 1) of the value hashed to it, 0 if empty.
+    entries - the dictionary of the first tier, one 32 byte entry per id:
+              <value offset> <value length> <live count> <head> <tail>
+              where head and tail are the first and last posting blocks.
+    heap    - the values themselves and the posting blocks of the second
+              tier, allocated from the end of the entries toward the end
+              of the file.
+
+A posting block is:
+
+    <next block> <slots used> <slots available> <64-bit record offsets>
+
+Deleted record offsets are overwritten with a tombstone and skipped by
+readers until the index is compacted.
+
+A file doesn't have to be preallocated for all it will hold. Before a batch
+is inserted, reserve() makes room for it: a heap that would run out is
+grown in place by doubling the file, and a first tier that would run out of
+ids has the index rebuilt into a new file twice the size. rebuild() is also
+the compaction: it drops the tombstones, gives each value a single sorted
+posting block, laid out in id order, and sizes the new file to what it
+holds. The ids of the values never change, the column files depend on them.
+The header counts the rebuilds, so rolling back to a checkpoint taken before
+one knows the heap top it holds is of another layout (see rollback).
+
+Readers don't wait for either. A reader notices a grown file from the heap
+top in the header and maps it again; a rebuilt file replaces the old one
+with os.replace, so a reader keeps the old mapping until it maps the path
+again (see pgm.GetIndex).
+"""
+from array import array
+from os.path import getsize
+import mmap
+import os
+import struct
+import zlib
+
+import exceptions
+
+# Header: magic, version, column type, ids in use, hash slots, heap top,
+# live record pointers, tombstones, generation, rebuilds.
+_HDR = struct.Struct('<4sHHIIQQQQQ')
+_HDRSIZE = 64
+_MAGIC = b'TS2I'
+_VERSION = 1
+
+_ENTRY = struct.Struct('<QIIQQ')
+_SLOT = struct.Struct('<I')
+_BLOCK = struct.Struct('<QII')
+
+# The first posting block of a value holds this many pointers, every
+# following block twice as many as the one before up to _MAXBLOCK.
+_FIRSTBLOCK = 4
+_MAXBLOCK = 4096
+
+TOMBSTONE = 0xFFFFFFFFFFFFFFFF
+
+COLTYPES = {'str': 0, 'int': 1, 'float': 2}
+_TYPENAMES = {v: k for k, v in COLTYPES.items()}
+
+# Array type codes of the dictionaries of int and float columns.
+_DOMAINCODES = {'int': 'q', 'float': 'd'}
+
+
+def _encode(coltype:str, value):
+    """
+    Turn a column value into the bytes stored in (and hashed by) the index.
+    """
+    if coltype == 'int':
+        return struct.pack('<q', int(value))
+    if coltype == 'float':
+        return struct.pack('<d', float(value))
+    return str(value).encode('utf-8')
+
+
+def _decode(coltype:str, data:bytes):
+    if coltype == 'int':
+        return struct.unpack('<q', data)[0]
+    if coltype == 'float':
+        return struct.unpack('<d', data)[0]
+    return data.decode('utf-8')
+
+
+def _layout(size:int):
+    """
+    Work out the number of hash slots that fits a file of 'size' bytes. About
+    half of the file goes to the first tier, the rest is left for values and
+    posting blocks.
+    """
+    nslots = 16
+    while _HDRSIZE + (nslots * 2) * (_SLOT.size + _ENTRY.size) <= size // 2:
+        nslots *= 2
+    return nslots
+
+
+class Index:
+    """
+    Memory mapped access to one column index file.
+
+    Methods:
+
+    Index(path, coltype) - map the index file, formatting it if it is new
+            lookup(value) - return the record offsets holding 'value'
+    insert(value, offset) - add record 'offset' under 'value'
+    insert_many(values, offsets) - add many pointers in a single pass
+    delete(value, offset) - remove record 'offset' from under 'value'
+    delete_many(values, offsets) - remove many pointers in a single pass
+    rollback(count, heaptop, offset, rebuilds) - undo what was added since a checkpoint
+          reserve(values) - make room to insert 'values', growing the file
+    rebuild(ids, nbytes) - rewrite the file compacted, with room for more
+                    id(value) - return the dictionary id of 'value', or None
+                   value(id) - return the value with dictionary id 'id'
+                postings(id) - return the record offsets of dictionary id 'id'
+                     items() - iterate over (id, value) of the first tier
+                    domain() - every value of the first tier, in id order
+                    extent() - the smallest and largest values of the first tier
+                     flush() - write dirty pages back to the file
+                     close() - unmap the file
+
+    Attributes:
+
+        path - file path of the index
+     coltype - type of the column indexed
+       count - number of distinct values (ids) in the first tier
+      nrefs - number of live record pointers in the second tier
+    heaptop - first free byte of the heap
+     ntomb - number of tombstones in the second tier
+       size - size of the file, in bytes
+  generation - bumped on every change to the index
+    rebuilds - number of times the index was rebuilt, its layout changed
+       pages - hash slots, dictionary entries and posting blocks read since
+               the index was opened
+    """
+
+    def __init__(self, path:str, coltype:str|None = None):
+        self._path = path
+        self._pages = 0
+        self._domain = None
+        self._extent = None
+        if getsize(path) < _HDRSIZE + 16 * (_SLOT.size + _ENTRY.size):
+            raise exceptions.IndexError("Index file '%s' is too small." % (path))
+        self._fp = open(path, 'r+b')
+        self._mm = mmap.mmap(self._fp.fileno(), 0)
+
+        magic = bytes(self._mm[0:4])
+        if magic == _MAGIC:
+            hdr = _HDR.unpack_from(self._mm, 0)
+            self._coltype = _TYPENAMES[hdr[2]]
+            self._nslots = hdr[4]
+        elif magic == bytes(4):
+            # A freshly preallocated file, lay out an empty index in it.
+            if coltype not in COLTYPES:
+                raise exceptions.TypeError("Type '%s' is invalid." % (coltype))
+            self._coltype = coltype
+            self._nslots = _layout(len(self._mm))
+            _HDR.pack_into(self._mm, 0, _MAGIC, _VERSION, COLTYPES[coltype],
+                           0, self._nslots, self._heapstart(), 0, 0, 0, 0)
+        else:
+            self.close()
+            raise exceptions.IndexError("'%s' is not an index file." % (path))
+        self._setlayout(self._nslots)
+
+    def _setlayout(self, nslots:int):
+        self._nslots = nslots
+        self._maxids = nslots * 3 // 4
+        self._entries = _HDRSIZE + nslots * _SLOT.size
+
+    def _heapstart(self):
+        return _HDRSIZE + self._nslots * _SLOT.size + (self._nslots * 3 // 4) * _ENTRY.size
+
+    def get_path(self):
+        return self._path
+    path = property(get_path)
+
+    def get_coltype(self):
+        return self._coltype
+    coltype = property(get_coltype)
+
+    def get_count(self):
+        return _HDR.unpack_from(self._mm, 0)[3]
+    count = property(get_count)
+
+    def get_nrefs(self):
+        return _HDR.unpack_from(self._mm, 0)[6]
+    nrefs = property(get_nrefs)
+
+    def get_heaptop(self):
+        return _HDR.unpack_from(self._mm, 0)[5]
+    heaptop = property(get_heaptop)
+
+    def get_ntomb(self):
+        return _HDR.unpack_from(self._mm, 0)[7]
+    ntomb = property(get_ntomb)
+
+    def get_size(self):
+        return len(self._mm)
+    size = property(get_size)
+
+    def get_pages(self):
+        return self._pages
+    pages = property(get_pages)
+
+    def get_generation(self):
+        return _HDR.unpack_from(self._mm, 0)[8]
+    generation = property(get_generation)
+
+    def get_rebuilds(self):
+        return _HDR.unpack_from(self._mm, 0)[9]
+    rebuilds = property(get_rebuilds)
+
+    def _header(self):
+        return list(_HDR.unpack_from(self._mm, 0))
+
+    def _setheader(self, hdr:list):
+        hdr[8] += 1
+        _HDR.pack_into(self._mm, 0, *hdr)
+
+    def _alloc(self, hdr:list, nbytes:int):
+        """
+        Allocate 'nbytes' from the heap, 8 byte aligned.
+        """
+        pos = hdr[5]
+        end = pos + ((nbytes + 7) & ~7)
+        if end > len(self._mm):
+            raise exceptions.IndexError("Index file '%s' is full." % (self._path))
+        hdr[5] = end
+        return pos
+
+    def _entry(self, vid:int):
+        return _ENTRY.unpack_from(self._mm, self._entries + vid * _ENTRY.size)
+
+    def _setentry(self, vid:int, entry):
+        _ENTRY.pack_into(self._mm, self._entries + vid * _ENTRY.size, *entry)
+
+    def _probe(self, data:bytes):
+        """
+        Find the hash slot of the encoded value 'data'. Returns the slot
+        position and the id stored there (None if the slot is empty).
+        """
+        mask = self._nslots - 1
+        slot = zlib.crc32(data) & mask
+        mm = self._mm
+        while True:
+            self._pages += 1
+            pos = _HDRSIZE + slot * _SLOT.size
+            sid = _SLOT.unpack_from(mm, pos)[0]
+            if sid == 0:
+                return pos, None
+            voff, vlen = _ENTRY.unpack_from(mm, self._entries + (sid - 1) * _ENTRY.size)[0:2]
+            if vlen == len(data) and mm[voff:voff+vlen] == data:
+                return pos, sid - 1
+            slot = (slot + 1) & mask
+
+    def _fresh(self):
+        """
+        Map the file again if another process grew it past the mapping.
+        """
+        if _HDR.unpack_from(self._mm, 0)[5] > len(self._mm):
+            self._remap()
+
+    def _remap(self):
+        # The old mapping isn't closed, a reader may still be using it.
+        self._mm = mmap.mmap(self._fp.fileno(), 0)
+
+    def id(self, value):
+        """
+        Return the dictionary id of 'value' or None if it isn't in the index.
+        """
+        if self._coltype == 'int' and isinstance(value, float) and not value.is_integer():
+            # Would be truncated by _encode; no int equals it.
+            return None
+        self._fresh()
+        return self._probe(_encode(self._coltype, value))[1]
+
+    def value(self, vid:int):
+        """
+        Return the value with the dictionary id 'vid'.
+        """
+        self._fresh()
+        self._pages += 1
+        mm = self._mm
+        voff, vlen = _ENTRY.unpack_from(mm, self._entries + vid * _ENTRY.size)[0:2]
+        return _decode(self._coltype, bytes(mm[voff:voff+vlen]))
+
+    def items(self):
+        """
+        Iterate over the first tier, yielding (id, value).
+        """
+        return enumerate(self.domain())
+
+    def domain(self):
+        """
+        Return the values of the first tier in id order, an array('q') or
+        array('d') for an int or float column and a list for a str column.
+        
+        The dictionary is kept between calls and only the ids added since
+        are read, so predicates can be run over the whole domain at once
+        (see pgm.Select) at the cost of the new values. Ids are only ever
+        taken back by a rollback, which is noticed from the count and the
+        entry of the last id read. Don't change the result.
+        """
+        self._fresh()
+        mm = self._mm
+        n = self.count
+        d = self._domain
+        if d:
+            last = len(d) - 1
+            voff, vlen = self._entry(last)[0:2] if last < n else (0, 0)
+            if not vlen or mm[voff:voff+vlen] != _encode(self._coltype, d[last]):
+                d = None
+        if d is None:
+            code = _DOMAINCODES.get(self._coltype)
+            d = self._domain = array(code) if code else []
+            self._extent = None
+        if len(d) < n:
+            first = len(d)
+            start = self._entries + first * _ENTRY.size
+            entries = _ENTRY.iter_unpack(mm[start:self._entries + n * _ENTRY.size])
+            self._pages += 1 + (n - first) * _ENTRY.size // mmap.PAGESIZE
+            if isinstance(d, array):
+                d.frombytes(b''.join([mm[voff:voff+8] for voff, vlen, *rest in entries]))
+            else:
+                d.extend([bytes(mm[voff:voff+vlen]).decode('utf-8') for voff, vlen, *rest in entries])
+            new = d[first:]
+            low, high = min(new), max(new)
+            if self._extent:
+                low, high = min(low, self._extent[0]), max(high, self._extent[1])
+            self._extent = (low, high)
+        return d
+
+    def extent(self):
+        """
+        Return (smallest, largest) of the values of the first tier, None if
+        it is empty. Kept up to date along with domain().
+        """
+        self.domain()
+        return self._extent
+
+    def sizes(self):
+        """
+        Return array('I') of the live count (the postings list size) of each
+        id of the first tier, read from the dictionary entries alone.
+        """
+        self._fresh()
+        n = self.count
+        self._pages += 1 + n * _ENTRY.size // mmap.PAGESIZE
+        # The live count is the third field, the fourth 32-bit word, of each entry.
+        words = array('I', self._mm[self._entries:self._entries + n * _ENTRY.size])
+        return words[3::_ENTRY.size // 4]
+
+    def postings(self, vid:int):
+        """
+        Return the live record offsets held by dictionary id 'vid'.
+        """
+        self._fresh()
+        mm = self._mm
+        nlive, blk = _ENTRY.unpack_from(mm, self._entries + vid * _ENTRY.size)[2:4]
+        result = array('Q')
+        used = 0
+        self._pages += 1
+        while blk:
+            self._pages += 1
+            nxt, n = _BLOCK.unpack_from(mm, blk)[0:2]
+            start = blk + _BLOCK.size
+            result.frombytes(mm[start:start + n * 8])
+            used += n
+            blk = nxt
+        if used != nlive:
+            result = array('Q', [i for i in result if i != TOMBSTONE])
+        return result
+
+    def lookup(self, value):
+        """
+        Return an array of the record offsets that hold 'value' in this column.
+        """
+        vid = self.id(value)
+        if vid is None:
+            return array('Q')
+        return self.postings(vid)
+
+    def _add(self, hdr:list, data:bytes):
+        """
+        Return the id of the encoded value 'data', adding it to the first
+        tier if it isn't there yet.
+        """
+        pos, vid = self._probe(data)
+        if vid is None:
+            vid = hdr[3]
+            if vid >= self._maxids:
+                raise exceptions.IndexError("Index file '%s' has no free ids." % (self._path))
+            voff = self._alloc(hdr, len(data))
+            self._mm[voff:voff+len(data)] = data
+            self._setentry(vid, (voff, len(data), 0, 0, 0))
+            _SLOT.pack_into(self._mm, pos, vid + 1)
+            hdr[3] += 1
+        return vid
+
+    def _append(self, hdr:list, vid:int, offsets):
+        """
+        Append the record 'offsets' to the postings of dictionary id 'vid'.
+        """
+        mm = self._mm
+        voff, vlen, nlive, head, tail = self._entry(vid)
+        offsets = array('Q', offsets)
+        done = 0
+        while done < len(offsets):
+            if tail:
+                nxt, used, cap = _BLOCK.unpack_from(mm, tail)
+            if not tail or used == cap:
+                # Chain on a new block, twice the size of the last one.
+                newcap = min(cap * 2, _MAXBLOCK) if tail else _FIRSTBLOCK
+                blk = self._alloc(hdr, _BLOCK.size + newcap * 8)
+                _BLOCK.pack_into(mm, blk, 0, 0, newcap)
+                if tail:
+                    _BLOCK.pack_into(mm, tail, blk, used, cap)
+                else:
+                    head = blk
+                tail, nxt, used, cap = blk, 0, 0, newcap
+            n = min(cap - used, len(offsets) - done)
+            start = tail + _BLOCK.size + used * 8
+            mm[start:start + n * 8] = offsets[done:done + n].tobytes()
+            _BLOCK.pack_into(mm, tail, nxt, used + n, cap)
+            done += n
+        self._setentry(vid, (voff, vlen, nlive + len(offsets), head, tail))
+        hdr[6] += len(offsets)
+
+    def insert(self, value, offset:int):
+        """
+        Add the record pointer 'offset' under 'value'.
+        """
+        hdr = self._header()
+        vid = self._add(hdr, _encode(self._coltype, value))
+        self._append(hdr, vid, [offset])
+        self._setheader(hdr)
+
+    def insert_many(self, values, offsets):
+        """
+        Add a batch of record pointers, 'values[i]' pointing at 'offsets[i]'.
+        The pointers are grouped by value first so each distinct value is
+        hashed and its posting chain extended only once.
+        """
+        groups = {}
+        for v, o in zip(values, offsets):
+            groups.setdefault(v, []).append(o)
+        hdr = self._header()
+        for v, offs in groups.items():
+            self._append(hdr, self._add(hdr, _encode(self._coltype, v)), offs)
+        self._setheader(hdr)
+
+    def _blockbytes(self, vid:int|None, n:int):
+        """
+        Return the heap bytes appending 'n' pointers to the postings of 'vid'
+        (None for a new value) takes, working through the blocks as _append does.
+        """
+        need = 0
+        used = cap = 0
+        if vid is not None:
+            tail = self._entry(vid)[4]
+            if tail:
+                used, cap = _BLOCK.unpack_from(self._mm, tail)[1:3]
+        while n > 0:
+            if used == cap:
+                cap = min(cap * 2, _MAXBLOCK) if cap else _FIRSTBLOCK
+                used = 0
+                need += _BLOCK.size + cap * 8
+            k = min(cap - used, n)
+            used += k
+            n -= k
+        return need
+
+    def reserve(self, values):
+        """
+        Make room for inserting a pointer under each of 'values', before
+        anything is changed, so an insert never fails half done. The heap is
+        grown by doubling the file; if the first tier would run out of ids
+        the index is rebuilt.
+
+        Return:
+            True if the index was rebuilt, its heap top and layout changed
+        """
+        groups = {}
+        for v in values:
+            groups[v] = groups.get(v, 0) + 1
+        self._fresh()
+        newids = 0
+        need = 0
+        for v, n in groups.items():
+            data = _encode(self._coltype, v)
+            vid = self._probe(data)[1]
+            if vid is None:
+                newids += 1
+                need += (len(data) + 7) & ~7
+            need += self._blockbytes(vid, n)
+        hdr = self._header()
+        if hdr[3] + newids > self._maxids:
+            self.rebuild(newids, need)
+            return True
+        if hdr[5] + need > len(self._mm):
+            size = len(self._mm)
+            while size < hdr[5] + need:
+                size *= 2
+            self._fp.truncate(size)
+            self._remap()
+        return False
+
+    def rebuild(self, ids:int = 0, nbytes:int = 0):
+        """
+        Rewrite the index into a new file and put it in place of the old one.
+        Tombstones are dropped and the live pointers of each value written as
+        one sorted block, the blocks in id order, so a scan of the second tier
+        reads the file front to back. The new file is sized to what it holds,
+        with room for 'ids' more ids and 'nbytes' more heap, and as much again
+        to grow into.
+        """
+        self._fresh()
+        count = self.count
+        values = []
+        heap = 0
+        for vid in range(count):
+            voff, vlen = self._entry(vid)[0:2]
+            ptrs = self.postings(vid)
+            ptrs = array('Q', sorted(ptrs))
+            values.append((bytes(self._mm[voff:voff+vlen]), ptrs))
+            heap += (vlen + 7) & ~7
+            if ptrs:
+                heap += _BLOCK.size + max(len(ptrs), _FIRSTBLOCK) * 8
+        size = 1 << 16
+        while True:
+            nslots = _layout(size)
+            heapstart = _HDRSIZE + nslots * _SLOT.size + (nslots * 3 // 4) * _ENTRY.size
+            if nslots * 3 // 4 >= 2 * (count + ids) and size - heapstart >= 2 * (heap + nbytes):
+                break
+            size *= 2
+
+        tmp = self._path + '.new'
+        with open(tmp, 'wb') as fp:
+            fp.truncate(size)
+        new = Index(tmp, self._coltype)
+        try:
+            mm = new._mm
+            hdr = new._header()
+            for vid, (data, ptrs) in enumerate(values):
+                new._add(hdr, data)
+                voff, vlen = new._entry(vid)[0:2]
+                if not ptrs:
+                    continue
+                cap = max(len(ptrs), _FIRSTBLOCK)
+                blk = new._alloc(hdr, _BLOCK.size + cap * 8)
+                _BLOCK.pack_into(mm, blk, 0, len(ptrs), cap)
+                mm[blk + _BLOCK.size:blk + _BLOCK.size + len(ptrs) * 8] = ptrs.tobytes()
+                new._setentry(vid, (voff, vlen, len(ptrs), blk, blk))
+                hdr[6] += len(ptrs)
+            hdr[8] = self.generation
+            hdr[9] = self.rebuilds + 1
+            new._setheader(hdr)
+            new.flush()
+            os.fsync(new._fp.fileno())
+        finally:
+            new.close()
+        os.replace(tmp, self._path)
+
+        # Take up the new file. The old mapping is left to readers still using it.
+        old = self._fp
+        self._fp = open(self._path, 'r+b')
+        self._mm = mmap.mmap(self._fp.fileno(), 0)
+        self._setlayout(_HDR.unpack_from(self._mm, 0)[4])
+        old.close()
+
+    def delete(self, value, offset:int):
+        """
+        Remove the record pointer 'offset' from under 'value'.
+
+        Return:
+            True - pointer found and removed
+           False - 'value' doesn't point at 'offset'
+        """
+        vid = self.id(value)
+        if vid is None:
+            return False
+        mm = self._mm
+        voff, vlen, nlive, head, tail = self._entry(vid)
+        blk = head
+        while blk:
+            nxt, used = _BLOCK.unpack_from(mm, blk)[0:2]
+            start = blk + _BLOCK.size
+            ptrs = array('Q', mm[start:start + used * 8])
+            try:
+                i = ptrs.index(offset)
+            except ValueError:
+                blk = nxt
+                continue
+            struct.pack_into('<Q', mm, start + i * 8, TOMBSTONE)
+            self._setentry(vid, (voff, vlen, nlive - 1, head, tail))
+            hdr = self._header()
+            hdr[6] -= 1
+            hdr[7] += 1
+            self._setheader(hdr)
+            return True
+        return False
+
+    def delete_many(self, values, offsets):
+        """
+        Remove a batch of record pointers, 'values[i]' pointing at
+        'offsets[i]'. The pointers are grouped by value first so the posting
+        chain of each distinct value is walked only once.
+
+        Return:
+            number of pointers found and removed
+        """
+        groups = {}
+        for v, o in zip(values, offsets):
+            groups.setdefault(v, set()).add(o)
+        removed = 0
+        for v, offs in groups.items():
+            vid = self.id(v)
+            if vid is None:
+                continue
+            mm = self._mm
+            voff, vlen, nlive, head, tail = self._entry(vid)
+            found = 0
+            blk = head
+            while blk and found < len(offs):
+                nxt, used = _BLOCK.unpack_from(mm, blk)[0:2]
+                start = blk + _BLOCK.size
+                for i, p in enumerate(array('Q', mm[start:start + used * 8])):
+                    if p in offs:
+                        struct.pack_into('<Q', mm, start + i * 8, TOMBSTONE)
+                        found += 1
+                blk = nxt
+            if found:
+                self._setentry(vid, (voff, vlen, nlive - found, head, tail))
+                removed += found
+        if removed:
+            hdr = self._header()
+            hdr[6] -= removed
+            hdr[7] += removed
+            self._setheader(hdr)
+        return removed
+
+    def _last(self, blk:int):
+        """
+        Return the last pointer, other than a tombstone, in posting block
+        'blk', 0 if there is none.
+        """
+        used = _BLOCK.unpack_from(self._mm, blk)[1]
+        start = blk + _BLOCK.size
+        ptrs = array('Q', self._mm[start:start + used * 8])
+        for p in reversed(ptrs):
+            if p != TOMBSTONE:
+                return p
+        return 0
+
+    def rollback(self, count:int, heaptop:int, offset:int, rebuilds:int|None = None):
+        """
+        Undo everything added to the index since its header held 'count' ids
+        and heap top 'heaptop', dropping every pointer to a record at or past
+        'offset'. Ids are handed out and the heap allocated in order, so what
+        was added since is the ids from 'count' on, the heap from 'heaptop' on
+        and the pointers appended to the last block of each chain; only the
+        chains that grew are walked. An insert cut short, whose header was
+        never written, is undone as well.
+
+        If the index was rebuilt since, its number of rebuilds no longer
+        'rebuilds', 'heaptop' means nothing in the new layout: the heap is
+        kept and every chain walked, dropping the pointers at or past
+        'offset' from each of its blocks. The ids are the same after a
+        rebuild, so 'count' still holds.
+        """
+        mm = self._mm
+        hdr = self._header()
+        self._domain = self._extent = None
+        relaid = rebuilds is not None and rebuilds != hdr[9]
+        if relaid:
+            heaptop = hdr[5]
+
+        # Forget the ids given out since. Values hash in the order they were
+        # added, so clearing the later ones leaves the earlier ones findable.
+        slots = array('I', mm[_HDRSIZE:self._entries])
+        for i, sid in enumerate(slots):
+            if sid > count:
+                _SLOT.pack_into(mm, _HDRSIZE + i * _SLOT.size, 0)
+        vid = count
+        while vid < self._maxids and self._entry(vid)[0]:
+            self._setentry(vid, (0, 0, 0, 0, 0))
+            vid += 1
+
+        nrefs = 0
+        for vid in range(count):
+            voff, vlen, nlive, head, tail = self._entry(vid)
+            if not head or (not relaid and head < heaptop and tail < heaptop and self._last(tail) < offset):
+                nrefs += nlive
+                continue
+            if head >= heaptop:
+                self._setentry(vid, (voff, vlen, 0, 0, 0))
+                continue
+            # Keep the blocks allocated before, trimming the last of them.
+            nlive = 0
+            blk = head
+            while True:
+                nxt, used, cap = _BLOCK.unpack_from(mm, blk)
+                start = blk + _BLOCK.size
+                ptrs = array('Q', mm[start:start + used * 8])
+                if relaid:
+                    # The pointers added since may be in any block of the chain.
+                    ptrs = array('Q', [p for p in ptrs if p < offset or p == TOMBSTONE])
+                    mm[start:start + len(ptrs) * 8] = ptrs.tobytes()
+                if not nxt or nxt >= heaptop:
+                    while ptrs and (ptrs[-1] == 0 or offset <= ptrs[-1] != TOMBSTONE):
+                        ptrs.pop()
+                    _BLOCK.pack_into(mm, blk, 0, len(ptrs), cap)
+                    nlive += len(ptrs) - ptrs.count(TOMBSTONE)
+                    break
+                if relaid:
+                    _BLOCK.pack_into(mm, blk, nxt, len(ptrs), cap)
+                nlive += len(ptrs) - ptrs.count(TOMBSTONE)
+                blk = nxt
+            self._setentry(vid, (voff, vlen, nlive, head, blk))
+            nrefs += nlive
+
+        hdr[3] = count
+        hdr[5] = heaptop
+        hdr[6] = nrefs
+        self._setheader(hdr)
+
+    def flush(self):
+        self._mm.flush()
+
+    def close(self):
+        if self._mm:
+            self._mm.close()
+            self._mm = None
+        if self._fp:
+            self._fp.close()
+            self._fp = None
@@ -0,0 +1,233 @@
+"""
+class Metrics - counters and timings of the stages a request goes through.
+class Trace   - the stages of one query, for EXPLAIN ANALYZE.
+
+Every stage of the pipeline reports here: parsing a request (server.py),
+compiling a statement (sql.py), the time a step waits in the Indexers'
+queue and the time and index pages it takes (pgm.py), merging the step
+results (Complete), reading and decoding records (records.py) and loading
+table definitions (catalog.py). Timings are kept as histograms and
+everything is rendered in the Prometheus text format for /metrics:
+
+    ts2db_<stage>_seconds      - histogram of the time taken by a stage
+    ts2db_<counter>_total      - counter
+    ts2db_<gauge>              - value read when rendered
+
+A Trace, when one is active in the context (see Tracing), also gets every
+timing and count made while it is, so a single query can be broken down.
+
+'metrics' is the registry shared by everything in the process.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+import threading
+import time
+
+# Upper bounds, in seconds, of the histogram buckets.
+BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# What each metric is, for the HELP lines.
+HELP = {
+    'parse': 'Parsing the body of a request',
+    'compile': 'Compiling a SQL statement into a program',
+    'queue': 'Time a step waited for an Indexer',
+    'step': 'Running a search step against an index',
+    'complete': 'Merging the step results and running the common program',
+    'fetch': 'Reading records from a record store',
+    'codec': 'Decompressing records',
+    'encode': 'Encoding and compressing records to append',
+    'catalog_load': 'Reading and decompressing an info.json.bz2',
+    'plan_hits': 'Statements whose program was cached',
+    'plan_misses': 'Statements compiled',
+    'result_hits': 'Queries answered from the result cache',
+    'result_extends': 'Cached results extended with the rows appended since',
+    'result_misses': 'Queries run in full',
+    'publish': 'Matching an inserted batch against the subscriptions of its table',
+    'published_rows': 'Rows pushed to subscribers',
+    'steps': 'Search steps run',
+    'plan': 'Planning the steps of a program from the table statistics',
+    'steps_pruned': 'Search steps skipped since the statistics tell what they find',
+    'filter': 'Checking the candidates of a step against the steps deferred to it',
+    'steps_filtered': 'Search steps answered by checking the candidates of another step',
+    'rows_deleted': 'Rows deleted, or replaced by a new version by an update',
+    'rows_reclaimed': 'Deleted rows whose index pointers were removed',
+    'feed_batches': 'Batches of changes shipped to replication sinks',
+    'feed_changes': 'Changes shipped to replication sinks',
+    'feed_bytes': 'Compressed bytes of changes shipped to replication sinks',
+    'index_pages': 'Posting blocks, first tier entries and run probes read by search steps',
+    'fetch_bytes': 'Bytes of records read',
+    'fetch_records': 'Records read',
+    'requests': 'Requests served',
+    'rejected': 'Requests turned away by admission control',
+}
+
+
+class Trace:
+    """
+    What happened while one query ran.
+
+    Methods:
+
+                   Trace() - an empty trace
+    add(stage, seconds, detail) - note a stage, with a dict of details
+      count(name, n) - add 'n' to counter 'name'
+               rows() - the stages, then the counters, as result rows
+
+    Attributes:
+
+        events - list of (stage, seconds, detail)
+      counters - dict of name to count
+    """
+
+    def __init__(self):
+        self._events = []
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    def get_events(self):
+        return self._events
+    events = property(get_events)
+
+    def get_counters(self):
+        return self._counters
+    counters = property(get_counters)
+
+    def add(self, stage:str, seconds:float, detail:dict|None = None):
+        with self._lock:
+            self._events.append((stage, seconds, detail))
+
+    def count(self, name:str, n:int = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def rows(self):
+        """
+        Return one row per stage, in the order they finished, then one per
+        counter and the total.
+        """
+        with self._lock:
+            result = [{'stage': s, 'ms': round(t * 1000, 3), 'detail': d} for s, t, d in self._events]
+            result += [{'stage': name, 'count': n} for name, n in sorted(self._counters.items())]
+        result.append({'stage': 'total', 'ms': round((time.perf_counter() - self._start) * 1000, 3)})
+        return result
+
+
+_trace = ContextVar('trace', default=None)
+
+
+def CurrentTrace():
+    """
+    Return the Trace active in this context, None if there is none.
+    """
+    return _trace.get()
+
+
+@contextmanager
+def Tracing(trace:Trace):
+    """
+    Make 'trace' the active Trace for the body of the with statement.
+    """
+    token = _trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _trace.reset(token)
+
+
+class Metrics:
+    """
+    Registry of counters, timings and gauges.
+
+    Methods:
+
+                Metrics() - an empty registry
+      count(name, n) - add 'n' to counter 'name'
+    observe(name, seconds, detail) - add a timing of stage 'name'
+         stage(name) - context manager timing its body as stage 'name'
+    gauge(name, f, help) - report f() as 'name' when rendered
+            render() - the registry in the Prometheus text format
+          snapshot() - dict of the counters and of the count and sum of each timing
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timings = {}
+        self._gauges = {}
+
+    def count(self, name:str, n:int = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+        trace = _trace.get()
+        if trace is not None:
+            trace.count(name, n)
+
+    def observe(self, name:str, seconds:float, detail:dict|None = None):
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                timing = self._timings[name] = [0, 0.0, [0] * len(BUCKETS)]
+            timing[0] += 1
+            timing[1] += seconds
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    timing[2][i] += 1
+                    break
+        trace = _trace.get()
+        if trace is not None:
+            trace.add(name, seconds, detail)
+
+    @contextmanager
+    def stage(self, name:str, detail:dict|None = None):
+        """
+        Time the body of the with statement as stage 'name'. 'detail' may be
+        filled in by the body; it goes to the trace.
+        """
+        start = time.perf_counter()
+        try:
+            yield detail
+        finally:
+            self.observe(name, time.perf_counter() - start, detail)
+
+    def gauge(self, name:str, f, help:str = ''):
+        with self._lock:
+            self._gauges[name] = (f, help)
+
+    def snapshot(self):
+        with self._lock:
+            return {'counters': dict(self._counters),
+                    'timings': {k: {'count': v[0], 'sum': v[1]} for k, v in self._timings.items()}}
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            timings = sorted((k, (v[0], v[1], list(v[2]))) for k, v in self._timings.items())
+            gauges = sorted(self._gauges.items())
+        lines = []
+        for name, n in counters:
+            metric = 'ts2db_%s_total' % (name)
+            lines.append('# HELP %s %s' % (metric, HELP.get(name, name)))
+            lines.append('# TYPE %s counter' % (metric))
+            lines.append('%s %d' % (metric, n))
+        for name, (n, total, buckets) in timings:
+            metric = 'ts2db_%s_seconds' % (name)
+            lines.append('# HELP %s %s' % (metric, HELP.get(name, name)))
+            lines.append('# TYPE %s histogram' % (metric))
+            cumulative = 0
+            for bound, k in zip(BUCKETS, buckets):
+                cumulative += k
+                lines.append('%s_bucket{le="%g"} %d' % (metric, bound, cumulative))
+            lines.append('%s_bucket{le="+Inf"} %d' % (metric, n))
+            lines.append('%s_sum %.9f' % (metric, total))
+            lines.append('%s_count %d' % (metric, n))
+        for name, (f, help) in gauges:
+            metric = 'ts2db_%s' % (name)
+            lines.append('# HELP %s %s' % (metric, help or name))
+            lines.append('# TYPE %s gauge' % (metric))
+            lines.append('%s %s' % (metric, f()))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
@@ -0,0 +1,326 @@
+"""
+class OrderedIndex - the values of an int or float column kept in order.
+
+The two tier index (index.py) answers equality, but its ids are handed out
+in insertion order, so a range predicate has to look at every value. A
+column added to a TABLEDEF as ordered also gets an ordered index, XXXXX.ord
+beside XXXXX.idx, made of sorted runs:
+
+    <header>  - 'TS2O', version, column type, generation, 16 bytes
+    <run>     - repeated: <entries>, then the values of the run sorted and
+                the record offset of each value, 8 bytes apiece
+
+Every insert batch is written as a new run at the end of the file and then,
+like a binary counter, the last two runs are merged into a new one while
+the older of them is no larger than the newer. A file of n values so has
+O(log n) runs, and a range is found by a binary search in each run that can
+hold it: O(log n + k) for k matches.
+
+Runs are never changed once written. Which runs are live is held in
+XXXXX.runs, a small JSON file replaced whole when it changes, so readers in
+other processes see either the old runs or the new. The space of the runs
+merged away is reclaimed by rewriting the file when it is more than half
+dead, which bumps the generation of the file. The generation is in both the
+header and the run directory; a reader finding them different has caught
+the file being rewritten and reads them again.
+"""
+from array import array
+from os.path import exists, dirname
+import heapq
+import json
+import os
+import struct
+import time
+
+import exceptions
+
+_HDR = struct.Struct('<4sHHQ')
+_MAGIC = b'TS2O'
+_VERSION = 1
+_COUNT = struct.Struct('<Q')
+
+_TYPES = {'int': 1, 'float': 2}
+_TYPENAMES = {v: k for k, v in _TYPES.items()}
+_CODES = {'int': 'q', 'float': 'd'}
+
+# Runs at most this long are searched by reading their values whole.
+_SMALLRUN = 256
+
+# Times a reader reads a file being rewritten again before giving up.
+_RETRIES = 100
+
+# Dead bytes that are worth rewriting the file for, once over half of it.
+_RECLAIM = 1 << 20
+
+
+def RunsPath(path:str):
+    """
+    Return the path of the run directory of ordered index file 'path'.
+    """
+    return path[:-len('.ord')] + '.runs'
+
+
+class OrderedIndex:
+    """
+    One ordered index file.
+
+    Methods:
+
+    OrderedIndex(path, coltype) - open (or create) the ordered index
+       append(values, offsets) - add 'values[i]' pointing at 'offsets[i]', as a run
+    range(low, high, lowincl, highincl) - sorted offsets of the values in the range,
+                                 either bound may be None
+                       state() - what rollback needs to undo later appends
+               rollback(state) - undo the appends made since 'state' was taken
+     rebuild(values, offsets) - replace the whole file with a single run
+                       flush() - make the file durable
+                       close() - close the file
+
+    Attributes:
+
+          path - file path of the ordered index
+       coltype - type of the column
+         count - number of values in the live runs
+          runs - number of live runs
+    generation - bumped every time the file is rewritten
+         pages - runs and run entries read since the index was opened
+    """
+
+    def __init__(self, path:str, coltype:str|None = None):
+        self._path = path
+        self._pages = 0
+        self._fd = None
+        self._dir = None
+        self._dirkey = None
+        if not exists(path):
+            if coltype not in _TYPES:
+                raise exceptions.TypeError("Type '%s' can't be ordered." % (coltype))
+            with open(path, 'wb') as fp:
+                fp.write(_HDR.pack(_MAGIC, _VERSION, _TYPES[coltype], 0))
+            self._writedir({'generation': 0, 'dead': 0, 'runs': []})
+        self._open()
+        self._code = _CODES[self._coltype]
+
+    def _open(self):
+        self.close()
+        self._fd = os.open(self._path, os.O_RDWR)
+        magic, version, code, self._gen = _HDR.unpack(os.pread(self._fd, _HDR.size, 0))
+        if magic != _MAGIC:
+            self.close()
+            raise exceptions.IndexError("'%s' is not an ordered index file." % (self._path))
+        self._coltype = _TYPENAMES[code]
+
+    def get_path(self):
+        return self._path
+    path = property(get_path)
+
+    def get_coltype(self):
+        return self._coltype
+    coltype = property(get_coltype)
+
+    def get_count(self):
+        return sum(r[1] for r in self._directory()['runs'])
+    count = property(get_count)
+
+    def get_runs(self):
+        return len(self._directory()['runs'])
+    runs = property(get_runs)
+
+    def get_pages(self):
+        return self._pages
+    pages = property(get_pages)
+
+    def get_generation(self):
+        return self._directory()['generation']
+    generation = property(get_generation)
+
+    def _directory(self):
+        """
+        Return the run directory, read again if another process replaced it.
+        Each run is [position, entries, smallest value, largest value].
+        """
+        for i in range(_RETRIES):
+            st = os.stat(RunsPath(self._path))
+            key = (st.st_mtime_ns, st.st_size, st.st_ino)
+            if key != self._dirkey:
+                with open(RunsPath(self._path), 'rb') as fp:
+                    self._dir = json.loads(fp.read())
+                self._dirkey = key
+            if self._dir['generation'] == self._gen:
+                return self._dir
+            # The file was rewritten: open the new one, or wait for its runs.
+            if os.stat(self._path).st_ino != os.fstat(self._fd).st_ino:
+                self._open()
+            else:
+                time.sleep(0.001)
+        raise exceptions.IndexError("'%s' doesn't match its runs." % (self._path))
+
+    def _writedir(self, d:dict):
+        tmp = RunsPath(self._path) + '.tmp'
+        with open(tmp, 'wb') as fp:
+            fp.write(json.dumps(d).encode('utf-8'))
+        os.replace(tmp, RunsPath(self._path))
+        self._dir = d
+        self._dirkey = None
+
+    def _write(self, keys:array, offsets:array):
+        """
+        Write a run of sorted 'keys' at the end of the file, return its entry.
+        """
+        pos = os.fstat(self._fd).st_size
+        os.pwrite(self._fd, _COUNT.pack(len(keys)) + keys.tobytes() + offsets.tobytes(), pos)
+        return [pos, len(keys), keys[0], keys[-1]]
+
+    def _read(self, run:list, first:int = 0, last:int|None = None):
+        """
+        Return the keys and offsets of entries [first, last) of 'run'.
+        """
+        pos, n = run[0:2]
+        last = n if last is None else last
+        self._pages += 1
+        keys = array(self._code)
+        keys.frombytes(os.pread(self._fd, (last - first) * 8, pos + _COUNT.size + first * 8))
+        offsets = array('Q')
+        offsets.frombytes(os.pread(self._fd, (last - first) * 8, pos + _COUNT.size + (n + first) * 8))
+        return keys, offsets
+
+    def _merge(self, a:list, b:list):
+        """
+        Write the merge of runs 'a' and 'b' as a new run, return its entry.
+        """
+        ka, oa = self._read(a)
+        kb, ob = self._read(b)
+        if ka[-1] <= kb[0]:
+            # Time series mostly arrive in order, and then so do the runs.
+            keys, offsets = ka + kb, oa + ob
+        elif kb[-1] < ka[0]:
+            keys, offsets = kb + ka, ob + oa
+        else:
+            merged = list(heapq.merge(zip(ka, oa), zip(kb, ob)))
+            keys = array(self._code, [k for k, o in merged])
+            offsets = array('Q', [o for k, o in merged])
+        return self._write(keys, offsets)
+
+    def append(self, values:list, offsets:list):
+        if not values:
+            return
+        order = sorted(range(len(values)), key=values.__getitem__)
+        keys = array(self._code, [values[i] for i in order])
+        offs = array('Q', [offsets[i] for i in order])
+        d = self._directory()
+        d = {'generation': d['generation'], 'dead': d['dead'], 'runs': list(d['runs'])}
+        runs = d['runs']
+        runs.append(self._write(keys, offs))
+        while len(runs) >= 2 and runs[-2][1] <= runs[-1][1]:
+            b = runs.pop()
+            a = runs.pop()
+            runs.append(self._merge(a, b))
+            d['dead'] += (a[1] + b[1]) * 16 + 2 * _COUNT.size
+        if d['dead'] > _RECLAIM and d['dead'] > os.fstat(self._fd).st_size // 2:
+            self._rewrite(d['runs'])
+        else:
+            self._writedir(d)
+
+    def _rewrite(self, runs:list):
+        """
+        Rewrite the file, as the next generation, with only 'runs'.
+        """
+        gen = self._gen + 1
+        tmp = self._path + '.tmp'
+        with open(tmp, 'wb') as fp:
+            fp.write(_HDR.pack(_MAGIC, _VERSION, _TYPES[self._coltype], gen))
+            live = []
+            for run in runs:
+                keys, offsets = self._read(run)
+                live.append([fp.tell(), run[1], run[2], run[3]])
+                fp.write(_COUNT.pack(len(keys)) + keys.tobytes() + offsets.tobytes())
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, self._path)
+        self._open()
+        self._writedir({'generation': gen, 'dead': 0, 'runs': live})
+
+    def _bisect(self, run:list, value, right:bool):
+        """
+        Return where 'value' goes in 'run', after equal values if 'right'.
+        """
+        lo, hi = 0, run[1]
+        pos = run[0] + _COUNT.size
+        code = '<' + self._code
+        while lo < hi:
+            mid = (lo + hi) // 2
+            self._pages += 1
+            k = struct.unpack(code, os.pread(self._fd, 8, pos + mid * 8))[0]
+            if k < value or (right and k == value):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def range(self, low, high, lowincl:bool = True, highincl:bool = True):
+        """
+        Return the sorted record offsets of the values between 'low' and
+        'high'. Either bound may be None.
+        """
+        result = array('Q')
+        for run in self._directory()['runs']:
+            pos, n, first, last = run
+            if low is not None and (last < low or (last == low and not lowincl)):
+                continue
+            if high is not None and (first > high or (first == high and not highincl)):
+                continue
+            if n <= _SMALLRUN:
+                keys, offsets = self._read(run)
+                result.extend(o for k, o in zip(keys, offsets)
+                              if (low is None or k > low or (lowincl and k == low))
+                              and (high is None or k < high or (highincl and k == high)))
+                continue
+            i = 0 if low is None else self._bisect(run, low, not lowincl)
+            j = n if high is None else self._bisect(run, high, highincl)
+            if i < j:
+                result.extend(self._read(run, i, j)[1])
+        return array('Q', sorted(result))
+
+    def state(self):
+        d = self._directory()
+        return {'size': os.fstat(self._fd).st_size, 'dir': d}
+
+    def rollback(self, state:dict):
+        """
+        Undo the appends made since 'state' was taken. Runs are only ever
+        added at the end, so this is cutting the file back. Returns False if
+        the file was rewritten since and can't be rolled back.
+        """
+        if self._gen != state['dir']['generation']:
+            return False
+        os.ftruncate(self._fd, state['size'])
+        self._writedir(state['dir'])
+        return True
+
+    def rebuild(self, values:list, offsets:list):
+        """
+        Replace the contents of the file with a single run of 'values'.
+        """
+        self._rewrite([])
+        self.append(values, offsets)
+
+    def flush(self):
+        """
+        Make the runs and the run directory durable.
+        """
+        os.fsync(self._fd)
+        for path in (RunsPath(self._path), dirname(self._path) or '.'):
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __del__(self):
+        # A reader's cached copy is dropped, not closed, when the file is rewritten.
+        self.close()
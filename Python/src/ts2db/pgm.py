@@ -1,11 +1,308 @@
-from multiprocessing import Queue, Process
+"""
+The Distributor/Composer and the Indexer processes.
+
+A program step is a tuple
+
+    (index file, predicate, op)
+
+where the predicate is (comparison, value) and op is the Indexer operation,
+currently only 'search'. The comparisons are '=', '!=', '<', '<=', '>',
+'>=', 'in' (value is a list), 'between' (value is [low, high], inclusive),
+'range' (value is [low, high, low included, high included]) and '*' (any
+value, the value is ignored). The file is a column's .idx, its .ord for
+a range over an ordered column, or its .col for a scan of the column's
+blocks that skips those its zone map rules out (see zones.py).
+
+The Indexers are long lived processes. Each keeps every index file it has
+been asked about mapped into memory across requests, until the file is
+removed (see Evict), so a step only costs the pages it touches. The record
+offsets an Indexer finds are handed back
+through a multiprocessing.shared_memory block rather than pickled on the
+output queue.
+
+The Composer (Complete) combines the sorted offset arrays of the steps
+with merge based set algebra (NumPy's when it is installed) and then
+reads only the surviving records, in file order.
+"""
+from multiprocessing import Queue, Process, resource_tracker
+from queue import Empty
+from multiprocessing.shared_memory import SharedMemory
+from array import array
+from bisect import bisect_left
+from concurrent.futures import Future
+from itertools import count
+import asyncio
+import heapq
+import os
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from index import Index
+from metrics import metrics, CurrentTrace, Tracing
+from ordered import OrderedIndex
+from zones import ZoneScan
+from rollup import Accumulate, Results
+import exceptions
+
+# Test of a value 'v' against the value 'x' of each comparison that isn't
+# answered by index lookups.
+COMPARE = {
+    '!=': lambda v, x: v != x,
+    '<':  lambda v, x: v < x,
+    '<=': lambda v, x: v <= x,
+    '>':  lambda v, x: v > x,
+    '>=': lambda v, x: v >= x,
+    'between': lambda v, x: x[0] <= v <= x[1],
+    'range': lambda v, x: (x[0] < v or (x[2] and x[0] == v)) and (v < x[1] or (x[3] and v == x[1])),
+    '*':  lambda v, x: True,
+}
+
+# The ids of the values of a dictionary 'd' passing each comparison against
+# 'x', as a single comprehension rather than a call per value.
+_SELECT = {
+    '!=': lambda d, x: [i for i, v in enumerate(d) if v != x],
+    '<':  lambda d, x: [i for i, v in enumerate(d) if v < x],
+    '<=': lambda d, x: [i for i, v in enumerate(d) if v <= x],
+    '>':  lambda d, x: [i for i, v in enumerate(d) if v > x],
+    '>=': lambda d, x: [i for i, v in enumerate(d) if v >= x],
+    'between': lambda d, x: [i for i, v in enumerate(d) if x[0] <= v <= x[1]],
+    'range': lambda d, x: [i for i, v in enumerate(d)
+                           if (x[0] < v or (x[2] and x[0] == v)) and (v < x[1] or (x[3] and v == x[1]))],
+    '*':  lambda d, x: list(range(len(d))),
+}
+
+# The same over the dictionary of an int or float column as a NumPy array.
+_NPSELECT = {
+    '!=': lambda a, x: a != x,
+    '<':  lambda a, x: a < x,
+    '<=': lambda a, x: a <= x,
+    '>':  lambda a, x: a > x,
+    '>=': lambda a, x: a >= x,
+    'between': lambda a, x: (a >= x[0]) & (a <= x[1]),
+    'range': lambda a, x: ((a >= x[0]) if x[2] else (a > x[0])) & ((a <= x[1]) if x[3] else (a < x[1])),
+    '*':  lambda a, x: np.ones(len(a), dtype=bool),
+}
+
+_NPTYPES = {'q': 'int64', 'd': 'float64'}
+
+# Seconds between the sweeps of an Indexer for files removed, see Evict.
+SWEEP = 10
+
+
+def GetIndex(cache:dict, path:str):
+    """
+    Return the mapped Index for 'path' from 'cache', mapping it if it isn't
+    there yet or if the file was replaced since it was mapped. A path ending
+    in .ord is an OrderedIndex, one ending in .col a ZoneScan of the column
+    (or its Index, in a segment made before columns were kept).
+    """
+    if path.endswith('.col') and not os.path.exists(path):
+        path = path[:-len('.col')] + '.idx'
+    ino = os.stat(path).st_ino
+    if path in cache:
+        idx, mapped = cache[path]
+        if mapped == ino:
+            return idx
+        # The file was rebuilt. The old mapping goes once nothing uses it.
+    if path.endswith('.ord'):
+        idx = OrderedIndex(path)
+    elif path.endswith('.col'):
+        idx = ZoneScan(path)
+    else:
+        idx = Index(path)
+    cache[path] = (idx, ino)
+    return idx
+
+
+def Evict(cache:dict, path:str|None = None):
+    """
+    Take out of 'cache' the files in directory 'path', or if 'path' is None
+    the files that no longer exist, and return their mappings. A mapping
+    still in use by a query stays valid and goes once nothing uses it.
+    """
+    if path is None:
+        stale = [p for p in list(cache) if not os.path.exists(p)]
+    else:
+        under = os.path.join(path, '')
+        stale = [p for p in list(cache) if p.startswith(under)]
+    gone = []
+    for p in stale:
+        entry = cache.pop(p, None)
+        if entry is not None:
+            gone.append(entry[0])
+    return gone
+
+
+# Comparisons that bound a range of values.
+_RANGEOPS = {'<', '<=', '>', '>=', 'between', 'range'}
+
+
+def _bounds(cmp:str, value):
+    """
+    Return (low, high, low included, high included) of a range predicate.
+    """
+    if cmp == '<':
+        return None, value, True, False
+    if cmp == '<=':
+        return None, value, True, True
+    if cmp == '>':
+        return value, None, False, True
+    if cmp == '>=':
+        return value, None, True, True
+    if cmp == 'between':
+        return value[0], value[1], True, True
+    if cmp == 'range':
+        return tuple(value)
+    if cmp == '*':
+        return None, None, True, True
+    raise exceptions.IndexError("Comparison '%s' can't use an ordered index." % (cmp))
+
+
+def Select(idx:Index, cmp:str, value):
+    """
+    Return the dictionary ids of the values of an index passing a
+    comparison that isn't a lookup, testing each distinct value once.
+
+    The comparison runs over the whole first tier at once (see
+    Index.domain): vectorized with NumPy, when it is installed, for int and
+    float columns and as one comprehension otherwise. A range that the
+    smallest and largest values of the domain show can't match anything is
+    turned away before that.
+    """
+    domain = idx.domain()
+    if not domain:
+        return []
+    if cmp in _RANGEOPS:
+        low, high, lowincl, highincl = _bounds(cmp, value)
+        first, last = idx.extent()
+        if low is not None and (last < low or (last == low and not lowincl)):
+            return []
+        if high is not None and (first > high or (first == high and not highincl)):
+            return []
+    if np is not None and isinstance(domain, array):
+        a = np.frombuffer(domain, dtype=_NPTYPES[domain.typecode])
+        return np.flatnonzero(_NPSELECT[cmp](a, value)).tolist()
+    return _SELECT[cmp](domain, value)
+
+
+def Test(cmp:str, value):
+    """
+    Return a function telling whether a value satisfies the predicate.
+    """
+    if cmp == '=':
+        return lambda v: v == value
+    if cmp == 'in':
+        wanted = set(value)
+        return lambda v: v in wanted
+    if cmp not in COMPARE:
+        raise exceptions.IndexError("Comparison '%s' is invalid." % (cmp))
+    f = COMPARE[cmp]
+    return lambda v: f(v, value)
+
+
+def Evaluate(idx:Index, predicate):
+    """
+    Run one search step against an index, a range step against an ordered
+    index, or a scan of a column's blocks.
+
+    Return:
+        sorted array('Q') of the record offsets satisfying 'predicate'
+    """
+    cmp, value = predicate
+    if isinstance(idx, OrderedIndex):
+        return idx.range(*_bounds(cmp, value))
+    if isinstance(idx, ZoneScan):
+        return idx.scan(cmp, value, Test(cmp, value))
+    if cmp == '=':
+        result = idx.lookup(value)
+    elif cmp == 'in':
+        result = array('Q')
+        # A value given twice would find its records twice.
+        for v in set(value):
+            result.extend(idx.lookup(v))
+    elif cmp in COMPARE:
+        # Apply F() to the first tier, then expand only the postings of the
+        # ids that pass.
+        result = array('Q')
+        for vid in Select(idx, cmp, value):
+            result.extend(idx.postings(vid))
+    else:
+        raise exceptions.IndexError("Comparison '%s' is invalid." % (cmp))
+    return array('Q', sorted(result))
+
+
+def Step(cache:dict, path:str, predicate):
+    """
+    Evaluate one search step, with the index of 'path' from 'cache'.
+
+    Return:
+        (sorted array('Q') of record offsets, stats), stats being a dict of
+        the 'step' it was, the 'seconds' and index 'pages' it took
+    """
+    start = time.perf_counter()
+    idx = GetIndex(cache, path)
+    pages = idx.pages
+    result = Evaluate(idx, predicate)
+    return result, {'step': '%s %s' % (os.path.basename(path), predicate[0]),
+                    'seconds': time.perf_counter() - start, 'pages': idx.pages - pages}
+
+
+def Record(stats:dict, n:int):
+    """
+    Add the stats of a step that found 'n' offsets to the metrics.
+    """
+    if 'wait' in stats:
+        metrics.observe('queue', stats['wait'], {'step': stats['step']})
+    metrics.observe('step', stats['seconds'], {'step': stats['step'], 'pages': stats['pages'], 'offsets': n})
+    metrics.count('steps')
+    metrics.count('index_pages', stats['pages'])
+
 
 def ProcessPgm(inque:Queue, outque:Queue):
     """
     This function, which is run in multiple processes, reads from
     inque, does the processing and returns the results in outque.
+
+    Each request is (request id, step number, step, time sent) and each
+    answer is (request id, step number, shared memory name, offsets, error,
+    stats), see Step; the stats add the 'wait' in the queue. A None request
+    stops the process. Every SWEEP seconds the files that were removed
+    are unmapped, see Evict.
     """
-    pass
+    indices = {}
+    swept = time.monotonic()
+    while True:
+        if time.monotonic() - swept >= SWEEP:
+            # Let go of the files of partitions and tables dropped since.
+            for idx in Evict(indices):
+                idx.close()
+            swept = time.monotonic()
+        try:
+            req = inque.get(timeout=SWEEP)
+        except Empty:
+            continue
+        if req is None:
+            break
+        reqid, stepno, (path, predicate, op), sent = req
+        wait = max(0.0, time.time() - sent)
+        try:
+            if op != 'search':
+                raise exceptions.IndexError("Operation '%s' is invalid." % (op))
+            result, stats = Step(indices, path, predicate)
+            stats['wait'] = wait
+            shm = SharedMemory(create=True, size=max(8, len(result) * 8))
+            shm.buf[:len(result) * 8] = result.tobytes()
+            outque.put((reqid, stepno, shm.name, len(result), None, stats))
+            shm.close()
+        except Exception as e:
+            outque.put((reqid, stepno, None, 0, "%s: %s" % (path, e), None))
+    for idx, _ in indices.values():
+        idx.close()
 
 
 def ProcessCOmpletion(inque:Queue, outque:Queue):
@@ -19,31 +316,340 @@ def Startup(nCount):
     This function is called during initialization of the system. It start
     'nCount' processes each running the ProcessPgm function. These processes
     evaluates various "programming step".
+
+    Returns [input queue, output queue, processes].
     """
+    # The Indexers create the shared memory blocks and the caller unlinks them,
+    # so they must all register with the same resource tracker.
+    resource_tracker.ensure_running()
+
     # Create the necessary queues.
     inQue = Queue()
     outQue = Queue()
-    
+
     # Startup the processing processes.
+    procs = []
     for i in range(nCount):
-        p=Process(target=ProcessPgm, name='ProcessPgm %s' % (str(i)), args=(inQue, outQue))
+        p=Process(target=ProcessPgm, name='ProcessPgm %s' % (str(i)), args=(inQue, outQue), daemon=True)
         p.start()
-        
+        procs.append(p)
+
     # Return the queues for additional handling.
-    return [inQue, outQue]
+    return [inQue, outQue, procs]
+
+
+def Shutdown(queues:list):
+    """
+    Stop the processes started by Startup.
+    """
+    inQue, outQue, procs = queues
+    for p in procs:
+        inQue.put(None)
+    for p in procs:
+        p.join()
+
+    # Stop the reader thread of the output queue, if there is one.
+    with _lock:
+        reader = _readers.pop(id(outQue), None)
+    if reader:
+        outQue.put(None)
+        reader.join()
+
+
+# Request ids are unique within this process. One reader thread per output
+# queue takes every answer off the queue and files it under its request in
+# _pending; once all the answers of a request are in, the future its owner
+# is waiting on is resolved. Callers never block on the queue itself.
+_reqids = count(1)
+_pending = {}
+_readers = {}
+_lock = threading.Lock()
 
 
 def Dispatch(pgm:list, inque:Queue):
-    
+    """
+    Hand the steps of 'pgm' to the Indexers. Returns the ticket to pass to
+    Collect, Submit or CollectAsync.
+    """
+
     # Normally we should use threading for this work, but Python because of the lock
     # isn't really a good solution. INstead in Python we use processes.
-    for i in pgm:
-        inque.put(i)
+    reqid = (os.getpid(), next(_reqids))
+    sent = time.time()
+    for n, i in enumerate(pgm):
+        inque.put((reqid, n, tuple(i), sent))
+    return (reqid, len(pgm))
+
+
+def _request(reqid):
+    return _pending.setdefault(reqid, {'answers': [], 'nsteps': None, 'future': None, 'trace': None})
+
+
+def _settle(reqid, req:dict):
+    """
+    Resolve the future of a request once all of its answers are in. Called
+    with _lock held; returns the future, the answers to resolve it with and
+    the trace of the request.
+    """
+    if req['future'] is not None and len(req['answers']) == req['nsteps']:
+        del _pending[reqid]
+        return req['future'], req['answers'], req['trace']
+    return None, None, None
+
+
+def _resolve(future:Future, answers:list, nsteps:int, trace=None):
+    results = [None] * nsteps
+    errors = []
+    for _, stepno, name, n, err, stats in answers:
+        if err:
+            errors.append(err)
+            continue
+        with Tracing(trace):
+            Record(stats, n)
+        shm = SharedMemory(name=name)
+        try:
+            results[stepno] = array('Q')
+            results[stepno].frombytes(shm.buf[:n * 8])
+        finally:
+            shm.close()
+            shm.unlink()
+    if errors:
+        future.set_exception(exceptions.IndexError("; ".join(errors)))
+    else:
+        future.set_result(results)
+
 
+def _read(outque:Queue):
+    """
+    Body of the reader thread of 'outque'. Stops on a None answer.
+    """
+    while True:
+        msg = outque.get()
+        if msg is None:
+            break
+        with _lock:
+            req = _request(msg[0])
+            req['answers'].append(msg)
+            future, answers, trace = _settle(msg[0], req)
+        if future:
+            _resolve(future, answers, len(answers), trace)
+
+
+def Submit(ticket, outque:Queue):
+    """
+    Return a concurrent.futures.Future resolved with the results of a
+    dispatched program: a list of sorted array('Q') of record offsets, one
+    per step, in step order. A failed step sets exceptions.IndexError.
+    """
+    reqid, nsteps = ticket
+    future = Future()
+    if nsteps == 0:
+        future.set_result([])
+        return future
+    with _lock:
+        if id(outque) not in _readers:
+            t = threading.Thread(target=_read, args=(outque,), name='Collect', daemon=True)
+            _readers[id(outque)] = t
+            t.start()
+        req = _request(reqid)
+        req['nsteps'] = nsteps
+        req['future'] = future
+        req['trace'] = CurrentTrace()
+        done, answers, trace = _settle(reqid, req)
+    if done:
+        _resolve(done, answers, nsteps, trace)
+    return future
 
-def Complete(pgm:list, intermediate, inque:Queue):
+
+def Collect(ticket, outque:Queue):
+    """
+    Wait for every step of a dispatched program to finish.
+
+    Return:
+        list of sorted array('Q') of record offsets, one per step, in step order
+    """
+    return Submit(ticket, outque).result()
+
+
+async def CollectAsync(ticket, outque:Queue):
+    """
+    Collect for a coroutine: the event loop isn't blocked while the
+    Indexers work.
+    """
+    return await asyncio.wrap_future(Submit(ticket, outque))
+
+
+def _asarray(a):
+    if np is not None and isinstance(a, np.ndarray):
+        return array('Q', a.astype(np.uint64).tobytes())
+    return a
+
+
+def Intersect(a, b):
+    """
+    Return the sorted offsets in both of the sorted offset arrays 'a' and 'b'.
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    if not a:
+        return array('Q')
+    if np is not None:
+        return _asarray(np.intersect1d(np.frombuffer(a, dtype=np.uint64),
+                                       np.frombuffer(b, dtype=np.uint64), assume_unique=True))
+    if len(a) * 16 < len(b):
+        # Much smaller than the other, binary search each offset.
+        result = array('Q')
+        lo = 0
+        for x in a:
+            lo = bisect_left(b, x, lo)
+            if lo == len(b):
+                break
+            if b[lo] == x:
+                result.append(x)
+        return result
+    s = set(b)
+    return array('Q', [x for x in a if x in s])
+
+
+def Union(a, b):
+    """
+    Return the sorted offsets in either of the sorted offset arrays 'a' and 'b'.
+    """
+    if not a or not b:
+        return array('Q', a or b)
+    if np is not None:
+        return _asarray(np.union1d(np.frombuffer(a, dtype=np.uint64),
+                                   np.frombuffer(b, dtype=np.uint64)))
+    result = array('Q')
+    last = None
+    for x in heapq.merge(a, b):
+        if x != last:
+            result.append(x)
+            last = x
+    return result
+
+
+def Difference(a, b):
+    """
+    Return the sorted offsets in 'a' that are not in 'b', both sorted offset arrays.
+    """
+    if not a or not b:
+        return array('Q', a)
+    if np is not None:
+        return _asarray(np.setdiff1d(np.frombuffer(a, dtype=np.uint64),
+                                     np.frombuffer(b, dtype=np.uint64), assume_unique=True))
+    s = set(b)
+    return array('Q', [x for x in a if x not in s])
+
+
+_SETOPS = {'and': Intersect, 'or': Union, 'not': Difference}
+
+
+def Complete(pgm:list, intermediate, getsegment=None):
     """
     This is the final step of a string of programming steps. It takes the intermediate
     results and, per the pgm, processes them to produce the output.
+
+    The pgm is a list of instructions run against a stack:
+
+        ('push', n)      - push the offsets found by parallel step n
+        ('and',)         - replace the top two entries with their intersection
+        ('or',)          - replace the top two entries with their union
+        ('not',)         - replace the top two entries with the lower minus the top
+        ('fetch', table) - replace the offsets on top with the records they point
+                           at in 'table', read in offset order
+        ('columns', table, cols) - replace the offsets on top with a dict of
+                           column to the values of those records, read from
+                           the column files of 'table' alone
+        ('order', col, desc) - sort the records on top by column 'col'
+        ('limit', n)     - keep only the first 'n' offsets or records on top
+        ('project', cols) - keep only the columns 'cols' of the records on top
+        ('aggregate', timecol, width, [(function, column), ...])
+                         - replace the records or columns on top with the aggregates of
+                           their columns, per 'width' seconds of 'timecol' or
+                           over all of them if width is None
+
+    An empty pgm is the intersection of all the intermediate results. The
+    top of the stack is the result.
+
+    Input:
+                pgm - the common program
+       intermediate - list of sorted array('Q'), one per parallel step
+         getsegment - function mapping a table name to its Segment
+    """
+    if not pgm:
+        pgm = [('push', i) for i in range(len(intermediate))]
+        pgm += [('and',)] * (len(intermediate) - 1)
+    stack = []
+    for ins in pgm:
+        op = ins[0]
+        if op == 'push':
+            stack.append(intermediate[ins[1]])
+        elif op in _SETOPS:
+            b = stack.pop()
+            stack.append(_SETOPS[op](stack.pop(), b))
+        elif op == 'fetch':
+            stack.append(getsegment(ins[1]).records.read_many(stack.pop()))
+        elif op == 'columns':
+            stack.append(getsegment(ins[1]).read_columns(ins[2], stack.pop()))
+        elif op == 'order':
+            col = ins[1]
+            stack[-1] = sorted(stack[-1], key=lambda r: r[col], reverse=ins[2])
+        elif op == 'limit':
+            stack[-1] = stack[-1][:ins[1]]
+        elif op == 'aggregate':
+            timecol, width, aggs = ins[1:4]
+            recs = stack.pop()
+            if not isinstance(recs, dict):
+                recs = {col: [r[col] for r in recs] for col in {timecol} | {c for f, c in aggs} if col}
+            n = len(next(iter(recs.values()), []))
+            times = recs[timecol] if width else [None] * n
+            stats = {}
+            for func, col in aggs:
+                if col not in stats:
+                    stats[col] = Accumulate(times, recs[col], width)
+            stack.append(Results(stats, aggs, timecol if width else None))
+        elif op == 'project':
+            cols = ins[1]
+            stack[-1] = [{c: r[c] for c in cols} for r in stack[-1]]
+        else:
+            raise exceptions.IndexError("Instruction '%s' is invalid." % (op))
+    return stack[-1] if stack else array('Q')
+
+
+# Number of records Batches reads and hands out at a time.
+BATCHSIZE = 1024
+
+
+def Batches(pgm:list, intermediate, getsegment=None, size:int = BATCHSIZE):
+    """
+    Complete a program as a generator of lists of at most 'size' results.
+
+    When all that follows the 'fetch' of the program is 'limit' and
+    'project', the records are read 'size' offsets at a time and only the
+    batch being handed out is held in memory. Any other program (one that
+    orders or aggregates the records) has to see all of them first, so it
+    is completed and the result handed out in batches.
+
+    Input: see Complete
+             size - most results per batch
     """
-    inque.put([pgm, intermediate])
+    ops = [ins[0] for ins in pgm]
+    if 'fetch' in ops and set(ops[ops.index('fetch')+1:]) <= {'limit', 'project'}:
+        n = ops.index('fetch')
+        offsets = Complete(pgm[:n], intermediate)
+        store = getsegment(pgm[n][1]).records
+        post = []
+        for ins in pgm[n+1:]:
+            if ins[0] == 'limit':
+                # The records come back in offset order, so limiting them is
+                # limiting the offsets.
+                offsets = offsets[:ins[1]]
+            else:
+                post.append(ins)
+        for i in range(0, len(offsets), size):
+            yield Complete([('push', 0)] + post, [store.read_many(offsets[i:i+size])])
+        return
+    result = Complete(pgm, intermediate, getsegment)
+    for i in range(0, len(result), size):
+        yield result[i:i+size]
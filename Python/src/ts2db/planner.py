@@ -0,0 +1,282 @@
+"""
+Plan - decide how to run the parallel steps of a program.
+
+A program as compiled (see sql.py) names a step per predicate and combines
+their results with 'and', 'or' and 'not'. Run as is, every step is handed
+to the Indexers whatever it costs. Table._plan first runs it through Plan,
+which estimates from the table statistics (see stats.py) how many rows each
+step finds in the segments searched, and
+
+  - skips the steps that the statistics prove find nothing, or every row,
+    where that settles the set operation they are in: an 'and' with a step
+    finding nothing finds nothing, one with a step finding every row is its
+    other side, and so on. A NOT compiled as (every row) minus (step) under
+    an 'and' becomes the 'and' side minus the step;
+  - picks, for a range over a column that has column files, between the
+    index (a pass over its dictionary, then the postings of the values
+    found) and a scan of the column blocks the zone map allows (see
+    zones.py), whichever reads less;
+  - orders the steps, and the operands of each 'and', from the most
+    selective on;
+  - passes the candidates of the most selective step of the top level
+    'and' to the other steps of it, when checking those few records is
+    cheaper than running the step: the step is then not dispatched at all
+    but answered by the Composer from the candidates (see Table._resolve).
+
+The costs are in rough units of the time each kind of work takes per value
+or offset, measured in this implementation.
+"""
+from os.path import basename, dirname, join, splitext
+
+from stats import Estimate
+
+# Cost of a dictionary value tested by a range, of an offset expanded from
+# a postings list and sorted, of a value looked up in the hash tier, of a
+# value decoded by a column scan and of a candidate record read and checked.
+_PROBE = 1
+_POSTING = 3
+_LOOKUP = 50
+_SCAN = 20
+_FILTER = 100
+
+_SETOPS = {'push', 'and', 'or', 'not'}
+_RANGES = {'<', '<=', '>', '>=', 'between', 'range'}
+
+# Results of a subtree the statistics settle.
+_NONE = ('none',)
+
+
+def _parse(code:list):
+    """
+    Return the tree of the push and set instructions 'code', None if they
+    don't make a single tree. Leaves are ('step', n), nodes (op, left, right).
+    """
+    stack = []
+    for ins in code:
+        if ins[0] == 'push':
+            stack.append(('step', ins[1]))
+        elif len(stack) < 2:
+            return None
+        else:
+            b = stack.pop()
+            stack.append((ins[0], stack.pop(), b))
+    return stack[0] if len(stack) == 1 else None
+
+
+def _simplify(tree, proven:dict):
+    """
+    Drop from 'tree' what the steps proven to find nothing or every row
+    settle. Returns _NONE for a tree that finds nothing; a step proven to
+    find every row is ('all', step).
+    """
+    kind = tree[0]
+    if kind == 'step':
+        p = proven.get(tree[1])
+        return _NONE if p == 'none' else ('all', tree) if p == 'all' else tree
+    a = _simplify(tree[1], proven)
+    b = _simplify(tree[2], proven)
+    if kind == 'and':
+        if a is _NONE or b is _NONE:
+            return _NONE
+        if a[0] == 'all':
+            return b
+        if b[0] == 'all':
+            return a
+    elif kind == 'or':
+        if a is _NONE:
+            return b
+        if b is _NONE:
+            return a
+        if a[0] == 'all':
+            return a
+        if b[0] == 'all':
+            return b
+    elif kind == 'not':
+        if a is _NONE or b[0] == 'all':
+            return _NONE
+        if b is _NONE:
+            return a
+    return (kind, a, b)
+
+
+def _conjuncts(tree):
+    """
+    Return the (positive, negated) operands of the top level 'and' of 'tree'.
+    """
+    if tree[0] == 'and':
+        pa, na = _conjuncts(tree[1])
+        pb, nb = _conjuncts(tree[2])
+        return pa + pb, na + nb
+    if tree[0] == 'not':
+        pa, na = _conjuncts(tree[1])
+        return pa, na + [tree[2]]
+    return [tree], []
+
+
+def _leaves(tree, found:list):
+    if tree[0] == 'step':
+        found.append(tree[1])
+    elif tree[0] == 'all':
+        _leaves(tree[1], found)
+    else:
+        _leaves(tree[1], found)
+        _leaves(tree[2], found)
+    return found
+
+
+def _cost(path:str, cmp:str, value, rows:float, stats:dict):
+    """
+    Return the cost of running a step finding about 'rows' rows against the
+    index of 'path' in a segment whose column has the statistics 'stats'.
+    """
+    if path.endswith('.ord'):
+        return _LOOKUP + rows * _POSTING
+    if cmp == '=':
+        return _LOOKUP + rows * _POSTING
+    if cmp == 'in':
+        return _LOOKUP * len(value) + rows * _POSTING
+    return (stats.get('distinct') or 0) * _PROBE + rows * _POSTING
+
+
+def Plan(ppgm:list, common:list, segs:list, segstats:list, cols:dict):
+    """
+    Plan the steps of a program against the segments it searches.
+
+    Input:
+          ppgm - the parallel steps, see pgm.py
+        common - the common program
+          segs - [(bucket start, Segment)] searched
+      segstats - the statistics of each of 'segs', see Statistics.get, with
+                 'removed' set if rows were deleted from the segment since
+                 the snapshot the program reads: the statistics no longer
+                 count rows it still sees, so they can't prove it finds none
+          cols - dict of column name to type
+
+    Return:
+        (ppgm, common, deferred, notes)
+          ppgm, common - the program to run, which finds the same rows
+              deferred - dict of step number to (number of the step whose
+                         result is the candidates, [most candidates, per
+                         segment, for which checking them beats running it])
+                 notes - a dict per step of the program given: its 'index',
+                         'predicate', estimated 'rows', the 'method' chosen
+                         ('probe', 'scan', 'filter' or 'skipped') and the
+                         'step' it became
+    """
+    if not ppgm:
+        return ppgm, common, {}, []
+    ops = [n for n, ins in enumerate(common) if ins[0] in _SETOPS]
+    if ops:
+        start = ops[0]
+        end = start
+        while end < len(common) and common[end][0] in _SETOPS:
+            end += 1
+        code = common[start:end]
+    else:
+        # An empty program is the 'and' of every step.
+        if common:
+            return ppgm, common, {}, []
+        start = end = 0
+        code = [('push', 0)] + [ins for n in range(1, len(ppgm)) for ins in (('push', n), ('and',))]
+    tree = _parse(code)
+    if tree is None or any(ins[1] >= len(ppgm) for ins in code if ins[0] == 'push'):
+        return ppgm, common, {}, []
+
+    # Estimate every step in every segment.
+    rows, proven, costs, scans = [], {}, [], []
+    for n, (path, (cmp, value), op) in enumerate(ppgm):
+        col, suffix = splitext(basename(path))
+        coltype = cols.get(col)
+        found, probe, scan, kinds = 0, [], [], set()
+        for (k, seg), stats in zip(segs, segstats):
+            if coltype is None:
+                r, p = stats['rows'], None
+            else:
+                r, p = Estimate(stats, col, coltype, cmp, value)
+            if stats.get('removed'):
+                if p == 'none':
+                    p = None
+                kinds.add(p)
+            elif stats['rows']:
+                kinds.add(p)
+            found += r
+            c = _cost(path, cmp, value, r, stats['columns'].get(col, {}))
+            probe.append(c)
+            read = None
+            # A scan decodes at least the values it finds.
+            if suffix == '.idx' and cmp in _RANGES and coltype is not None and r * _SCAN < c:
+                read = seg.blockrows(col, cmp, value)
+            scan.append(c if read is None else read * _SCAN)
+        if kinds <= {'none'}:
+            proven[n] = 'none'
+        elif kinds == {'all'}:
+            proven[n] = 'all'
+        rows.append(found)
+        costs.append(probe)
+        scans.append(scan)
+
+    tree = _simplify(tree, proven)
+    notes = [{'index': basename(path), 'predicate': list(pred), 'rows': round(rows[n]),
+              'method': 'skipped'} for n, (path, pred, op) in enumerate(ppgm)]
+    if tree is _NONE:
+        # Nothing is found: one step that finds nothing stands for them all.
+        path = ppgm[0][0]
+        path = join(dirname(path), splitext(basename(path))[0] + '.idx')
+        return ([(path, ('in', []), 'search')], common[:start] + [('push', 0)] + common[end:],
+                {}, notes)
+    if tree[0] == 'all':
+        tree = tree[1]
+
+    # The top level 'and': drop the operands finding every row, then the
+    # most selective first.
+    total = lambda t: sum(rows[n] for n in _leaves(t, []))
+    positive, negated = _conjuncts(tree)
+    kept = [t for t in positive if t[0] != 'all']
+    positive = sorted(kept, key=total) if kept else positive[:1]
+    positive = [t[1] if t[0] == 'all' else t for t in positive]
+    negated = sorted(negated, key=total)
+
+    # Number the steps kept, the most selective first.
+    leaves = []
+    for t in positive + negated:
+        _leaves(t, leaves)
+    order = sorted(dict.fromkeys(leaves), key=lambda n: rows[n])
+    number = {n: i for i, n in enumerate(order)}
+
+    def emit(t):
+        if t[0] == 'all':
+            t = t[1]
+        if t[0] == 'step':
+            return [('push', number[t[1]])]
+        return emit(t[1]) + emit(t[2]) + [(t[0],)]
+
+    code = emit(positive[0])
+    for t in positive[1:]:
+        code += emit(t) + [('and',)]
+    for t in negated:
+        code += emit(t) + [('not',)]
+
+    newppgm = []
+    for n in order:
+        path, pred, op = ppgm[n]
+        method = 'probe'
+        if sum(scans[n]) < sum(costs[n]):
+            path = join(dirname(path), splitext(basename(path))[0] + '.col')
+            method = 'scan'
+            costs[n] = scans[n]
+        newppgm.append((path, pred, op))
+        notes[n].update({'method': method, 'step': number[n]})
+
+    # Steps of the top level 'and' that only appear there can be answered
+    # from the candidates of its most selective step.
+    deferred = {}
+    if positive[0][0] == 'step':
+        driver = positive[0][1]
+        for t in positive[1:] + negated:
+            if t[0] != 'step' or leaves.count(t[1]) != 1:
+                continue
+            n = t[1]
+            if rows[driver] * _FILTER < sum(costs[n]):
+                deferred[number[n]] = (number[driver], [c / _FILTER for c in costs[n]])
+                notes[n]['method'] = 'filter'
+    return newppgm, common[:start] + code + common[end:], deferred, notes
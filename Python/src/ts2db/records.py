@@ -0,0 +1,237 @@
+"""
+class RecordStore - the file holding the complete records of a table.
+
+The record store (records.dat) is append only. Every record is written as
+a self contained frame, so a record can be read back knowing nothing but
+its 64-bit file offset (which is what the index files hold), and appending
+never touches anything already written.
+
+The layout of the file is:
+
+    <file header>  - 'TS2R', version and default codec, 8 bytes
+    <frame>        - repeated, one per record
+
+and each frame is:
+
+    <payload length>  - 32 bits
+    <payload crc32>   - 32 bits, of the payload as stored
+    <codec>           - 8 bits, how the payload is compressed
+    <payload>         - the record in JSON, possibly compressed
+
+Small records are stored uncompressed; compressing them costs more than
+it saves. The codecs, and the levels they can be used at, are in codec.py.
+"""
+from os.path import exists
+import json
+import os
+import struct
+import time
+import zlib
+
+from codec import Parse, Decompress, CODECS
+import exceptions
+from metrics import metrics
+
+_HDR = struct.Struct('<4sHH')
+_MAGIC = b'TS2R'
+_VERSION = 1
+HDRSIZE = _HDR.size
+
+_FRAME = struct.Struct('<IIB')
+_ENCODER = json.JSONEncoder(separators=(',', ':'))
+
+# Payloads shorter than this are never compressed.
+_MINCOMPRESS = 128
+
+# read_many reads records closer together than _READGAP with a single read,
+# reading _READAHEAD bytes beyond the last one of the run.
+_READGAP = 65536
+_READAHEAD = 4096
+
+
+class RecordStore:
+    """
+    Append records to, and read records from, a record store.
+
+    Methods:
+
+    RecordStore(path, codec) - open (or create) the record store, 'codec' is
+                               a codec.py spec such as 'zlib:6' 
+               append(record) - append one record, returns its offset
+        append_many(records) - append many records in one write, returns the offsets
+                 read(offset) - return the record at 'offset'
+         read_many(offsets) - return the records at 'offsets', in offset order
+                       scan() - iterate over (offset, record) of the whole store
+                 flush(sync) - push written data to the disk
+                      close() - close the store
+
+    Attributes:
+
+      path - file path of the record store
+     codec - codec spec used on new frames
+      size - bytes in the store, which is also the offset of the next record
+     empty - True if no record was ever written
+    """
+
+    def __init__(self, path:str, codec:str = 'none'):
+        name, level = Parse(codec)
+        self._path = path
+        self._codec = codec
+        self._cid = CODECS[name][0]
+        self._compress = CODECS[name][1]
+        self._level = level
+        if not exists(path):
+            with open(path, 'wb') as fp:
+                fp.write(_HDR.pack(_MAGIC, _VERSION, self._cid))
+        self._fd = os.open(path, os.O_RDWR)
+        hdr = os.pread(self._fd, HDRSIZE, 0)
+        if len(hdr) != HDRSIZE or _HDR.unpack(hdr)[0] != _MAGIC:
+            self.close()
+            raise exceptions.TableError("'%s' is not a record store." % (path))
+        self._end = os.fstat(self._fd).st_size
+
+    def get_path(self):
+        return self._path
+    path = property(get_path)
+
+    def get_codec(self):
+        return self._codec
+    codec = property(get_codec)
+
+    def get_size(self):
+        return self._end
+    size = property(get_size)
+
+    def get_empty(self):
+        return self._end == HDRSIZE
+    empty = property(get_empty)
+
+    def _frame(self, record:dict):
+        payload = _ENCODER.encode(record).encode('utf-8')
+        cid, compress = self._cid, self._compress
+        if compress and len(payload) >= _MINCOMPRESS:
+            packed = compress(payload, self._level)
+            if len(packed) < len(payload):
+                payload = packed
+            else:
+                cid = 0
+        else:
+            cid = 0
+        return _FRAME.pack(len(payload), zlib.crc32(payload), cid) + payload
+
+    def append(self, record:dict):
+        """
+        Append a single record. Returns the offset of the record.
+        """
+        return self.append_many([record])[0]
+
+    def append_many(self, records:list):
+        """
+        Append 'records' with a single write.
+
+        Return:
+            list of the offsets of the records, in the order given
+        """
+        offsets = []
+        frames = []
+        pos = self._end
+        with metrics.stage('encode', {'records': len(records)}):
+            for r in records:
+                f = self._frame(r)
+                offsets.append(pos)
+                frames.append(f)
+                pos += len(f)
+        os.pwrite(self._fd, b''.join(frames), self._end)
+        self._end = pos
+        return offsets
+
+    def _decode(self, offset:int, hdr:bytes, payload:bytes, codec:list|None = None):
+        """
+        Check and decode a frame, adding the seconds spent decompressing it
+        to codec[0] if 'codec' is given.
+        """
+        n, crc, cid = _FRAME.unpack(hdr)
+        if len(payload) != n or zlib.crc32(payload) != crc:
+            raise exceptions.TableError("Record at %d in '%s' is damaged." % (offset, self._path))
+        if cid:
+            if codec is None:
+                payload = Decompress(cid, payload)
+            else:
+                start = time.perf_counter()
+                payload = Decompress(cid, payload)
+                codec[0] += time.perf_counter() - start
+        return json.loads(payload)
+
+    def read(self, offset:int):
+        """
+        Return the record stored at 'offset'.
+        """
+        if offset < HDRSIZE or offset >= self._end:
+            raise exceptions.TableError("No record at %d in '%s'." % (offset, self._path))
+        hdr = os.pread(self._fd, _FRAME.size, offset)
+        n = _FRAME.unpack(hdr)[0]
+        return self._decode(offset, hdr, os.pread(self._fd, n, offset + _FRAME.size))
+
+    def read_many(self, offsets):
+        """
+        Return the records at 'offsets'. The offsets are sorted first so the
+        file is read front to back, and records near each other are read
+        together with one read.
+        """
+        offsets = sorted(offsets)
+        if offsets and (offsets[0] < HDRSIZE or offsets[-1] >= self._end):
+            raise exceptions.TableError("Offsets out of range in '%s'." % (self._path))
+        result = []
+        began = time.perf_counter()
+        nbytes = 0
+        codec = [0.0]
+        i = 0
+        while i < len(offsets):
+            j = i + 1
+            while j < len(offsets) and offsets[j] - offsets[j-1] <= _READGAP:
+                j += 1
+            start = offsets[i]
+            buf = os.pread(self._fd, offsets[j-1] - start + _READAHEAD, start)
+            nbytes += len(buf)
+            for o in offsets[i:j]:
+                p = o - start
+                hdr = buf[p:p + _FRAME.size]
+                n = _FRAME.unpack(hdr)[0] if len(hdr) == _FRAME.size else -1
+                payload = buf[p + _FRAME.size:p + _FRAME.size + n]
+                if n < 0 or len(payload) < n:
+                    # The last record of the run goes past what was read.
+                    result.append(self.read(o))
+                else:
+                    result.append(self._decode(o, hdr, payload, codec))
+            i = j
+        metrics.observe('fetch', time.perf_counter() - began, {'records': len(result), 'bytes': nbytes})
+        metrics.count('fetch_records', len(result))
+        metrics.count('fetch_bytes', nbytes)
+        if codec[0]:
+            metrics.observe('codec', codec[0], {'records': len(result)})
+        return result
+
+    def scan(self):
+        """
+        Iterate over every record in the store, yielding (offset, record).
+        """
+        with open(self._path, 'rb') as fp:
+            fp.seek(HDRSIZE)
+            pos = HDRSIZE
+            while pos < self._end:
+                hdr = fp.read(_FRAME.size)
+                payload = fp.read(_FRAME.unpack(hdr)[0])
+                yield pos, self._decode(pos, hdr, payload)
+                pos += _FRAME.size + len(payload)
+
+    def flush(self, sync:bool = True):
+        """
+        Make everything appended so far durable.
+        """
+        if sync:
+            os.fsync(self._fd)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
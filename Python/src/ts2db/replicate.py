@@ -0,0 +1,249 @@
+"""
+Replicator     - ship the change feed of a table to a sink, in batches.
+DirectorySink  - a sink keeping the batches as files in a directory.
+SQLiteSink     - a sink keeping the batches in a SQLite database.
+ReadBatch      - the changes of a batch.
+
+An edge device keeps its tables with the 'feed' option (see feed.py) and
+runs a Replicator per table, which reads the changes past its cursor, packs
+up to 'batchbytes' of them into one batch compressed with a codec.py codec,
+hands it to its sink and only then moves its cursor on. Rows aren't sent one
+at a time: while the sink keeps up, the changes of 'interval' seconds go in
+a batch; once it falls behind, every batch is as large as allowed, so a slow
+link sends fewer, larger, better compressed batches. Should it fall behind
+by more than the 'feedlag' of the table, the writers to the table wait for
+it, see Table._throttle.
+
+A sink is anything with
+
+    send(table, first, last, data) - keep batch 'data' of the changes
+                                     'first' to 'last' of table 'table',
+                                     raising OSError if it can't
+              position(table) - the 'last' of the last batch kept, 0 if none
+
+A batch is sent again if the Replicator stops between the sink keeping it
+and the cursor moving on; the sink is asked for its position when the
+Replicator starts, so the batch isn't sent twice, and the sinks here keep a
+batch sent again once. A sink that fails is tried again after a wait that
+doubles each time, up to BACKOFF seconds.
+
+A batch is the changes, one JSON list [seq, change] per line, compressed.
+"""
+from os.path import join, exists
+from os import listdir
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from codec import Compress, Unpack, Parse
+from feed import feeds
+from metrics import metrics
+
+# Bytes of changes in a batch, and the longest wait before a failed sink is
+# tried again, in seconds.
+BATCHBYTES = 1 << 22
+BACKOFF = 300
+
+
+def ReadBatch(data:bytes):
+    """
+    Return the [(seq, change)] of a batch, see Replicator.
+    """
+    return [tuple(json.loads(line)) for line in Unpack(data).split(b'\n') if line]
+
+
+class DirectorySink:
+    """
+    Keep batches as files, <path>/<table>/<first>-<last>.batch. A file is
+    written in full and synced before it is given its name.
+
+    Methods:
+
+          DirectorySink(path) - keep the batches under directory 'path'
+    send(table, first, last, data) - keep a batch
+              position(table) - 'last' of the last batch of 'table' kept
+        batches(table, after) - iterate (first, last, data) of the batches
+                                of 'table' past change 'after'
+                      close() - nothing to do
+
+    Attributes:
+
+        path - directory of the batches
+    """
+
+    def __init__(self, path:str):
+        self._path = path
+        if not exists(path):
+            os.makedirs(path)
+
+    def get_path(self):
+        return self._path
+    path = property(get_path)
+
+    def _ranges(self, table:str):
+        path = join(self._path, table)
+        if not exists(path):
+            return []
+        return sorted(tuple(int(n) for n in f[:-len('.batch')].split('-'))
+                      for f in listdir(path) if f.endswith('.batch'))
+
+    def send(self, table:str, first:int, last:int, data:bytes):
+        path = join(self._path, table)
+        if not exists(path):
+            os.makedirs(path)
+        name = join(path, '%020d-%020d.batch' % (first, last))
+        with open(name + '.tmp', 'wb') as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(name + '.tmp', name)
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def position(self, table:str):
+        ranges = self._ranges(table)
+        return ranges[-1][1] if ranges else 0
+
+    def batches(self, table:str, after:int = 0):
+        for first, last in self._ranges(table):
+            if last > after:
+                with open(join(self._path, table, '%020d-%020d.batch' % (first, last)), 'rb') as fp:
+                    yield first, last, fp.read()
+
+    def close(self):
+        pass
+
+
+class SQLiteSink:
+    """
+    Keep batches in table 'batches' of a SQLite database, a stand in for a
+    department or enterprise server.
+
+    Methods:
+
+             SQLiteSink(path) - keep the batches in SQLite database 'path'
+    send(table, first, last, data) - keep a batch
+              position(table) - 'last' of the last batch of 'table' kept
+        batches(table, after) - iterate (first, last, data) of the batches
+                                of 'table' past change 'after'
+                      close() - close the database
+    """
+
+    def __init__(self, path:str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS batches '
+                         '(tbl TEXT, first INTEGER, last INTEGER, data BLOB, PRIMARY KEY (tbl, last))')
+        self._db.commit()
+
+    def send(self, table:str, first:int, last:int, data:bytes):
+        try:
+            with self._lock, self._db:
+                self._db.execute('INSERT OR IGNORE INTO batches VALUES (?, ?, ?, ?)', (table, first, last, data))
+        except sqlite3.Error as e:
+            raise OSError(str(e))
+
+    def position(self, table:str):
+        with self._lock:
+            row = self._db.execute('SELECT MAX(last) FROM batches WHERE tbl = ?', (table,)).fetchone()
+        return row[0] or 0
+
+    def batches(self, table:str, after:int = 0):
+        with self._lock:
+            rows = self._db.execute('SELECT first, last, data FROM batches WHERE tbl = ? AND last > ? '
+                                    'ORDER BY last', (table, after)).fetchall()
+        for first, last, data in rows:
+            yield first, last, bytes(data)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class Replicator(threading.Thread):
+    """
+    Background thread shipping the change feed of a table to a sink.
+
+    Methods:
+    Replicator(table, name, sink, cursor, interval, batchbytes, codec)
+                    - make the thread for table 'name' of Table 'table',
+                      reading the feed with cursor 'cursor'; start() runs it
+             ship() - send the next batch, if there is one
+             stop() - stop the thread and wait for it
+
+    Attributes:
+       table - name of the table replicated
+        sink - where the batches go
+    """
+    def __init__(self, table, name:str, sink, cursor:str = 'replica', interval:float = 1,
+                 batchbytes:int = BATCHBYTES, codec:str = 'zlib:6'):
+        super().__init__(name='Replicator', daemon=True)
+        Parse(codec)
+        self._table = name
+        self._sink = sink
+        self._cursor = cursor
+        self._interval = interval
+        self._batchbytes = batchbytes
+        self._codec = codec
+        self._feed = feeds.get(table.db.path, name)
+        self._done = threading.Event()
+        # Carry on from the last batch the sink kept, even if the cursor
+        # wasn't moved past it. A new cursor is made at once, so the changes
+        # it hasn't read yet are kept for it from now on.
+        self._feed.commit(cursor, max(sink.position(name), self._feed.cursor(cursor)))
+
+    def get_table(self):
+        return self._table
+    table = property(get_table)
+
+    def get_sink(self):
+        return self._sink
+    sink = property(get_sink)
+
+    def ship(self):
+        """
+        Send the changes past the cursor, up to 'batchbytes' of them, to the
+        sink as one batch and move the cursor past them.
+
+        Return:
+            seq of the last change sent, None if there was nothing to send
+
+        Exceptions:
+            OSError - the sink couldn't take the batch
+        """
+        changes = self._feed.read(self._feed.cursor(self._cursor), self._batchbytes)
+        if not changes:
+            return None
+        lines = [json.dumps([seq, change], separators=(',', ':')).encode('utf-8') for seq, change in changes]
+        data = Compress(b'\n'.join(lines), self._codec)
+        first, last = changes[0][0], changes[-1][0]
+        self._sink.send(self._table, first, last, data)
+        self._feed.commit(self._cursor, last)
+        metrics.count('feed_batches')
+        metrics.count('feed_changes', len(changes))
+        metrics.count('feed_bytes', len(data))
+        return last
+
+    def run(self):
+        delay = 0
+        failures = 0
+        while not self._done.wait(delay):
+            try:
+                last = self.ship()
+            except OSError as e:
+                failures += 1
+                delay = min(self._interval * 2 ** failures, BACKOFF)
+                logging.warning("Replicating '%s' failed, trying again in %gs: %s", self._table, delay, e)
+                continue
+            failures = 0
+            # Behind: send the next batch at once.
+            delay = 0 if last is not None and last < self._feed.seq else self._interval
+
+    def stop(self):
+        self._done.set()
+        self.join()
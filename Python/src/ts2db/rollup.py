@@ -0,0 +1,237 @@
+"""
+class Rollup - count/sum/min/max of a numeric column per fixed time bucket.
+
+The rollups of a table are declared with the 'rollups' table option, a
+dict of column name to the granularities kept for it:
+
+    {'rollups': {'temp': ['minute', 'hour']}}
+
+Each (column, granularity) pair is one file in the table directory,
+<col>.<seconds>.rollup, kept up to date as rows are inserted:
+
+    <header>   - 'TS2U', version, bucket width, first bucket, 24 bytes
+    <slot>     - repeated, one per bucket from the first bucket on:
+                 <count> <sum> <min> <max>, 32 bytes
+
+A bucket that never saw a row has a count of 0. Since the slots are dense
+the slot of a time is found by arithmetic, and a range of buckets is read
+with a single read.
+
+The aggregate functions of a query are computed from the same per bucket
+statistics whether they come from a rollup file or from the raw records,
+see Accumulate and Results.
+"""
+from os.path import exists
+import os
+import struct
+
+import exceptions
+
+GRANULARITY = {'minute': 60, 'hour': 3600, 'day': 86400}
+
+FUNCTIONS = ('count', 'sum', 'min', 'max', 'avg')
+
+_HDR = struct.Struct('<4sHxxQq')
+_MAGIC = b'TS2U'
+_VERSION = 1
+_SLOT = struct.Struct('<Qddd')
+
+# 'base' of a rollup that has no data yet.
+_NOBASE = -(1 << 63)
+
+
+def Accumulate(times, values, width:int|None, stats:dict|None = None):
+    """
+    Add 'values' at 'times' into per bucket statistics.
+
+    Input:
+        times - time of each value, in seconds
+       values - the values
+        width - bucket width in seconds, None for a single bucket keyed None
+        stats - statistics to add to, a new dict if None
+
+    Return:
+        dict of bucket start to [count, sum, min, max]
+    """
+    if stats is None:
+        stats = {}
+    for t, v in zip(times, values):
+        b = t - t % width if width else None
+        s = stats.get(b)
+        if s is None:
+            stats[b] = [1, v, v, v]
+        else:
+            s[0] += 1
+            s[1] += v
+            if v < s[2]:
+                s[2] = v
+            if v > s[3]:
+                s[3] = v
+    return stats
+
+
+def Combine(a:list, b:list):
+    """
+    Fold the bucket statistics 'b' into 'a'.
+    """
+    if a[0] == 0:
+        a[:] = b
+    elif b[0]:
+        a[0] += b[0]
+        a[1] += b[1]
+        a[2] = min(a[2], b[2])
+        a[3] = max(a[3], b[3])
+
+
+def Results(stats:dict, aggs:list, timecol:str|None):
+    """
+    Turn per column bucket statistics into result rows.
+
+    Input:
+        stats - dict of column to the dict returned by Accumulate
+         aggs - list of (function, column)
+      timecol - name given to the bucket start, None if not grouped by time
+
+    Return:
+        list of dicts, one per bucket, in time order
+    """
+    buckets = set()
+    for s in stats.values():
+        buckets.update(s)
+    if not timecol and not buckets:
+        # Aggregates over nothing are still one row.
+        buckets.add(None)
+    rows = []
+    for b in sorted(buckets, key=lambda b: b or 0):
+        row = {timecol: b} if timecol else {}
+        for func, col in aggs:
+            c, total, low, high = stats.get(col, {}).get(b, (0, 0, None, None))
+            if func == 'count':
+                row['count(%s)' % col] = c
+            elif func == 'sum':
+                row['sum(%s)' % col] = float(total)
+            elif func == 'avg':
+                row['avg(%s)' % col] = total / c if c else None
+            else:
+                # Rollups keep doubles, so the raw records answer in kind.
+                v = low if func == 'min' else high
+                row['%s(%s)' % (func, col)] = None if v is None else float(v)
+        rows.append(row)
+    return rows
+
+
+class Rollup:
+    """
+    One rollup file.
+
+    Methods:
+
+        Rollup(path, width) - open (or create) the rollup file with 'width' second buckets
+    update(times, values) - add values to the buckets of their times
+    query(low, high, width) - statistics of the buckets in [low, high)
+        reset(low, high) - empty the buckets in [low, high)
+                  flush() - make the file durable
+                  close() - close the file
+
+    Attributes:
+
+       width - bucket width of the file, in seconds
+    """
+
+    def __init__(self, path:str, width:int):
+        self._path = path
+        if not exists(path):
+            with open(path, 'wb') as fp:
+                fp.write(_HDR.pack(_MAGIC, _VERSION, width, _NOBASE))
+        self._fd = os.open(path, os.O_RDWR)
+        magic, version, self._width, self._base = _HDR.unpack(os.pread(self._fd, _HDR.size, 0))
+        if magic != _MAGIC or self._width != width:
+            self.close()
+            raise exceptions.TableError("'%s' is not a %d second rollup." % (path, width))
+
+    def get_width(self):
+        return self._width
+    width = property(get_width)
+
+    def _nslots(self):
+        return (os.fstat(self._fd).st_size - _HDR.size) // _SLOT.size
+
+    def _read(self, first:int, n:int):
+        data = os.pread(self._fd, n * _SLOT.size, _HDR.size + first * _SLOT.size)
+        slots = [list(s) for s in _SLOT.iter_unpack(data)]
+        return slots + [[0, 0.0, 0.0, 0.0] for i in range(n - len(slots))]
+
+    def _rebase(self, base:int):
+        """
+        Move the first bucket back to 'base', shifting every slot up.
+        """
+        data = b''
+        if self._base != _NOBASE:
+            n = self._nslots()
+            shift = (self._base - base) // self._width
+            data = bytes(shift * _SLOT.size) + os.pread(self._fd, n * _SLOT.size, _HDR.size)
+        os.pwrite(self._fd, _HDR.pack(_MAGIC, _VERSION, self._width, base) + data, 0)
+        self._base = base
+
+    def update(self, times, values):
+        """
+        Add 'values' at 'times' to the rollup, reading and writing the
+        range of slots touched once.
+        """
+        stats = Accumulate(times, values, self._width)
+        if not stats:
+            return
+        low, high = min(stats), max(stats)
+        if self._base == _NOBASE or low < self._base:
+            self._rebase(low)
+        first = (low - self._base) // self._width
+        slots = self._read(first, (high - low) // self._width + 1)
+        for b, s in stats.items():
+            Combine(slots[(b - low) // self._width], s)
+        os.pwrite(self._fd, b''.join(_SLOT.pack(*s) for s in slots),
+                  _HDR.size + first * _SLOT.size)
+
+    def reset(self, low:int, high:int):
+        """
+        Empty the buckets in [low, high), for them to be computed again.
+        """
+        if self._base == _NOBASE:
+            return
+        first = max(0, (low - self._base) // self._width)
+        last = min(self._nslots(), (high - self._base) // self._width)
+        if last > first:
+            os.pwrite(self._fd, _SLOT.pack(0, 0.0, 0.0, 0.0) * (last - first),
+                      _HDR.size + first * _SLOT.size)
+
+    def query(self, low:int|None, high:int|None, width:int|None):
+        """
+        Return the statistics of the buckets in [low, high), either bound
+        may be None, combined into buckets of 'width' seconds (a multiple of
+        the width of the file) or into a single bucket keyed None.
+        """
+        if self._base == _NOBASE:
+            return {}
+        n = self._nslots()
+        first = 0 if low is None else max(0, (low - self._base) // self._width)
+        last = n if high is None else min(n, (high - self._base) // self._width)
+        stats = {}
+        if last <= first:
+            return stats
+        for i, s in enumerate(self._read(first, last - first)):
+            if s[0] == 0:
+                continue
+            t = self._base + (first + i) * self._width
+            b = t - t % width if width else None
+            if b in stats:
+                Combine(stats[b], s)
+            else:
+                stats[b] = s
+        return stats
+
+    def flush(self):
+        os.fsync(self._fd)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
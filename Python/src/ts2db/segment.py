@@ -0,0 +1,528 @@
+"""
+class Segment - a record store plus one index file per column.
+
+A table without partitioning is a single segment, the table directory
+itself. A table partitioned by time (the 'partition' and 'timecol' table
+options) has one segment directory per time bucket, named by the start of
+the bucket in seconds:
+
+    <table>/info.json.bz2
+    <table>/<bucket start>/records.dat
+    <table>/<bucket start>/XXXXX.idx
+    <table>/<bucket start>/XXXXX.col
+    <table>/<bucket start>/_offsets.col
+    <table>/<bucket start>/zones.dat
+    <table>/<bucket start>/deleted.dat
+    <table>/<bucket start>/segment.json
+
+segment.json holds the bounds of the bucket plus the smallest and largest
+time actually stored and the number of rows, so a time range query can skip
+a segment without opening it, and old data is dropped by removing the
+directory. It is rewritten on every insert and so, unlike the other table
+files, kept as plain JSON, and like them only made durable at a checkpoint.
+
+The .col files hold the values of each column in record order, see
+columns.py, so aggregating a column doesn't read the records. zones.dat
+holds the smallest and largest value, or a Bloom filter, of each column in
+each block of the .col files, so a scan only decodes the blocks that may
+match, see zones.py. deleted.dat, made by the first delete, holds the
+offsets of the records deleted, see tombstones.py.
+"""
+from os.path import join, exists
+from os import mkdir
+from array import array
+from bisect import bisect_left, bisect_right
+import json
+import os
+
+from columns import ColumnFile, OFFSETS
+from index import Index
+from ordered import OrderedIndex
+from records import RecordStore
+from tombstones import Tombstones, DELETED
+from zones import ZoneMap, Scan, ZONES
+
+# Width of each bucket, in seconds.
+BUCKETS = {'hour': 3600, 'day': 86400}
+
+
+def Bucket(partition:str, ts:int):
+    """
+    Return the start of the 'partition' bucket holding time 'ts'.
+    """
+    width = BUCKETS[partition]
+    return ts - ts % width
+
+
+def MakeSegment(path:str, cols:dict, opts:dict, start:int|None = None, ordered:list = ()):
+    """
+    Create the files of an empty segment in directory 'path'. 'start' is the
+    start of the bucket the segment holds, None if the table isn't partitioned.
+    'ordered' are the columns that also get an ordered index.
+    """
+    if not exists(path):
+        mkdir(path)
+    end = start + BUCKETS[opts['partition']] if start is not None else None
+    _writemeta(path, {'start': start, 'end': end, 'mints': None, 'maxts': None, 'rows': 0})
+
+    """
+    This is a file that contains the unique complete records stored in the table.
+    The format is one record following another, each in its own frame so it can
+    be read back from its offset alone (see records.py). Each record looks like this
+
+    <size of record><crc><codec>
+    <record, in JSON format, compressed with the codec>
+    """
+    # There's nothing yet recorded in the file.
+    RecordStore(join(path, "records.dat"), opts.get('codec', 'none')).close()
+
+    """
+    There is one index file for each index that is defined. Each of the index files are composed
+    of two tiers. The first tier maps the actual record field to an index (32-bit number). The
+    second tier of the file takes the numeric index and maps it to one or more record pointers.
+    The record pointers are 64 bit offsets into a records file, and point to a JSON representation
+    of the record. This second tier is real a B-Tree with the key being the index value from
+    the first tier.
+    """
+    for i, coltype in cols.items():
+        # Preallocate the index files to their initial size. We do this to make certain that
+        # we can map each index file into the memory map; they grow as they fill (see index.py).
+        ipath = join(path, i+'.idx')
+        with open(ipath,'wb') as fp:
+            fp.truncate(opts['idxsize'])
+
+        # Lay out the empty two tiers.
+        Index(ipath, coltype).close()
+
+        # The values of the column, in record order.
+        ColumnFile(join(path, i+'.col'), coltype).close()
+    ColumnFile(join(path, OFFSETS+'.col'), 'offset').close()
+    ZoneMap(join(path, ZONES)).close()
+
+    # Range predicates on the ordered columns are answered from sorted runs
+    # of their values (see ordered.py).
+    for i in ordered:
+        OrderedIndex(join(path, i+'.ord'), cols[i]).close()
+
+
+def _writemeta(path:str, meta:dict, durable:bool = False):
+    tmp = join(path, 'segment.json.tmp')
+    with open(tmp, 'wb') as fp:
+        fp.write(json.dumps(meta).encode('utf-8'))
+        if durable:
+            fp.flush()
+            os.fsync(fp.fileno())
+    os.replace(tmp, join(path, 'segment.json'))
+    if durable:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class Segment:
+    """
+    Open segment of a table.
+
+    Methods:
+
+    Segment(path, cols, opts) - open the segment in directory 'path'
+                 append(rows) - append rows to the records, the indices and the columns
+    read_columns(cols, offsets) - the values of columns 'cols' of the records at 'offsets'
+    scan(col, cmp, value, test) - the record offsets whose 'col' satisfies the predicate,
+                                  read from the column blocks the zone map allows
+    blockrows(col, cmp, value) - the values such a scan would decode
+    filter(col, offsets, test) - those of the 'offsets' whose record's 'col' passes 'test'
+              delete(offsets) - delete the records at 'offsets'
+                reclaim(upto) - drop the index pointers of the records deleted
+                                before delete 'upto'
+                reserve(rows) - make room in the indices to append 'rows'
+                compact(ratio) - rebuild the indices with tombstones over 'ratio'
+                      state() - what rollback needs to undo later appends
+              rollback(state) - undo everything appended since 'state' was taken
+         overlaps(low, high) - can the segment hold times in [low, high]
+                       sync() - make the records, indices, columns and metadata durable
+                      close() - close the files
+
+    Attributes:
+
+        path - directory of the segment
+     records - the RecordStore, opened on first use
+     indices - dict of column name to Index, opened on first use
+     columns - dict of column name to ColumnFile, opened on first use, None
+               for a segment made before columns were kept
+     ordered - dict of column name to OrderedIndex of the ordered columns,
+               opened on first use
+       zones - the ZoneMap of the column blocks, opened on first use, None
+               for a segment made before zone maps were kept
+  tombstones - the Tombstones of the records deleted, opened on first use
+        meta - dict of 'start', 'end', 'mints', 'maxts', 'rows' and, once
+               records were deleted, 'reclaimed', the deletes whose index
+               pointers are gone
+    """
+
+    def __init__(self, path:str, cols:dict, opts:dict):
+        self._path = path
+        self._cols = cols
+        self._opts = opts
+        self._records = None
+        self._indices = None
+        self._columns = None
+        self._ordered = None
+        self._zones = None
+        self._tombstones = None
+        # A table made before segments kept their metadata has none.
+        self._meta = {'start': None, 'end': None, 'mints': None, 'maxts': None, 'rows': None}
+        mpath = join(path, 'segment.json')
+        if exists(mpath):
+            with open(mpath, 'rb') as fp:
+                data = fp.read()
+            try:
+                self._meta = json.loads(data)
+            except ValueError:
+                # Only made durable at a checkpoint, so a crash may have
+                # torn it; the rollback of recovery writes it again.
+                self._meta['torn'] = True
+
+    def get_path(self):
+        return self._path
+    path = property(get_path)
+
+    def get_meta(self):
+        return self._meta
+    meta = property(get_meta)
+
+    def get_records(self):
+        if not self._records:
+            self._records = RecordStore(join(self._path, "records.dat"), self._opts.get('codec', 'none'))
+        return self._records
+    records = property(get_records)
+
+    def get_indices(self):
+        if self._indices is None:
+            self._indices = {}
+            for col, coltype in self._cols.items():
+                self._indices[col] = Index(join(self._path, col+'.idx'), coltype)
+        return self._indices
+    indices = property(get_indices)
+
+    def get_columns(self):
+        if self._columns is None and exists(join(self._path, OFFSETS+'.col')):
+            self._columns = {OFFSETS: ColumnFile(join(self._path, OFFSETS+'.col'), 'offset')}
+            for col, coltype in self._cols.items():
+                self._columns[col] = ColumnFile(join(self._path, col+'.col'), coltype)
+        return self._columns
+    columns = property(get_columns)
+
+    def get_ordered(self):
+        if self._ordered is None:
+            self._ordered = {}
+            for col in self._cols:
+                if exists(join(self._path, col+'.ord')):
+                    self._ordered[col] = OrderedIndex(join(self._path, col+'.ord'))
+        return self._ordered
+    ordered = property(get_ordered)
+
+    def get_zones(self):
+        if self._zones is None and exists(join(self._path, ZONES)):
+            self._zones = ZoneMap(join(self._path, ZONES))
+        return self._zones
+    zones = property(get_zones)
+
+    def get_tombstones(self):
+        if self._tombstones is None:
+            self._tombstones = Tombstones(join(self._path, DELETED))
+        return self._tombstones
+    tombstones = property(get_tombstones)
+
+    def overlaps(self, low, high):
+        """
+        Return False if the segment can't hold a time in [low, high]. Either
+        bound may be None.
+        """
+        meta = self._meta
+        if meta['rows'] == 0:
+            return False
+        if meta['mints'] is None:
+            return True
+        return (low is None or meta['maxts'] >= low) and (high is None or meta['mints'] <= high)
+
+    def append(self, rows:list):
+        """
+        Append checked rows to the segment, one write to the record store, one
+        pass over each index, one block appended to each column file and
+        one entry describing the blocks to the zone map.
+
+        Return:
+            list of the record offsets of the rows
+        """
+        offsets = self.records.append_many(rows)
+        for col, idx in self.indices.items():
+            idx.insert_many([r[col] for r in rows], offsets)
+        columns = self.columns
+        if columns:
+            columns[OFFSETS].append(offsets)
+            block = {}
+            for col, idx in self.indices.items():
+                values = block[col] = [r[col] for r in rows]
+                if idx.coltype == 'str':
+                    ids = {v: idx.id(v) for v in set(values)}
+                    columns[col].append(values, [ids[v] for v in values])
+                else:
+                    columns[col].append(values)
+            if self.zones is not None:
+                self.zones.append(block, self._cols)
+        for col, oidx in self.ordered.items():
+            oidx.append([r[col] for r in rows], offsets)
+
+        meta = self._meta
+        meta['rows'] = (meta['rows'] or 0) + len(rows)
+        timecol = self._opts.get('timecol')
+        if timecol:
+            times = [r[timecol] for r in rows]
+            low, high = min(times), max(times)
+            meta['mints'] = low if meta['mints'] is None else min(low, meta['mints'])
+            meta['maxts'] = high if meta['maxts'] is None else max(high, meta['maxts'])
+        _writemeta(self._path, meta)
+        return offsets
+
+    def read_columns(self, cols:list, offsets):
+        """
+        Return dict of column name to the list of values of the records at
+        the sorted 'offsets' (every record if None), reading only the column
+        files of 'cols' and, of those, only the blocks holding the records
+        wanted.
+        """
+        columns = self.columns
+        if columns is None:
+            if offsets is None:
+                recs = [r for o, r in self.records.scan()]
+            else:
+                recs = self.records.read_many(offsets)
+            return {c: [r[c] for r in recs] for c in cols}
+
+        # Record offsets grow as rows are appended, so they are sorted
+        # within and across blocks.
+        blocks = columns[OFFSETS].read()
+        firsts = [b[0] for b in blocks]
+        total = sum(len(b) for b in blocks)
+        if offsets is None or len(offsets) == total:
+            picks = {n: None for n in range(len(blocks))}
+        else:
+            picks = {}
+            for o in offsets:
+                n = bisect_right(firsts, o) - 1
+                if n < 0:
+                    continue
+                i = bisect_left(blocks[n], o)
+                if i < len(blocks[n]) and blocks[n][i] == o:
+                    picks.setdefault(n, []).append(i)
+
+        result = {}
+        for col in cols:
+            index = self.indices[col] if self._cols[col] == 'str' else None
+            values = []
+            for n, block in enumerate(columns[col].read(picks, index)):
+                if block is None:
+                    continue
+                which = picks[n]
+                values.extend(block if which is None else [block[i] for i in which])
+            result[col] = values
+        return result
+
+    def scan(self, col:str, cmp:str, value, test):
+        """
+        Return the sorted record offsets of the rows whose value of 'col'
+        satisfies the predicate, 'test' telling whether a value does (see
+        pgm.Test). Only the blocks the zone map allows are read. Deleted
+        records are left out.
+        """
+        columns = self.columns
+        if columns is None:
+            found = array('Q', [o for o, r in self.records.scan() if test(r[col])])
+        else:
+            index = self.indices[col] if self._cols[col] == 'str' else None
+            found = Scan(self.zones, columns[col], columns[OFFSETS], index, cmp, value, test)[0]
+        return self.tombstones.visible(found, self.records.size, self.tombstones.count)
+
+    def blockrows(self, col:str, cmp:str, value):
+        """
+        Return the number of values a scan of 'col' for the predicate would
+        decode, None if the segment has no column files.
+        """
+        columns = self.columns
+        if columns is None:
+            return None
+        counts = columns[OFFSETS].counts()
+        if self.zones is None:
+            return sum(counts)
+        entries = len(self.zones.entries())
+        return (sum(counts[n] for n in self.zones.blocks(col, cmp, value) if n < len(counts)) +
+                sum(counts[entries:]))
+
+    def filter(self, col:str, offsets, test):
+        """
+        Return the sorted array('Q') of those of the sorted 'offsets' whose
+        record's value of 'col' passes 'test', reading the records.
+        """
+        # The zone maps are not used here on purpose. The planner only
+        # filters candidates when they are few (see planner.Plan), and
+        # reading a few records costs a pread each, while finding the
+        # blocks of the candidates means decoding the whole offsets column,
+        # and every block the zone map lets through must be decoded whole.
+        if not len(offsets):
+            return array('Q')
+        records = self.records.read_many(offsets)
+        return array('Q', [o for o, r in zip(offsets, records) if test(r[col])])
+
+    def delete(self, offsets):
+        """
+        Delete the records at 'offsets', see tombstones.py. The records and
+        the index pointers to them stay until reclaimed; 'mints' and
+        'maxts' still bound the times of the rows left.
+        """
+        self.tombstones.append(offsets)
+        meta = self._meta
+        meta['rows'] = max(0, (meta['rows'] or 0) - len(offsets))
+        _writemeta(self._path, meta)
+
+    def reclaim(self, upto:int):
+        """
+        Remove from the indices the pointers to the records deleted by the
+        deletes before delete 'upto' (see Tombstones.count), those no reader
+        may still see. An ordered index keeps its pointers; the searches
+        drop them like any other deleted offset.
+
+        Return:
+            number of records whose pointers were removed
+        """
+        first = self._meta.get('reclaimed', 0)
+        if upto <= first:
+            return 0
+        offsets = self.tombstones.deleted(first, upto)
+        values = self.read_columns(list(self._cols), offsets)
+        for col, idx in self.indices.items():
+            idx.delete_many(values[col], offsets)
+        self._meta['reclaimed'] = upto
+        _writemeta(self._path, self._meta)
+        return len(offsets)
+
+    def reserve(self, rows:list):
+        """
+        Make room in every index for appending 'rows', see Index.reserve.
+
+        Return:
+            True if an index was rebuilt
+        """
+        rebuilt = False
+        for col, idx in self.indices.items():
+            rebuilt |= idx.reserve([r[col] for r in rows])
+        return rebuilt
+
+    def compact(self, ratio:float):
+        """
+        Rebuild the indices in which at least 'ratio' of the pointers are
+        tombstones, see Index.rebuild.
+
+        Return:
+            number of indices rebuilt
+        """
+        n = 0
+        for idx in self.indices.values():
+            ntomb = idx.ntomb
+            if ntomb and ntomb >= ratio * (ntomb + idx.nrefs):
+                idx.rebuild()
+                n += 1
+        return n
+
+    def state(self):
+        """
+        Return the sizes and index headers that 'rollback' puts back. Only
+        meaningful once the segment has been synced.
+        """
+        columns = self.columns or {}
+        return {'records': self.records.size,
+                'columns': {name: cf.size for name, cf in columns.items()},
+                'zones': self.zones.size if self.zones is not None else None,
+                'tombstones': self.tombstones.size,
+                'indices': {col: [idx.count, idx.heaptop, idx.rebuilds] for col, idx in self.indices.items()},
+                'ordered': {col: oidx.state() for col, oidx in self.ordered.items()},
+                'meta': dict(self._meta)}
+
+    def rollback(self, state:dict):
+        """
+        Undo everything appended to the segment since 'state' was taken: the
+        record store, column files and tombstones are cut back to their
+        sizes then, and the indices drop what was added since, whether or
+        not they were rebuilt since (see Index.rollback). An ordered index
+        rewritten since is built again from the columns.
+        """
+        self.close()
+        os.truncate(join(self._path, "records.dat"), state['records'])
+        for name, size in state['columns'].items():
+            os.truncate(join(self._path, name+'.col'), size)
+        if state.get('zones') is not None:
+            os.truncate(join(self._path, ZONES), state['zones'])
+        if state.get('tombstones') is not None:
+            os.truncate(join(self._path, DELETED), state['tombstones'])
+        elif exists(join(self._path, DELETED)):
+            # Made by a delete since.
+            os.remove(join(self._path, DELETED))
+        for col, istate in state['indices'].items():
+            idx = Index(join(self._path, col+'.idx'))
+            try:
+                # A checkpoint from before indices counted their rebuilds has none.
+                idx.rollback(istate[0], istate[1], state['records'], *istate[2:])
+            finally:
+                idx.close()
+        for col, ostate in state.get('ordered', {}).items():
+            oidx = OrderedIndex(join(self._path, col+'.ord'))
+            try:
+                if not oidx.rollback(ostate):
+                    values = self.read_columns([col], None)[col]
+                    offsets = [o for b in self.columns[OFFSETS].read() for o in b]
+                    oidx.rebuild(values, offsets)
+            finally:
+                oidx.close()
+                self.close()
+        self._meta = dict(state['meta'])
+        _writemeta(self._path, self._meta)
+
+    def sync(self):
+        """
+        Make the records, indices, columns and segment.json durable.
+        """
+        if self._records:
+            self._records.flush(True)
+        for idx in (self._indices or {}).values():
+            idx.flush()
+        for cf in (self._columns or {}).values():
+            cf.flush()
+        for oidx in (self._ordered or {}).values():
+            oidx.flush()
+        if self._zones is not None:
+            self._zones.flush()
+        if self._tombstones is not None:
+            self._tombstones.flush()
+        _writemeta(self._path, self._meta, True)
+
+    def close(self):
+        if self._records:
+            self._records.close()
+            self._records = None
+        for idx in (self._indices or {}).values():
+            idx.close()
+        self._indices = None
+        for cf in (self._columns or {}).values():
+            cf.close()
+        self._columns = None
+        for oidx in (self._ordered or {}).values():
+            oidx.close()
+        self._ordered = None
+        if self._zones is not None:
+            self._zones.close()
+            self._zones = None
+        if self._tombstones is not None:
+            self._tombstones.close()
+            self._tombstones = None
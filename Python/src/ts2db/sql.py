@@ -0,0 +1,684 @@
+"""
+class SQL - the SQL Command Processor.
+
+Takes a SELECT statement, checks it against the tables known to the
+database and compiles it into a program for Table.execute: one parallel
+search step per column the WHERE clause touches, and a common program that
+combines the step results, fetches the records, orders, limits and
+projects them.
+
+The statements understood are
+
+    SELECT <* | col, ... | func(col), ...> FROM <table>
+        [WHERE <condition>]
+        [GROUP BY TIME(<seconds>)]
+        [ORDER BY <col> [ASC | DESC]]
+        [LIMIT <n>]
+    DELETE FROM <table> [WHERE <condition>]
+    UPDATE <table> SET <col> = <literal>, ... [WHERE <condition>]
+
+where a condition is built from
+
+    <col> <op> <literal>             op is one of = != <> < <= > >=
+    <col> BETWEEN <literal> AND <literal>
+    <col> IN (<literal>, ...)
+    NOT <condition>, <condition> AND <condition>, <condition> OR <condition>, (<condition>)
+
+The aggregate functions are COUNT, SUM, MIN, MAX and AVG over int and
+float columns. GROUP BY TIME(n) groups by n second buckets of the table's
+'timecol'. When the WHERE clause only bounds the time column on bucket
+boundaries and every aggregated column has a rollup that divides the
+bucket width, the aggregates come from the rollup files instead of the
+records. Otherwise they are computed from the column files of the columns
+aggregated, again without reading the records.
+
+DELETE and UPDATE compile to the program selecting the rows, ended by a
+('delete', table) or ('update', table, changes) instruction that tells
+execute to hand it to Table.delete_many or Table.update_many. They return
+a single row, the number of rows 'deleted' or 'updated'.
+
+A statement may be prefixed with EXPLAIN, which returns the program it
+compiles to and how the planner would run each step (see planner.py)
+instead of running it, or EXPLAIN ANALYZE, which runs it and returns the
+program followed by the time each stage took (see metrics.py).
+
+Compiled programs are cached by statement text.
+"""
+from collections import OrderedDict
+from os.path import join, basename
+import asyncio
+import re
+import threading
+
+from rollup import FUNCTIONS, GRANULARITY
+from pgm import BATCHSIZE
+from metrics import metrics, Trace, Tracing
+import exceptions
+
+_TOKENS = re.compile(r"""
+      (?P<ws>\s+)
+    | (?P<num>-?\d+\.\d*(?:[eE][-+]?\d+)?|-?\d+(?:[eE][-+]?\d+)?)
+    | (?P<str>'(?:[^']|'')*')
+    | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<op><>|!=|<=|>=|=|<|>|\(|\)|,|\*)
+    """, re.VERBOSE)
+
+_KEYWORDS = {'SELECT', 'FROM', 'WHERE', 'GROUP', 'ORDER', 'BY', 'ASC', 'DESC', 'LIMIT',
+             'AND', 'OR', 'NOT', 'BETWEEN', 'IN', 'DELETE', 'UPDATE', 'SET'}
+
+# Last instructions of the programs of the statements that change a table.
+_WRITES = {'delete', 'update'}
+
+# Literals an UPDATE may set each column type to.
+_STORES = {'str': str, 'int': int, 'float': (float, int)}
+
+# Comparisons that bound a range, and how they fold into [low, high].
+_RANGES = {'<', '<=', '>', '>=', 'between'}
+
+_EXPLAIN = re.compile(r'\s*EXPLAIN(\s+ANALYZE)?\s+', re.IGNORECASE)
+
+# Number of compiled statements kept.
+_CACHESIZE = 256
+
+
+def _tokenize(text:str):
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        m = _TOKENS.match(text, pos)
+        if not m:
+            raise exceptions.SQLError("Syntax error at '%s'." % (text[pos:pos+20]))
+        pos = m.end()
+        kind = m.lastgroup
+        tok = m.group(kind)
+        if kind == 'ws':
+            continue
+        if kind == 'num':
+            tokens.append(('lit', float(tok) if any(c in tok for c in '.eE') else int(tok)))
+        elif kind == 'str':
+            tokens.append(('lit', tok[1:-1].replace("''", "'")))
+        elif kind == 'name' and tok.upper() in _KEYWORDS:
+            tokens.append(('kw', tok.upper()))
+        else:
+            tokens.append((kind, tok))
+    tokens.append(('end', None))
+    return tokens
+
+
+class _Parser:
+    """
+    Recursive descent parser producing
+
+        {'kind': 'select', 'columns': [...] or None, 'table': name,
+         'where': tree or None, 'group': seconds or None,
+         'order': (col, desc) or None, 'limit': n or None}
+
+    for a SELECT, the same with 'kind' 'delete' for a DELETE and 'update',
+    plus 'set', the dict of column to new value, for an UPDATE, where a column is a name or (function, name) and
+    a tree is ('and', [trees]), ('or', [trees]), ('not', tree) or
+    ('pred', col, cmp, value).
+    """
+    def __init__(self, text:str):
+        self._tokens = _tokenize(text)
+        self._pos = 0
+
+    def _peek(self):
+        return self._tokens[self._pos]
+
+    def _take(self):
+        tok = self._tokens[self._pos]
+        self._pos += 1
+        return tok
+
+    def _accept(self, kind, value=None):
+        tok = self._peek()
+        if tok[0] == kind and (value is None or tok[1] == value):
+            self._pos += 1
+            return tok
+        return None
+
+    def _expect(self, kind, value=None):
+        tok = self._accept(kind, value)
+        if not tok:
+            raise exceptions.SQLError("Expected %s but found '%s'." % (value or kind, self._peek()[1]))
+        return tok
+
+    def parse(self):
+        stmt = {'kind': 'select', 'columns': None, 'where': None, 'group': None, 'order': None,
+                'limit': None}
+        if self._accept('kw', 'DELETE'):
+            stmt['kind'] = 'delete'
+            self._expect('kw', 'FROM')
+            stmt['table'] = self._expect('name')[1]
+            return self._where(stmt)
+        if self._accept('kw', 'UPDATE'):
+            stmt['kind'] = 'update'
+            stmt['table'] = self._expect('name')[1]
+            self._expect('kw', 'SET')
+            stmt['set'] = {}
+            while True:
+                col = self._expect('name')[1]
+                self._expect('op', '=')
+                stmt['set'][col] = self._expect('lit')[1]
+                if not self._accept('op', ','):
+                    break
+            return self._where(stmt)
+        self._expect('kw', 'SELECT')
+        if not self._accept('op', '*'):
+            stmt['columns'] = [self._column()]
+            while self._accept('op', ','):
+                stmt['columns'].append(self._column())
+        self._expect('kw', 'FROM')
+        stmt['table'] = self._expect('name')[1]
+        if self._accept('kw', 'WHERE'):
+            stmt['where'] = self._or()
+        if self._accept('kw', 'GROUP'):
+            self._expect('kw', 'BY')
+            if self._expect('name')[1].upper() != 'TIME':
+                raise exceptions.SQLError("Only GROUP BY TIME(<seconds>) is supported.")
+            self._expect('op', '(')
+            width = self._expect('lit')[1]
+            self._expect('op', ')')
+            if not isinstance(width, int) or width <= 0:
+                raise exceptions.SQLError("TIME() needs a positive number of seconds.")
+            stmt['group'] = width
+        if self._accept('kw', 'ORDER'):
+            self._expect('kw', 'BY')
+            col = self._expect('name')[1]
+            desc = bool(self._accept('kw', 'DESC'))
+            if not desc:
+                self._accept('kw', 'ASC')
+            stmt['order'] = (col, desc)
+        if self._accept('kw', 'LIMIT'):
+            n = self._expect('lit')[1]
+            if not isinstance(n, int) or n < 0:
+                raise exceptions.SQLError("LIMIT must be a positive integer.")
+            stmt['limit'] = n
+        self._expect('end')
+        return stmt
+
+    def _where(self, stmt:dict):
+        if self._accept('kw', 'WHERE'):
+            stmt['where'] = self._or()
+        self._expect('end')
+        return stmt
+
+    def _column(self):
+        name = self._expect('name')[1]
+        if self._accept('op', '('):
+            if name.lower() not in FUNCTIONS:
+                raise exceptions.SQLError("Function '%s' is unknown." % (name))
+            col = self._expect('name')[1]
+            self._expect('op', ')')
+            return (name.lower(), col)
+        return name
+
+    def _or(self):
+        terms = [self._and()]
+        while self._accept('kw', 'OR'):
+            terms.append(self._and())
+        return terms[0] if len(terms) == 1 else ('or', terms)
+
+    def _and(self):
+        terms = [self._not()]
+        while self._accept('kw', 'AND'):
+            terms.append(self._not())
+        return terms[0] if len(terms) == 1 else ('and', terms)
+
+    def _not(self):
+        if self._accept('kw', 'NOT'):
+            return ('not', self._not())
+        if self._accept('op', '('):
+            tree = self._or()
+            self._expect('op', ')')
+            return tree
+        col = self._expect('name')[1]
+        if self._accept('kw', 'BETWEEN'):
+            low = self._expect('lit')[1]
+            self._expect('kw', 'AND')
+            return ('pred', col, 'between', [low, self._expect('lit')[1]])
+        if self._accept('kw', 'IN'):
+            self._expect('op', '(')
+            values = [self._expect('lit')[1]]
+            while self._accept('op', ','):
+                values.append(self._expect('lit')[1])
+            self._expect('op', ')')
+            return ('pred', col, 'in', values)
+        tok = self._take()
+        if tok[0] != 'op' or tok[1] not in ('=', '!=', '<>', '<', '<=', '>', '>='):
+            raise exceptions.SQLError("Expected a comparison after '%s'." % (col))
+        return ('pred', col, '!=' if tok[1] == '<>' else tok[1], self._expect('lit')[1])
+
+
+def _timerange(tree, timecol:str):
+    """
+    Return the [low, high] bounds (either may be None) the top level
+    conjunction of 'tree' puts on column 'timecol', or None if it puts none.
+    """
+    terms = tree[1] if tree[0] == 'and' else [tree]
+    low = high = None
+    found = False
+    for t in terms:
+        if t[0] != 'pred' or t[1] != timecol:
+            continue
+        cmp, value = t[2], t[3]
+        if cmp == '=':
+            lo = hi = value
+        elif cmp == 'in':
+            lo, hi = min(value), max(value)
+        elif cmp in ('between', 'range'):
+            lo, hi = value[0], value[1]
+        elif cmp in ('>', '>='):
+            lo, hi = value, None
+        elif cmp in ('<', '<='):
+            lo, hi = None, value
+        else:
+            continue
+        found = True
+        if lo is not None and (low is None or lo > low):
+            low = lo
+        if hi is not None and (high is None or hi < high):
+            high = hi
+    return [low, high] if found else None
+
+
+def _exactrange(tree, timecol:str):
+    """
+    Return the half open [low, high) the WHERE clause 'tree' selects if it
+    is nothing but bounds on the int column 'timecol' (either bound may be
+    None), or None if it selects anything else.
+    """
+    terms = tree[1] if tree[0] == 'and' else [tree]
+    low = high = None
+    for t in terms:
+        if t[0] != 'pred' or t[1] != timecol:
+            return None
+        cmp, v = t[2], t[3]
+        if cmp == 'between':
+            lo, hi = v[0], v[1] + 1
+        elif cmp == 'range':
+            lo, hi = v[0] + (0 if v[2] else 1), v[1] + (1 if v[3] else 0)
+        elif cmp == '=':
+            lo, hi = v, v + 1
+        elif cmp in ('>', '>='):
+            lo, hi = v + (1 if cmp == '>' else 0), None
+        elif cmp in ('<', '<='):
+            lo, hi = None, v + (1 if cmp == '<=' else 0)
+        else:
+            return None
+        if not all(isinstance(x, int) for x in (lo, hi) if x is not None):
+            return None
+        if lo is not None and (low is None or lo > low):
+            low = lo
+        if hi is not None and (high is None or hi < high):
+            high = hi
+    return low, high
+
+
+def _fold(preds:list):
+    """
+    Fold the range predicates on one column in a conjunction into a single
+    'between' (or one sided) predicate, so each column is searched once.
+    """
+    low = high = None
+    lowopen = highopen = False
+    rest = []
+    for p in preds:
+        _, col, cmp, value = p
+        if cmp == 'between':
+            bounds = [(value[0], False, True), (value[1], False, False)]
+        elif cmp in ('>', '>='):
+            bounds = [(value, cmp == '>', True)]
+        elif cmp in ('<', '<='):
+            bounds = [(value, cmp == '<', False)]
+        else:
+            rest.append(p)
+            continue
+        for v, isopen, islow in bounds:
+            if islow and (low is None or v > low or (v == low and isopen)):
+                low, lowopen = v, isopen
+            elif not islow and (high is None or v < high or (v == high and isopen)):
+                high, highopen = v, isopen
+    col = preds[0][1]
+    if low is None:
+        rest.append(('pred', col, '<' if highopen else '<=', high))
+    elif high is None:
+        rest.append(('pred', col, '>' if lowopen else '>=', low))
+    elif not lowopen and not highopen:
+        rest.append(('pred', col, 'between', [low, high]))
+    else:
+        rest.append(('pred', col, 'range', [low, high, not lowopen, not highopen]))
+    return rest
+
+
+class SQL:
+    """
+    SQL Command Processor for one database.
+
+    Methods:
+
+           SQL(Table) - create a processor for the tables of Table's database
+    compile(statement) - return the (ppgm, common) program for a statement
+    execute(statement) - run a statement, returns the list of result rows
+    modifies(statement) - does the statement change a table
+    execute_async(statement, executor) - execute from a coroutine
+    stream(statement, size) - run a statement, yields lists of at most 'size' rows
+    subscribe(statement, deliver) - hand the rows inserted from now on that the
+                         statement selects to 'deliver', returns the subscription id
+      unsubscribe(subid) - end a subscription
+     invalidate(table) - forget the cached programs that use 'table'
+
+    Attributes:
+
+          table - the Table the statements run against
+    """
+
+    def __init__(self, table):
+        self._table = table
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_table(self):
+        return self._table
+    table = property(get_table)
+
+    def invalidate(self, name:str|None = None):
+        """
+        Drop the cached programs of table 'name', or all of them if None.
+        """
+        with self._lock:
+            for text in list(self._plans):
+                if name is None or self._plans[text][0] == name:
+                    del self._plans[text]
+
+    def compile(self, statement:str):
+        """
+        Compile a SELECT statement, the statement explained if it starts
+        with EXPLAIN.
+
+        Return:
+            (ppgm, common) - the parallel steps and the common program
+
+        Exceptions:
+            SQLError - the statement is invalid
+        """
+        m = _EXPLAIN.match(statement)
+        if m:
+            statement = statement[m.end():]
+        with self._lock:
+            if statement in self._plans:
+                self._plans.move_to_end(statement)
+                plan = self._plans[statement][1]
+            else:
+                plan = None
+        if plan:
+            metrics.count('plan_hits')
+            return plan
+        metrics.count('plan_misses')
+        with metrics.stage('compile'):
+            stmt = _Parser(statement).parse()
+            plan = self._build(stmt)
+        with self._lock:
+            self._plans[statement] = (stmt['table'], plan)
+            if len(self._plans) > _CACHESIZE:
+                self._plans.popitem(last=False)
+        return plan
+
+    def execute(self, statement:str):
+        """
+        Run a statement and return the resulting rows.
+        """
+        m = _EXPLAIN.match(statement)
+        if m:
+            return self._explain(statement[m.end():], bool(m.group(1)))
+        ppgm, common = self.compile(statement)
+        return self._run(ppgm, common)
+
+    def modifies(self, statement:str):
+        """
+        Return True if 'statement' changes a table (a DELETE or an UPDATE
+        not explained).
+        """
+        if _EXPLAIN.match(statement):
+            return False
+        ppgm, common = self.compile(statement)
+        return bool(common) and common[-1][0] in _WRITES
+
+    def _run(self, ppgm:list, common:list):
+        """
+        Run a compiled program: a DELETE's or UPDATE's through
+        Table.delete_many or Table.update_many, any other through Table.execute.
+        """
+        last = common[-1] if common else ()
+        if last[:1] == ('delete',):
+            return [{'deleted': self._table.delete_many(ppgm, common[:-1])}]
+        if last[:1] == ('update',):
+            return [{'updated': self._table.update_many(ppgm, common[:-1], last[2])}]
+        return self._table.execute(ppgm, common)
+
+    def _explain(self, statement:str, analyze:bool):
+        """
+        Return a row per parallel step and per instruction of the common
+        program of 'statement'. If 'analyze', the statement is run as well
+        and a row added per stage it went through, then the rows it returned.
+        """
+        trace = Trace()
+        with Tracing(trace):
+            ppgm, common = self.compile(statement)
+            if analyze:
+                result = self._run(ppgm, common)
+        rows = [{'step': n, 'index': basename(path), 'predicate': list(pred)}
+                for n, (path, pred, op) in enumerate(ppgm)]
+        rows += [{'instruction': ins[0], 'args': list(ins[1:])} for ins in common]
+        planned = common[:-1] if common and common[-1][0] in _WRITES else common
+        rows += [dict(note, plan=n) for n, note in enumerate(self._table.plan(ppgm, planned))]
+        if analyze:
+            rows += trace.rows()
+            rows.append({'stage': 'rows', 'count': len(result)})
+        return rows
+
+    def stream(self, statement:str, size:int = BATCHSIZE):
+        """
+        Run a SELECT statement, yielding the resulting rows in lists of at
+        most 'size', see Table.stream.
+        """
+        ppgm, common = self.compile(statement)
+        if _EXPLAIN.match(statement) or (common and common[-1][0] in _WRITES):
+            rows = self.execute(statement)
+            return (rows[i:i+size] for i in range(0, len(rows), size))
+        return self._table.stream(ppgm, common, size)
+
+    def subscribe(self, statement:str, deliver):
+        """
+        Subscribe to the rows of the inserts from now on that a SELECT
+        statement selects, see Table.subscribe. The statement can't order,
+        limit, group or aggregate.
+
+        Exceptions:
+            SQLError - the statement is invalid or does more than select rows
+        """
+        if _EXPLAIN.match(statement):
+            raise exceptions.SQLError("EXPLAIN can't be subscribed to.")
+        ppgm, common = self.compile(statement)
+        ops = {ins[0] for ins in common}
+        if not ppgm or ops & ({'order', 'limit', 'columns', 'aggregate'} | _WRITES):
+            raise exceptions.SQLError("Only rows can be subscribed to, not ordered, limited or aggregated.")
+        return self._table.subscribe(ppgm, common, deliver)
+
+    def unsubscribe(self, subid:int):
+        self._table.unsubscribe(subid)
+
+    async def execute_async(self, statement:str, executor=None):
+        """
+        Run a SELECT statement from a coroutine, see Table.execute_async.
+        """
+        loop = asyncio.get_running_loop()
+        if _EXPLAIN.match(statement):
+            # Run whole in one thread, so the trace sees every stage.
+            return await loop.run_in_executor(executor, self.execute, statement)
+        ppgm, common = await loop.run_in_executor(executor, self.compile, statement)
+        if common and common[-1][0] in _WRITES:
+            return await loop.run_in_executor(executor, self._run, ppgm, common)
+        return await self._table.execute_async(ppgm, common, executor)
+
+    def _columns(self, name:str):
+        cols = self._table.db.list(name, True)
+        if name not in cols:
+            raise exceptions.SQLError("Table '%s' doesn't exist." % (name))
+        return cols[name]
+
+    def _checkaggs(self, stmt:dict, aggs:list, cols:dict, timecol:str|None):
+        if len(aggs) != len(stmt['columns']):
+            raise exceptions.SQLError("Columns can't be mixed with aggregate functions.")
+        for func, col in aggs:
+            if cols[col] not in ('int', 'float'):
+                raise exceptions.SQLError("%s() needs an int or float column." % (func.upper()))
+        if stmt['group'] and not timecol:
+            raise exceptions.SQLError("GROUP BY TIME needs a table with a 'timecol'.")
+        if stmt['order'] and (not stmt['group'] or stmt['order'][0] != timecol):
+            raise exceptions.SQLError("Aggregates can only be ordered by '%s'." % (timecol))
+
+    def _fromrollup(self, stmt:dict, aggs:list, opts:dict):
+        """
+        Return the common program answering the aggregates from the rollups,
+        or None if they can't be.
+        """
+        if not opts.get('rollups'):
+            return None
+        low = high = None
+        if stmt['where']:
+            bounds = _exactrange(stmt['where'], opts['timecol'])
+            if not bounds:
+                return None
+            low, high = bounds
+        chosen = []
+        for func, col in aggs:
+            # The widest rollup whose buckets fit the groups and the bounds.
+            widths = sorted((GRANULARITY[g] for g in opts['rollups'].get(col, [])), reverse=True)
+            fits = [w for w in widths if (not stmt['group'] or stmt['group'] % w == 0)
+                    and all(b is None or b % w == 0 for b in (low, high))]
+            if not fits:
+                return None
+            chosen.append((func, col, fits[0]))
+        common = [('rollup', stmt['table'], low, high, stmt['group'], chosen)]
+        if stmt['order']:
+            common.append(('order', opts['timecol'], stmt['order'][1]))
+        if stmt['limit'] is not None:
+            common.append(('limit', stmt['limit']))
+        return common
+
+    def _check(self, cols:dict, col:str, cmp:str, value):
+        if col not in cols:
+            raise exceptions.SQLError("Column '%s' doesn't exist." % (col))
+        # A 'range' is [low, high, low included, high included].
+        values = value[:2] if cmp == 'range' else value if isinstance(value, list) else [value]
+        for v in values:
+            if (cols[col] == 'str') != isinstance(v, str):
+                raise exceptions.SQLError("'%s' can't be compared with %s column '%s'." % (v, cols[col], col))
+
+    def _build(self, stmt:dict):
+        name = stmt['table']
+        cols = self._columns(name)
+        tbldir = join(self._table.db.path, name)
+        conn = self._table.connection(name)
+        opts = conn.opts
+        ordered = conn.tabledef.ordered
+        timecol = opts.get('timecol')
+        aggs = [c for c in (stmt['columns'] or []) if isinstance(c, tuple)]
+        for c in [c[1] if isinstance(c, tuple) else c for c in (stmt['columns'] or [])]:
+            if c not in cols:
+                raise exceptions.SQLError("Column '%s' doesn't exist." % (c))
+        if aggs:
+            self._checkaggs(stmt, aggs, cols, timecol)
+        elif stmt['group']:
+            raise exceptions.SQLError("GROUP BY needs aggregate functions.")
+        elif stmt['order'] and stmt['order'][0] not in cols:
+            raise exceptions.SQLError("Column '%s' doesn't exist." % (stmt['order'][0]))
+
+        ppgm = []
+        steps = {}
+
+        def step(col, cmp, value):
+            key = (col, cmp, repr(value))
+            if key not in steps:
+                steps[key] = len(ppgm)
+                # Ranges over an ordered column are read from its ordered index.
+                # The planner may still scan the column instead, see planner.py.
+                suffix = '.ord' if col in ordered and (cmp in _RANGES or cmp == 'range') else '.idx'
+                ppgm.append((join(tbldir, col + suffix), (cmp, value), 'search'))
+            return [('push', steps[key])]
+
+        def everything():
+            # Every record has a value in every column, so any column will do.
+            return step(next(iter(cols)), '*', None)
+
+        def emit(tree):
+            kind = tree[0]
+            if kind == 'pred':
+                self._check(cols, tree[1], tree[2], tree[3])
+                return step(tree[1], tree[2], tree[3])
+            if kind == 'not':
+                return everything() + emit(tree[1]) + [('not',)]
+            terms = tree[1]
+            if kind == 'and':
+                # One search per column: fold the ranges on the same column.
+                bycol = OrderedDict()
+                others = []
+                for t in terms:
+                    if t[0] == 'pred' and t[2] in _RANGES:
+                        bycol.setdefault(t[1], []).append(t)
+                    else:
+                        others.append(t)
+                terms = [p for preds in bycol.values() for p in _fold(preds)] + others
+            code = emit(terms[0])
+            for t in terms[1:]:
+                code += emit(t) + [(kind,)]
+            return code
+
+        if aggs:
+            rollup = self._fromrollup(stmt, aggs, opts)
+            if rollup:
+                return [], rollup
+        
+        common = emit(stmt['where']) if stmt['where'] else everything()
+        
+        # Let a partitioned table skip the partitions outside the time range.
+        if timecol and stmt['where']:
+            bounds = _timerange(stmt['where'], timecol)
+            if bounds:
+                common.insert(0, ('timerange', bounds[0], bounds[1]))
+        
+        if stmt['kind'] == 'delete':
+            return ppgm, common + [('delete', name)]
+        if stmt['kind'] == 'update':
+            for col, value in stmt['set'].items():
+                if col not in cols:
+                    raise exceptions.SQLError("Column '%s' doesn't exist." % (col))
+                if not isinstance(value, _STORES[cols[col]]):
+                    raise exceptions.SQLError("'%s' can't be stored in %s column '%s'." % (value, cols[col], col))
+            return ppgm, common + [('update', name, stmt['set'])]
+        
+        if aggs:
+            # Only the columns aggregated (and the time) are read.
+            needed = ([timecol] if stmt['group'] else []) + [c for f, c in aggs]
+            common.append(('columns', name, list(dict.fromkeys(needed))))
+            common.append(('aggregate', timecol, stmt['group'], aggs))
+            if stmt['order']:
+                common.append(('order', timecol, stmt['order'][1]))
+            if stmt['limit'] is not None:
+                common.append(('limit', stmt['limit']))
+            return ppgm, common
+        if stmt['order']:
+            common.append(('fetch', name))
+            common.append(('order', stmt['order'][0], stmt['order'][1]))
+            if stmt['limit'] is not None:
+                common.append(('limit', stmt['limit']))
+        else:
+            # Without an order the first offsets are as good as any, so
+            # only fetch the records that are returned.
+            if stmt['limit'] is not None:
+                common.append(('limit', stmt['limit']))
+            common.append(('fetch', name))
+        if stmt['columns']:
+            common.append(('project', stmt['columns']))
+        return ppgm, common
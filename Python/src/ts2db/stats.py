@@ -0,0 +1,391 @@
+"""
+class Statistics - what the values of each column of a table look like.
+
+The planner (see planner.py) decides how to run a program from estimates
+of how many rows each step will find. They come from statistics kept per
+segment and per column:
+
+    rows      - rows in the segment
+    distinct  - values in the first tier of the column's index
+    min, max  - the smallest and largest value
+    bins      - for an int or float column, an equi-width histogram: the
+                rows whose value falls in each of HISTBINS bins of 'width'
+                from 'low'
+    common    - the values with the largest postings lists and their sizes,
+                for a column of at most COMMONLIMIT distinct values
+
+Everything but 'common' is kept up to date as each batch is applied, the
+distinct values from the number of ids of each index; the histogram only
+ever widens, doubling the width of its bins as the values spread. At every
+checkpoint 'distinct' and 'common' are read again from the first tier of
+each index, the live counts of its dictionary entries.
+
+They are kept in memory by the table connection and written to stats.json,
+next to info.json.bz2, at every checkpoint, along with the log entry they
+reflect. A segment that has none (a table made before statistics were
+kept, or one whose statistics don't match its checkpoint after a crash)
+has them computed again from its columns.
+
+Deleted rows are taken away from 'rows' and the histogram, but 'min' and
+'max' are left as they were, so they always bound every value in the
+segment: the planner relies on that to skip steps that can't find
+anything, or that find every row.
+"""
+from os.path import join, exists
+import copy
+import heapq
+import json
+import os
+import threading
+
+# Name of the statistics file of a table.
+STATS = 'stats.json'
+
+# Bins of the histograms.
+HISTBINS = 32
+
+# Values with the largest postings lists kept per column, and the most
+# distinct values a column may have to keep them.
+COMMON = 8
+COMMONLIMIT = 1 << 12
+
+# Fraction of the rows a range over a str column is taken to find.
+_STRRANGE = 1 / 3
+
+_RANGES = {'<', '<=', '>', '>=', 'between', 'range'}
+
+
+def _key(start):
+    return '' if start is None else str(start)
+
+
+def _bounds(cmp:str, value):
+    """
+    Return (low, high, low included, high included) of a range predicate.
+    """
+    if cmp == '<':
+        return None, value, True, False
+    if cmp == '<=':
+        return None, value, True, True
+    if cmp == '>':
+        return value, None, False, True
+    if cmp == '>=':
+        return value, None, True, True
+    if cmp == 'between':
+        return value[0], value[1], True, True
+    return tuple(value)
+
+
+def _widen(col:dict, low, high):
+    """
+    Double the width of the bins of the histogram of 'col' until it spans
+    [low, high].
+    """
+    width = col['width']
+    while low < col['low'] or high >= col['low'] + width * HISTBINS:
+        bins = col['bins']
+        merged = [bins[i] + bins[i + 1] for i in range(0, HISTBINS, 2)]
+        if low < col['low']:
+            # The old range becomes the upper half.
+            col['low'] -= width * HISTBINS
+            col['bins'] = [0] * (HISTBINS // 2) + merged
+        else:
+            col['bins'] = merged + [0] * (HISTBINS // 2)
+        width *= 2
+        col['width'] = width
+
+
+def _add(col:dict, coltype:str, values:list):
+    """
+    Add a batch of values to the statistics 'col' of a column.
+    """
+    low, high = min(values), max(values)
+    if col.get('min') is None:
+        col['min'], col['max'] = low, high
+    else:
+        col['min'], col['max'] = min(low, col['min']), max(high, col['max'])
+    if coltype == 'str':
+        return
+    if 'bins' not in col:
+        span = high - low
+        if coltype == 'int':
+            width = max(1, -(-(span + 1) // HISTBINS))
+        else:
+            width = span / HISTBINS if span > 0 else 1.0
+        col['low'], col['width'], col['bins'] = low, width, [0] * HISTBINS
+    _widen(col, low, high)
+    bins = col['bins']
+    base, width = col['low'], col['width']
+    last = HISTBINS - 1
+    for v in values:
+        bins[min(last, int((v - base) // width))] += 1
+
+
+def _take(col:dict, values:list):
+    """
+    Take a batch of deleted values away from the histogram of 'col'.
+    """
+    bins = col['bins']
+    base, width = col['low'], col['width']
+    last = HISTBINS - 1
+    for v in values:
+        i = max(0, min(last, int((v - base) // width)))
+        bins[i] = max(0, bins[i] - 1)
+
+
+def _between(col:dict, coltype:str, rows:int, low, high, lowin:bool, highin:bool):
+    """
+    Return the estimated rows with values in the range, from the histogram
+    of an int or float column.
+    """
+    if 'bins' not in col:
+        return rows
+    base, width = col['low'], col['width']
+    lo = base if low is None else max(low, base)
+    hi = base + width * HISTBINS if high is None else min(high, base + width * HISTBINS)
+    if coltype == 'int':
+        # Integers: make the bounds inclusive and count the integers covered.
+        lo += 0 if lowin or low is None or lo > low else 1
+        hi += 1 if highin or high is None or hi < high else 0
+    if hi <= lo:
+        return 0
+    found = 0.0
+    for i, n in enumerate(col['bins']):
+        a = base + i * width
+        b = a + width
+        if n and b > lo and a < hi:
+            found += n * (min(b, hi) - max(a, lo)) / width
+    return min(rows, found)
+
+
+def Estimate(seg:dict, col:str, coltype:str, cmp:str, value):
+    """
+    Estimate the rows of a segment whose value of 'col' satisfies the
+    predicate, from the statistics 'seg' of the segment.
+
+    Return:
+        (rows, proven) - 'proven' is 'none' if no row can satisfy it, 'all'
+                         if every row does and None if the statistics can't
+                         tell
+    """
+    rows = seg['rows']
+    stats = seg['columns'].get(col)
+    if not rows or stats is None or stats.get('min') is None:
+        return 0, ('none' if not rows else None)
+    low, high = stats['min'], stats['max']
+    distinct = max(1, stats.get('distinct') or 1)
+    common = dict((v, n) for v, n in stats.get('common', []))
+    other = max(1, distinct - len(common))
+    rest = max(0, rows - sum(common.values()))
+
+    def equal(v):
+        if not low <= v <= high:
+            return 0
+        if v in common:
+            return common[v]
+        return min(rows, max(1, rest / other))
+
+    try:
+        if cmp == '*':
+            return rows, 'all'
+        if cmp == '=':
+            n = equal(value)
+            return n, ('none' if not n else 'all' if low == high == value else None)
+        if cmp == 'in':
+            n = min(rows, sum(equal(v) for v in set(value)))
+            return n, ('none' if not n else None)
+        if cmp == '!=':
+            if not low <= value <= high:
+                return rows, 'all'
+            return rows - equal(value), ('none' if low == high == value else None)
+        if cmp in _RANGES:
+            lo, hi, lowin, highin = _bounds(cmp, value)
+            if ((lo is not None and (high < lo or (high == lo and not lowin))) or
+                    (hi is not None and (low > hi or (low == hi and not highin)))):
+                return 0, 'none'
+            if ((lo is None or low > lo or (low == lo and lowin)) and
+                    (hi is None or high < hi or (high == hi and highin))):
+                return rows, 'all'
+            if coltype == 'str':
+                return rows * _STRRANGE, None
+            return _between(stats, coltype, rows, lo, hi, lowin, highin), None
+    except TypeError:
+        # A value of the wrong type for the column.
+        pass
+    return rows, None
+
+
+class Statistics:
+    """
+    The statistics of the segments of a table.
+
+    Methods:
+
+  Statistics(path, cols, lock) - load the statistics of table directory 'path',
+                               'cols' being the column types and 'lock' the
+                               lock held while the table is written
+         update(start, rows) - add a batch of rows about to be applied to segment 'start'
+     counted(start, segment) - note the distinct values once the batch is applied
+         remove(start, rows) - take away rows deleted from segment 'start'
+     refresh(start, segment) - read 'distinct' and 'common' from the indices
+         get(start, segment) - the statistics of segment 'start', computed
+                               from 'segment' if there are none yet
+                drop(start) - forget segment 'start'
+        save(lsn, segments) - refresh the segments updated since the last
+                              save and write the file
+                   load(lsn) - read the file again, keeping only what
+                               reflects log entry 'lsn'
+
+    Attributes:
+
+        path - file path of the statistics
+    """
+
+    def __init__(self, path:str, cols:dict, lock):
+        self._path = join(path, STATS)
+        self._cols = cols
+        self._segments = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._writing = lock
+        self.load()
+
+    def get_path(self):
+        return self._path
+    path = property(get_path)
+
+    def load(self, lsn:int|None = None):
+        """
+        Read the statistics file. If 'lsn' is given and the file reflects
+        another log entry, the statistics are dropped and computed again
+        when next needed.
+        """
+        segments = {}
+        if exists(self._path):
+            with open(self._path, 'rb') as fp:
+                saved = json.loads(fp.read())
+            if lsn is None or saved.get('lsn') == lsn:
+                segments = saved['segments']
+        with self._lock:
+            self._segments = segments
+            self._dirty = set()
+
+    def update(self, start, rows:list):
+        """
+        Add a batch of rows about to be applied to segment 'start'. Done
+        before the rows are, so the statistics never miss a row a search
+        can find.
+        """
+        key = _key(start)
+        with self._lock:
+            seg = self._segments.get(key)
+            if seg is None:
+                # Computed in full when next needed.
+                return
+            for col, coltype in self._cols.items():
+                _add(seg['columns'].setdefault(col, {}), coltype, [r[col] for r in rows])
+            seg['rows'] += len(rows)
+            self._dirty.add(key)
+
+    def remove(self, start, rows:list):
+        """
+        Take away a batch of rows deleted from segment 'start'. 'min' and
+        'max' are kept: they still bound the values left.
+        """
+        key = _key(start)
+        with self._lock:
+            seg = self._segments.get(key)
+            if seg is None:
+                return
+            for col in self._cols:
+                stats = seg['columns'].get(col, {})
+                if 'bins' in stats:
+                    _take(stats, [r[col] for r in rows])
+            seg['rows'] = max(0, seg['rows'] - len(rows))
+            self._dirty.add(key)
+
+    def counted(self, start, segment):
+        key = _key(start)
+        counts = {col: idx.count for col, idx in segment.indices.items()}
+        with self._lock:
+            seg = self._segments.get(key)
+            if seg is not None:
+                for col, n in counts.items():
+                    seg['columns'].setdefault(col, {})['distinct'] = n
+
+    def refresh(self, start, segment):
+        """
+        Read the distinct values of each column, and the sizes of the largest
+        postings lists, from the first tier of the segment's indices.
+        """
+        key = _key(start)
+        found = {}
+        for col, idx in segment.indices.items():
+            sizes = idx.sizes()
+            distinct = len(sizes) - sizes.count(0)
+            common = []
+            if distinct <= COMMONLIMIT:
+                top = heapq.nlargest(COMMON, range(len(sizes)), key=sizes.__getitem__)
+                common = [[idx.value(vid), sizes[vid]] for vid in top if sizes[vid]]
+            found[col] = (distinct, common)
+        with self._lock:
+            seg = self._segments.get(key)
+            if seg is not None:
+                for col, (distinct, common) in found.items():
+                    stats = seg['columns'].setdefault(col, {})
+                    stats['distinct'], stats['common'] = distinct, common
+
+    def get(self, start, segment):
+        """
+        Return the statistics of segment 'start', a dict of 'rows' and
+        'columns', the column name to the statistics of the column. It is a
+        copy, which the batches applied and the rows deleted later don't
+        change.
+        """
+        key = _key(start)
+        with self._lock:
+            seg = self._segments.get(key)
+            if seg is not None:
+                return copy.deepcopy(seg)
+        # No rows may be applied while the columns are read.
+        with self._writing:
+            with self._lock:
+                seg = self._segments.get(key)
+                if seg is not None:
+                    return copy.deepcopy(seg)
+            seg = {'rows': 0, 'columns': {col: {} for col in self._cols}}
+            values = segment.read_columns(list(self._cols), None)
+            for col, coltype in self._cols.items():
+                if values[col]:
+                    _add(seg['columns'][col], coltype, values[col])
+            seg['rows'] = len(next(iter(values.values()), []))
+            with self._lock:
+                self._segments[key] = seg
+                self._dirty.add(key)
+            self.refresh(start, segment)
+            with self._lock:
+                return copy.deepcopy(self._segments[key])
+
+    def drop(self, start):
+        with self._lock:
+            self._segments.pop(_key(start), None)
+
+    def save(self, lsn:int, segments:dict):
+        """
+        Refresh the statistics of 'segments' (bucket start to Segment) from
+        their indices and durably replace the file, noting they reflect log
+        entry 'lsn'. Segments with no statistics get them first.
+        """
+        for start, segment in segments.items():
+            self.get(start, segment)
+            if _key(start) in self._dirty:
+                self.refresh(start, segment)
+        with self._lock:
+            data = json.dumps({'lsn': lsn, 'segments': self._segments}).encode('utf-8')
+            self._dirty = set()
+        tmp = self._path + '.tmp'
+        with open(tmp, 'wb') as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, self._path)
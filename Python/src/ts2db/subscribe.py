@@ -0,0 +1,182 @@
+"""
+class Subscriptions - continuous queries over the rows being inserted.
+
+A subscription is a program (see pgm.py), usually compiled from a SELECT
+statement by SQL.subscribe, and a function that is handed the rows of each
+inserted batch the program selects. Rather than each client polling the
+table, Table.insert_many publishes every batch it applies here, and the
+subscriptions of the table are all matched against the batch together:
+
+  - the distinct predicates of all the subscriptions are gathered by
+    column, so a predicate shared by many subscriptions is tested once;
+  - the values of a column are read out of the batch once, and every
+    '=', 'in' and '!=' predicate on the column is answered from a single
+    map of value to rows, one lookup per predicate however many there are;
+  - each subscription then only combines the row sets of its predicates
+    with its 'and', 'or' and 'not' instructions and projects the rows.
+
+Only programs that select rows can be subscribed to: push, the set
+operations, 'timerange', 'fetch' and 'project'. Ordering, limiting and
+aggregating need more than one batch at a time.
+"""
+from itertools import count
+from os.path import basename, splitext
+import logging
+import threading
+
+from metrics import metrics
+from pgm import COMPARE
+import exceptions
+
+# Instructions of a common program a subscription can run.
+_ALLOWED = {'push', 'and', 'or', 'not', 'timerange', 'fetch', 'project'}
+
+
+class Subscriptions:
+    """
+    The subscriptions of the tables of one Table.
+
+    Methods:
+
+                      Subscriptions() - no subscriptions
+     add(name, ppgm, common, deliver) - subscribe 'deliver' to the rows of table
+                                        'name' the program selects, returns its id
+                      remove(subid) - end a subscription
+              publish(name, rows) - hand the rows of a batch inserted into table
+                                    'name' to its subscriptions
+                      tables() - names of the tables with subscriptions
+
+    Attributes:
+
+        count - number of subscriptions
+    """
+
+    def __init__(self):
+        self._subs = {}
+        self._ids = count(1)
+        self._lock = threading.Lock()
+
+    def get_count(self):
+        return len(self._subs)
+    count = property(get_count)
+
+    def tables(self):
+        with self._lock:
+            return sorted({s[0] for s in self._subs.values()})
+
+    def add(self, name:str, ppgm:list, common:list, deliver):
+        """
+        Subscribe to the rows of table 'name' selected by a program.
+
+        Input:
+             name - the table
+             ppgm - the parallel steps, one predicate on a column each
+           common - the common program combining them
+          deliver - called with the list of rows each batch inserted
+                    has that the program selects, in insert order. It is
+                    called by the thread inserting, so it shouldn't block.
+
+        Return:
+            the id of the subscription
+
+        Exceptions:
+            IndexError - the program does more than select rows
+        """
+        for ins in common:
+            if ins[0] not in _ALLOWED:
+                raise exceptions.IndexError("Instruction '%s' can't be subscribed to." % (ins[0]))
+        steps = [(splitext(basename(path))[0], repr(pred), tuple(pred)) for path, pred, op in ppgm]
+        project = [ins[1] for ins in common if ins[0] == 'project']
+        program = [ins for ins in common if ins[0] in ('push', 'and', 'or', 'not')]
+        with self._lock:
+            subid = next(self._ids)
+            self._subs[subid] = (name, steps, program, project[-1] if project else None, deliver)
+        return subid
+
+    def remove(self, subid:int):
+        with self._lock:
+            self._subs.pop(subid, None)
+
+    def publish(self, name:str, rows:list):
+        """
+        Match a batch of rows (dicts) just inserted into table 'name'
+        against its subscriptions and deliver the matches. A subscription
+        whose 'deliver' raises is ended.
+        """
+        with self._lock:
+            subs = [(subid, s) for subid, s in self._subs.items() if s[0] == name]
+        if not subs or not rows:
+            return
+        with metrics.stage('publish', {'subscriptions': len(subs), 'rows': len(rows)}):
+            found = _match(rows, [s[1] for subid, s in subs])
+            for subid, (table, steps, program, project, deliver) in subs:
+                sets = [found[(col, key)] for col, key, pred in steps]
+                if program:
+                    which = _run(program, sets)
+                else:
+                    which = set.intersection(*sets) if sets else set(range(len(rows)))
+                if not which:
+                    continue
+                if project:
+                    matched = [{c: rows[i][c] for c in project} for i in sorted(which)]
+                else:
+                    matched = [dict(rows[i]) for i in sorted(which)]
+                try:
+                    deliver(matched)
+                except Exception as e:
+                    logging.warning("Subscription %d failed and was ended: %s", subid, e)
+                    self.remove(subid)
+                    continue
+                metrics.count('published_rows', len(matched))
+
+
+def _match(rows:list, stepsets:list):
+    """
+    Return dict of (column, repr of predicate) to the set of the indices of the
+    'rows' satisfying it, for every distinct step of 'stepsets'. Each step
+    is (column, repr of the predicate, predicate).
+    """
+    bycol = {}
+    for steps in stepsets:
+        for col, key, pred in steps:
+            bycol.setdefault(col, {})[key] = pred
+    everything = set(range(len(rows)))
+    found = {}
+    for col, preds in bycol.items():
+        values = [r[col] for r in rows]
+        where = None
+        for key, (cmp, value) in preds.items():
+            if cmp in ('=', 'in', '!='):
+                if where is None:
+                    # One pass over the column answers every lookup on it.
+                    where = {}
+                    for i, v in enumerate(values):
+                        where.setdefault(v, set()).add(i)
+                if cmp == '=':
+                    result = where.get(value, set())
+                elif cmp == 'in':
+                    result = set().union(*(where.get(v, ()) for v in value))
+                else:
+                    result = everything - where.get(value, set())
+            else:
+                f = COMPARE[cmp]
+                result = {i for i, v in enumerate(values) if f(v, value)}
+            found[(col, key)] = result
+    return found
+
+
+def _run(program:list, sets:list):
+    """
+    Run the push and set instructions of a common program over the row
+    sets of its steps.
+    """
+    stack = []
+    for ins in program:
+        op = ins[0]
+        if op == 'push':
+            stack.append(sets[ins[1]])
+        else:
+            b = stack.pop()
+            a = stack.pop()
+            stack.append(a & b if op == 'and' else a | b if op == 'or' else a - b)
+    return stack[-1] if stack else set()
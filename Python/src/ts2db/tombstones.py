@@ -0,0 +1,162 @@
+"""
+class Tombstones - the records of a segment that were deleted.
+
+Records are never changed or removed from records.dat, nor are the index
+files rewritten under the readers: deleting a row appends its record
+offset to deleted.dat beside the records, and updating a row deletes it
+and appends the new version as a new record. A search finds what the
+indices point at and drops the offsets deleted, see Table._resolve.
+
+deleted.dat is
+
+    <header>  - 'TS2D', version, 8 bytes
+    <entry>   - repeated, one per delete: <offsets> <payload crc32>, then
+                the sorted record offsets deleted, 8 bytes apiece
+
+so the deletes are kept in the order they were made, and a reader that
+pinned the table as it was after the first n of them (see
+PERCONNECT.pin) only drops those. Offsets are bytes into records.dat and
+so sparse, which is why they are kept as offsets rather than a bitmap of
+rows.
+
+The file is only made by the first delete; a segment without it has
+none. Its entries are read once and kept in memory.
+"""
+from array import array
+from bisect import bisect_left
+from os.path import exists
+import os
+import struct
+import zlib
+
+import exceptions
+
+_HDR = struct.Struct('<4sHH')
+_MAGIC = b'TS2D'
+_VERSION = 1
+_ENTRY = struct.Struct('<II')
+
+# Name of the tombstone file of a segment.
+DELETED = 'deleted.dat'
+
+
+class Tombstones:
+    """
+    The deleted records of a segment.
+
+    Methods:
+
+      Tombstones(path) - open the tombstone file, if there is one
+      append(offsets) - delete the records at 'offsets'
+    visible(offsets, end, count) - those of 'offsets' a reader sees
+       deleted(first, last) - the offsets of deletes 'first' to 'last'
+            flush() - force the file to disk
+            close() - close the file
+
+    Attributes:
+
+      path - file path of the tombstone file
+      size - size of the file in bytes, None if there is none yet
+     count - number of records deleted so far
+    """
+
+    def __init__(self, path:str):
+        self._path = path
+        self._fd = None
+        self._log = array('Q')
+        self._dead = {}
+        if exists(path):
+            self._open()
+            self._load()
+
+    def _open(self):
+        if not exists(self._path):
+            with open(self._path, 'wb') as fp:
+                fp.write(_HDR.pack(_MAGIC, _VERSION, 0))
+        self._fd = os.open(self._path, os.O_RDWR)
+        hdr = os.pread(self._fd, _HDR.size, 0)
+        if len(hdr) != _HDR.size or _HDR.unpack(hdr)[0] != _MAGIC:
+            self.close()
+            raise exceptions.TableError("'%s' is not a tombstone file." % (self._path))
+
+    def _load(self):
+        end = os.fstat(self._fd).st_size
+        data = os.pread(self._fd, end - _HDR.size, _HDR.size)
+        p = 0
+        while p + _ENTRY.size <= len(data):
+            n, crc = _ENTRY.unpack_from(data, p)
+            payload = data[p + _ENTRY.size:p + _ENTRY.size + n * 8]
+            if len(payload) < n * 8 or zlib.crc32(payload) != crc:
+                # Torn by a crash; recovery cuts it off.
+                break
+            self._add(array('Q', payload))
+            p += _ENTRY.size + n * 8
+
+    def _add(self, offsets:array):
+        # Each offset deleted maps to its place in the order of the deletes.
+        first = len(self._log)
+        self._log.extend(offsets)
+        for i, o in enumerate(offsets):
+            self._dead[o] = first + i
+
+    def get_path(self):
+        return self._path
+    path = property(get_path)
+
+    def get_size(self):
+        if self._fd is None:
+            return None
+        return os.fstat(self._fd).st_size
+    size = property(get_size)
+
+    def get_count(self):
+        return len(self._log)
+    count = property(get_count)
+
+    def append(self, offsets):
+        """
+        Delete the records at 'offsets', none of them deleted already.
+        """
+        offsets = array('Q', sorted(offsets))
+        if not offsets:
+            return
+        if self._fd is None:
+            self._open()
+        payload = offsets.tobytes()
+        os.pwrite(self._fd, _ENTRY.pack(len(offsets), zlib.crc32(payload)) + payload,
+                  os.fstat(self._fd).st_size)
+        self._add(offsets)
+
+    def visible(self, offsets, end:int, count:int):
+        """
+        Return the sorted array('Q') of those of the sorted 'offsets' a
+        reader that pinned the segment when its records ended at 'end' and
+        'count' records were deleted sees: those before 'end' that aren't
+        among the first 'count' deleted.
+        """
+        if len(offsets) and offsets[-1] >= end:
+            offsets = offsets[:bisect_left(offsets, end)]
+        if not count or not len(offsets):
+            return offsets
+        # Deleted after the pin: the position in the log is 'count' or more.
+        since = self._dead.get
+        return array('Q', [o for o in offsets if since(o, count) >= count])
+
+    def deleted(self, first:int, last:int):
+        """
+        Return the sorted array('Q') of the offsets of the records deleted
+        'first' to 'last' (not included), in the order of the deletes.
+        """
+        return array('Q', sorted(self._log[first:last]))
+
+    def flush(self):
+        if self._fd is not None:
+            os.fsync(self._fd)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __del__(self):
+        self.close()
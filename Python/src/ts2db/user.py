@@ -23,7 +23,7 @@ class User:
     
     def set_idxsize(self, idxsize):
         self._idxsize = idxsize
-    idxsize = property(get_idxsize, set_idxsize, doc="Maximum size of index files, in bytes")
+    idxsize = property(get_idxsize, set_idxsize, doc="Initial size of index files, in bytes; they grow as they fill")
     
     
 def GetPerUser(user:str):
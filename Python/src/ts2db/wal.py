@@ -0,0 +1,181 @@
+"""
+class Wal - the write ahead log of a table.
+
+Every batch of rows inserted into a table is first appended to wal.log in
+the table directory and made durable there, then applied to the segments,
+whose files are only made durable at a checkpoint. A checkpoint syncs the
+record stores, columns, indices and rollups, writes checkpoint.json and
+empties the log. So a batch costs one fsync, of the log, however many
+files it touches.
+
+wal.log is
+
+    <header>  - 'TS2W', version, 8 bytes
+    <entry>   - repeated: <payload bytes> <payload crc32> <lsn>, 16 bytes,
+                then the payload, the batch in JSON
+
+and every entry has a log sequence number (lsn) one greater than the entry
+before. A torn entry at the end of the log, from a crash while it was
+being written, is dropped when the log is opened.
+
+checkpoint.json holds the lsn of the last entry applied at the checkpoint
+and, per segment, what is needed to put the segment back the way it was
+then (see Segment.state). When a table is connected, the log entries past
+the checkpoint are the only ones that may be partly applied: the segments
+they touched are put back to the checkpoint and the entries applied again.
+Recovery costs the tail of the log, not the size of the table.
+"""
+from os.path import join, exists
+import json
+import os
+import struct
+import zlib
+
+import exceptions
+
+_HDR = struct.Struct('<4sHxx')
+_MAGIC = b'TS2W'
+_VERSION = 1
+_ENTRY = struct.Struct('<IIQ')
+
+CHECKPOINT = 'checkpoint.json'
+
+
+def ReadCheckpoint(path:str):
+    """
+    Return the checkpoint of table directory 'path', None if it has none.
+    """
+    cpath = join(path, CHECKPOINT)
+    if not exists(cpath):
+        return None
+    with open(cpath, 'rb') as fp:
+        return json.loads(fp.read())
+
+
+def WriteCheckpoint(path:str, ckpt:dict):
+    """
+    Durably replace the checkpoint of table directory 'path'.
+    """
+    tmp = join(path, CHECKPOINT + '.tmp')
+    with open(tmp, 'wb') as fp:
+        fp.write(json.dumps(ckpt).encode('utf-8'))
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp, join(path, CHECKPOINT))
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Wal:
+    """
+    The write ahead log of one table.
+
+    Methods:
+
+        Wal(path, lsn) - open (or create) the log, 'lsn' is that of the last checkpoint
+    append(payload, sync) - log 'payload', returns its lsn
+        entries(after) - iterate over (lsn, payload) of the entries past lsn 'after'
+                sync() - make every entry appended durable
+            truncate() - empty the log, after a checkpoint
+               close() - close the log
+
+    Attributes:
+
+         lsn - lsn of the last entry appended
+        size - bytes of entries in the log
+     pending - are there entries not yet durable
+    """
+
+    def __init__(self, path:str, lsn:int = 0):
+        self._path = path
+        if not exists(path):
+            with open(path, 'wb') as fp:
+                fp.write(_HDR.pack(_MAGIC, _VERSION))
+        self._fd = os.open(path, os.O_RDWR)
+        if os.fstat(self._fd).st_size < _HDR.size:
+            # The header of a log made just before a crash may not have
+            # reached the disk; the log is empty.
+            os.ftruncate(self._fd, 0)
+            os.pwrite(self._fd, _HDR.pack(_MAGIC, _VERSION), 0)
+            os.fsync(self._fd)
+        if _HDR.unpack(os.pread(self._fd, _HDR.size, 0))[0] != _MAGIC:
+            self.close()
+            raise exceptions.TableError("'%s' is not a write ahead log." % (path))
+        self._lsn = lsn
+        self._end = _HDR.size
+        self._pending = False
+        for entry in self._scan():
+            self._lsn = max(self._lsn, entry[0])
+        if self._end < os.fstat(self._fd).st_size:
+            # Drop a torn entry.
+            os.ftruncate(self._fd, self._end)
+
+    def _scan(self):
+        """
+        Iterate over the intact entries from the start, leaving _end just
+        past the last.
+        """
+        end = os.fstat(self._fd).st_size
+        pos = _HDR.size
+        while pos + _ENTRY.size <= end:
+            n, crc, lsn = _ENTRY.unpack(os.pread(self._fd, _ENTRY.size, pos))
+            payload = os.pread(self._fd, n, pos + _ENTRY.size)
+            if len(payload) < n or zlib.crc32(payload) != crc:
+                break
+            pos += _ENTRY.size + n
+            self._end = pos
+            yield lsn, payload
+
+    def get_lsn(self):
+        return self._lsn
+    lsn = property(get_lsn)
+
+    def get_size(self):
+        return self._end - _HDR.size
+    size = property(get_size)
+
+    def get_pending(self):
+        return self._pending
+    pending = property(get_pending)
+
+    def append(self, payload:dict, sync:bool = True):
+        """
+        Append 'payload' to the log and, if 'sync', make it durable.
+
+        Return:
+            lsn of the entry
+        """
+        data = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+        lsn = self._lsn + 1
+        os.pwrite(self._fd, _ENTRY.pack(len(data), zlib.crc32(data), lsn) + data, self._end)
+        self._end += _ENTRY.size + len(data)
+        self._lsn = lsn
+        self._pending = True
+        if sync:
+            self.sync()
+        return lsn
+
+    def entries(self, after:int):
+        for lsn, payload in self._scan():
+            if lsn > after:
+                yield lsn, json.loads(payload)
+
+    def sync(self):
+        if self._pending:
+            os.fsync(self._fd)
+            self._pending = False
+
+    def truncate(self):
+        os.ftruncate(self._fd, _HDR.size)
+        os.fsync(self._fd)
+        self._end = _HDR.size
+        self._pending = False
+
+    def close(self):
+        if self._fd is not None:
+            self.sync()
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,320 @@
+"""
+class ZoneMap  - what each block of a segment's column files can hold.
+class ZoneScan - a search step answered by scanning column blocks.
+
+Every insert batch appends one block to each column file of a segment (see
+columns.py), and, beside them, one entry to zones.dat describing it:
+
+    int, float - the smallest and largest value of the column in the block
+    str        - a Bloom filter of the values of the column in the block
+
+A scan of a column (a range on the time column, or a residual check that
+would otherwise read every record) looks at the entries first and reads
+and decodes only the blocks that may hold a match, so a selective scan of
+a large segment touches a few blocks rather than the whole file. The
+entries are small and kept in memory once read; like the column files, only
+the entries appended since the last look are read.
+
+zones.dat is
+
+    <header>  - 'TS2Z', version, 8 bytes
+    <entry>   - repeated, one per block: <payload bytes> <payload crc32>,
+                then the payload: for each column its name, its type and
+                either <min> <max> or <filter bytes> <filter>
+
+An entry is appended only once the column blocks it describes are written,
+so the entries also tell a reader in another process how many blocks are
+complete.
+"""
+from array import array
+from os.path import exists, join, dirname, basename, splitext
+import hashlib
+import os
+import struct
+import zlib
+
+from columns import ColumnFile, OFFSETS
+from index import Index
+import exceptions
+
+_HDR = struct.Struct('<4sHH')
+_MAGIC = b'TS2Z'
+_VERSION = 1
+_ENTRY = struct.Struct('<II')
+_NAME = struct.Struct('<BH')
+_LEN = struct.Struct('<I')
+
+_TYPES = {'str': 0, 'int': 1, 'float': 2}
+_TYPENAMES = {v: k for k, v in _TYPES.items()}
+_MINMAX = {'int': struct.Struct('<qq'), 'float': struct.Struct('<dd')}
+
+# Bits of Bloom filter per distinct value and the number of probes, for
+# about a 1% false positive rate.
+_BLOOMBITS = 10
+_PROBES = 7
+
+# Name of the zone map file of a segment.
+ZONES = 'zones.dat'
+
+
+def _probes(value:str, nbits:int):
+    h = hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest()
+    h1, h2 = struct.unpack('<II', h)
+    h2 |= 1
+    return [(h1 + i * h2) % nbits for i in range(_PROBES)]
+
+
+def Bloom(values):
+    """
+    Return the Bloom filter of the distinct 'values', as bytes.
+    """
+    distinct = set(values)
+    nbits = max(64, (len(distinct) * _BLOOMBITS + 7) & ~7)
+    bits = bytearray(nbits // 8)
+    for v in distinct:
+        for p in _probes(v, nbits):
+            bits[p >> 3] |= 1 << (p & 7)
+    return bytes(bits)
+
+
+def MayHold(bits:bytes, value:str):
+    """
+    Return False if the Bloom filter 'bits' can't hold 'value'.
+    """
+    return all(bits[p >> 3] & (1 << (p & 7)) for p in _probes(value, len(bits) * 8))
+
+
+def Match(zone, cmp:str, value):
+    """
+    Return False if a block described by 'zone' (None if there is no entry
+    for the column) can't hold a value satisfying the predicate.
+    """
+    if zone is None or cmp == '*':
+        return True
+    if isinstance(zone, bytes):
+        if cmp == '=':
+            return MayHold(zone, value)
+        if cmp == 'in':
+            return any(MayHold(zone, v) for v in value)
+        return True
+    low, high = zone
+    if cmp == '=':
+        return low <= value <= high
+    if cmp == 'in':
+        return any(low <= v <= high for v in value)
+    if cmp == '!=':
+        return not low == high == value
+    if cmp in ('<', '<='):
+        return low < value or (cmp == '<=' and low == value)
+    if cmp in ('>', '>='):
+        return high > value or (cmp == '>=' and high == value)
+    if cmp == 'between':
+        return high >= value[0] and low <= value[1]
+    if cmp == 'range':
+        return ((high > value[0] or (value[2] and high == value[0])) and
+                (low < value[1] or (value[3] and low == value[1])))
+    return True
+
+
+class ZoneMap:
+    """
+    The zone map of a segment.
+
+    Methods:
+
+      ZoneMap(path) - open (or create) the zone map file
+    append(values, cols) - describe a new block, 'values' being a dict of
+                           column to the values of the block and 'cols'
+                           the column types
+          entries() - dict of column to zone, per block
+    blocks(col, cmp, value) - the blocks that may hold a match of the predicate
+           flush() - force the entries to disk
+           close() - close the file
+
+    Attributes:
+
+      path - file path of the zone map
+      size - size of the file, in bytes
+    """
+
+    def __init__(self, path:str):
+        self._path = path
+        if not exists(path):
+            with open(path, 'wb') as fp:
+                fp.write(_HDR.pack(_MAGIC, _VERSION, 0))
+        self._fd = os.open(path, os.O_RDWR)
+        hdr = os.pread(self._fd, _HDR.size, 0)
+        if len(hdr) != _HDR.size or _HDR.unpack(hdr)[0] != _MAGIC:
+            self.close()
+            raise exceptions.TableError("'%s' is not a zone map." % (path))
+        self._entries = []
+        self._scanned = _HDR.size
+
+    def get_path(self):
+        return self._path
+    path = property(get_path)
+
+    def get_size(self):
+        return os.fstat(self._fd).st_size
+    size = property(get_size)
+
+    def append(self, values:dict, cols:dict):
+        out = bytearray()
+        for col, vals in values.items():
+            coltype = cols[col]
+            name = col.encode('utf-8')
+            out += _NAME.pack(_TYPES[coltype], len(name)) + name
+            if coltype == 'str':
+                bits = Bloom(vals)
+                out += _LEN.pack(len(bits)) + bits
+            else:
+                out += _MINMAX[coltype].pack(min(vals), max(vals))
+        payload = bytes(out)
+        os.pwrite(self._fd, _ENTRY.pack(len(payload), zlib.crc32(payload)) + payload,
+                  os.fstat(self._fd).st_size)
+
+    def _parse(self, payload:bytes):
+        zone = {}
+        pos = 0
+        while pos < len(payload):
+            code, n = _NAME.unpack_from(payload, pos)
+            pos += _NAME.size
+            col = payload[pos:pos + n].decode('utf-8')
+            pos += n
+            coltype = _TYPENAMES[code]
+            if coltype == 'str':
+                nbytes = _LEN.unpack_from(payload, pos)[0]
+                pos += _LEN.size
+                zone[col] = bytes(payload[pos:pos + nbytes])
+                pos += nbytes
+            else:
+                zone[col] = _MINMAX[coltype].unpack_from(payload, pos)
+                pos += _MINMAX[coltype].size
+        return zone
+
+    def entries(self):
+        """
+        Return the list of the zones of each block, a dict of column to
+        (min, max) or a Bloom filter. Only the entries appended since the
+        last call are read.
+        """
+        end = os.fstat(self._fd).st_size
+        if end < self._scanned:
+            # Cut back by a rollback.
+            self._entries = []
+            self._scanned = _HDR.size
+        pos = self._scanned
+        if pos < end:
+            data = os.pread(self._fd, end - pos, pos)
+            p = 0
+            while p + _ENTRY.size <= len(data):
+                n, crc = _ENTRY.unpack_from(data, p)
+                payload = data[p + _ENTRY.size:p + _ENTRY.size + n]
+                if len(payload) < n or zlib.crc32(payload) != crc:
+                    # Still being written.
+                    break
+                self._entries.append(self._parse(payload))
+                p += _ENTRY.size + n
+            self._scanned = pos + p
+        return self._entries
+
+    def blocks(self, col:str, cmp:str, value):
+        """
+        Return the numbers of the blocks that may hold a value of column
+        'col' satisfying the predicate.
+        """
+        return [n for n, zone in enumerate(self.entries()) if Match(zone.get(col), cmp, value)]
+
+    def flush(self):
+        os.fsync(self._fd)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __del__(self):
+        self.close()
+
+
+def Scan(zones:ZoneMap|None, column:ColumnFile, offsets:ColumnFile, index:Index|None,
+         cmp:str, value, test):
+    """
+    Return the sorted record offsets of the rows whose value in 'column'
+    satisfies the predicate, decoding only the blocks the zone map allows;
+    'test' tells whether a value satisfies it (see pgm.Test). 'index' is
+    the column's index for a str column. Without a zone map every block is
+    read.
+
+    Return:
+        (sorted array('Q') of record offsets, blocks read)
+    """
+    blocks = len(offsets.counts())
+    if zones is not None:
+        # Blocks with no entry yet are read.
+        picks = zones.blocks(splitext(basename(column.path))[0], cmp, value)
+        picks += range(len(zones.entries()), blocks)
+    else:
+        picks = range(blocks)
+    picks = {n: None for n in picks if n < blocks}
+    if not picks:
+        return array('Q'), 0
+    result = array('Q')
+    for vals, offs in zip(column.read(picks, index), offsets.read(picks)):
+        if vals is not None:
+            result.extend(o for v, o in zip(vals, offs) if test(v))
+    return result, len(picks)
+
+
+class ZoneScan:
+    """
+    A search step over a column's blocks rather than its index, for the
+    step paths ending in .col (see pgm.GetIndex).
+
+    Methods:
+
+      ZoneScan(path) - open the column file 'path' and what goes with it
+    scan(cmp, value, test) - sorted record offsets satisfying the predicate,
+                             'test' telling whether a value does
+          close() - close the files
+
+    Attributes:
+
+      path - file path of the column file
+     pages - blocks read since the scan was opened
+    """
+
+    def __init__(self, path:str):
+        self._path = path
+        self._pages = 0
+        base = dirname(path)
+        col = splitext(basename(path))[0]
+        self._index = Index(join(base, col + '.idx'))
+        self._column = ColumnFile(path, self._index.coltype)
+        self._offsets = ColumnFile(join(base, OFFSETS + '.col'), 'offset')
+        self._zones = ZoneMap(join(base, ZONES)) if exists(join(base, ZONES)) else None
+
+    def get_path(self):
+        return self._path
+    path = property(get_path)
+
+    def get_pages(self):
+        return self._pages
+    pages = property(get_pages)
+
+    def scan(self, cmp:str, value, test):
+        # Other processes append to the files.
+        self._column.refresh()
+        self._offsets.refresh()
+        index = self._index if self._index.coltype == 'str' else None
+        result, n = Scan(self._zones, self._column, self._offsets, index, cmp, value, test)
+        self._pages += n
+        return result
+
+    def close(self):
+        self._index.close()
+        self._column.close()
+        self._offsets.close()
+        if self._zones is not None:
+            self._zones.close()
+
@@ -0,0 +1,44 @@
+"""
+Shared fixtures of the ts2db tests. The ts2db modules import each other by
+their plain names, so their directory is put on the path, as server.py and
+bench.py do.
+"""
+from os.path import join, dirname, abspath
+import sys
+
+import pytest
+
+SRC = join(dirname(dirname(abspath(__file__))), 'src')
+sys.path.insert(0, SRC)
+sys.path.insert(0, join(SRC, 'ts2db'))
+
+from database import DB, Table, TABLEDEF
+from user import User
+
+
+@pytest.fixture
+def user(tmp_path):
+    u = User()
+    u.home = str(tmp_path)
+    u.idxsize = 1 << 16
+    return u
+
+
+@pytest.fixture
+def table(user):
+    """
+    A Table of an empty database, searching in this process and caching no
+    results, so every query runs in full.
+    """
+    return Table(DB('db', user), {'cachesize': 0})
+
+
+def MakeTable(table:Table, name:str, cols:dict, opts:dict|None = None, ordered:list|None = None):
+    """
+    Create table 'name' with columns 'cols', dict of name to type.
+    """
+    td = TABLEDEF(name)
+    for col, coltype in cols.items():
+        td.AddCol(col, coltype, col in (ordered or []))
+    table.create(name, td, opts or {})
+    return td
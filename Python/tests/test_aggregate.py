@@ -0,0 +1,102 @@
+"""
+Aggregates, answered from the rollups kept at ingest, checked against
+computing them from the rows inserted.
+"""
+import random
+
+import pytest
+
+from conftest import MakeTable
+from database import Table
+from metrics import metrics
+from sql import SQL
+
+COLS = {'ts': 'int', 'dev': 'str', 'v': 'float', 'n': 'int'}
+FUNCS = ['count', 'sum', 'min', 'max', 'avg']
+
+
+def aggregate(rows:list, col:str, group:int|None, test=lambda r: True):
+    """
+    Return {bucket: {'count(col)': ..., ...}} of the rows passing 'test'.
+    """
+    buckets = {}
+    for r in rows:
+        if test(r):
+            buckets.setdefault(r['ts'] - r['ts'] % group if group else None, []).append(r[col])
+    return {k: {'count(%s)' % col: len(vs), 'sum(%s)' % col: pytest.approx(sum(vs)),
+                'min(%s)' % col: min(vs), 'max(%s)' % col: max(vs),
+                'avg(%s)' % col: pytest.approx(sum(vs) / len(vs))} for k, vs in buckets.items()}
+
+
+def select(col:str):
+    return 'SELECT %s FROM t' % ', '.join('%s(%s)' % (f, col) for f in FUNCS)
+
+
+def grouped(found:list, col:str, group:int|None):
+    """
+    Return the result rows of a query by bucket, leaving out the empty ones.
+    """
+    count = 'count(%s)' % col
+    if not group:
+        return {None: found[0]} if found and found[0][count] else {}
+    return {r.pop('ts'): r for r in found if r[count]}
+
+
+@pytest.fixture
+def loaded(table):
+    MakeTable(table, 't', COLS, {'timecol': 'ts', 'partition': 'hour',
+                                 'rollups': {'v': ['minute', 'hour']}})
+    rnd = random.Random(8)
+    rows = []
+    for b in range(6):
+        batch = [{'ts': rnd.randrange(4 * 3600), 'dev': 'd%d' % rnd.randrange(3),
+                  'v': round(rnd.uniform(-50, 50), 3), 'n': rnd.randrange(100)} for i in range(300)]
+        table.insert_many('t', batch)
+        rows.extend(batch)
+    return table, rows
+
+
+def check(sql:SQL, rows:list):
+    for where, group, test in (
+            ('', None, lambda r: True),
+            (' GROUP BY TIME(600)', 600, lambda r: True),
+            (' WHERE ts >= 3600 AND ts < 10800 GROUP BY TIME(3600)', 3600, lambda r: 3600 <= r['ts'] < 10800),
+            (' WHERE ts >= 60 AND ts < 120', None, lambda r: 60 <= r['ts'] < 120)):
+        statement = select('v') + where
+        assert [r['instruction'] for r in sql.execute('EXPLAIN ' + statement) if 'instruction' in r] == ['rollup']
+        assert grouped(sql.execute(statement), 'v', group) == aggregate(rows, 'v', group, test), statement
+
+
+def test_rollups(loaded):
+    table, rows = loaded
+    sql = SQL(table)
+    check(sql, rows)
+    # Deletes and updates take their rows out of the rollups.
+    sql.execute("DELETE FROM t WHERE dev = 'd1'")
+    rows = [r for r in rows if r['dev'] != 'd1']
+    sql.execute("UPDATE t SET v = 99.5 WHERE n < 10")
+    rows = [dict(r, v=99.5) if r['n'] < 10 else r for r in rows]
+    check(sql, rows)
+    check(SQL(Table(table.db, {'cachesize': 0})), rows)
+
+
+@pytest.mark.parametrize('where,group,test', [
+    ("dev = 'd1'", 600, lambda r: r['dev'] == 'd1'),
+    ("ts >= 100 AND ts < 5000", None, lambda r: 100 <= r['ts'] < 5000),
+    ("n < 50 AND NOT dev = 'd0'", 3600, lambda r: r['n'] < 50 and r['dev'] != 'd0'),
+    ("dev = 'none'", 600, lambda r: False),
+])
+def test_columns(loaded, where, group, test):
+    """
+    Aggregates the rollups can't answer are computed from the column files
+    of the columns aggregated, reading no records.
+    """
+    table, rows = loaded
+    sql = SQL(table)
+    for col in ('v', 'n'):
+        statement = select(col) + ' WHERE ' + where + (' GROUP BY TIME(%d)' % group if group else '')
+        ops = [r['instruction'] for r in sql.execute('EXPLAIN ' + statement) if 'instruction' in r]
+        assert 'columns' in ops and 'fetch' not in ops and 'rollup' not in ops
+        fetched = metrics.snapshot()['counters'].get('fetch_records', 0)
+        assert grouped(sql.execute(statement), col, group) == aggregate(rows, col, group, test), statement
+        assert metrics.snapshot()['counters'].get('fetch_records', 0) == fetched
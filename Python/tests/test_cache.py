@@ -0,0 +1,73 @@
+"""
+The result cache, and the cached results extended as tables are appended to.
+"""
+import pytest
+
+from cache import ResultCache
+from conftest import MakeTable
+from database import DB, Table
+from metrics import metrics
+from sql import SQL
+from test_wal import COLS, rows
+
+
+def test_lru():
+    cache = ResultCache(100)
+    cache.put(('a', 1), 'A1', 40)
+    cache.put(('b', 1), 'B1', 40)
+    assert cache.get(('a', 1)) == 'A1'
+    # The least recently used goes to make room.
+    cache.put(('a', 2), 'A2', 40)
+    assert cache.get(('b', 1)) is None and cache.entries == 2 and cache.bytes == 80
+    cache.put(('a', 2), 'A2', 10)
+    assert cache.bytes == 50
+    cache.put(('c', 1), 'big', 101)
+    assert cache.get(('c', 1)) is None
+    cache.invalidate('a')
+    assert cache.entries == 0 and cache.bytes == 0
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def counters(*names):
+    found = metrics.snapshot()['counters']
+    return [found.get(n, 0) for n in names]
+
+
+@pytest.fixture
+def cached(user):
+    table = Table(DB('db', user), {'cachesize': 1 << 20})
+    MakeTable(table, 't', COLS, {'timecol': 'ts', 'partition': 'hour'})
+    table.insert_many('t', rows(0, 1000))
+    return table
+
+
+def test_hit_extend_miss(cached):
+    sql = SQL(cached)
+    statement = "SELECT * FROM t WHERE dev = 'd1'"
+    first = sql.execute(statement)
+    before = counters('result_hits', 'result_extends', 'result_misses')
+    again = sql.execute(statement)
+    assert again == first
+    again.clear()
+    assert sql.execute(statement) == first
+    assert counters('result_hits', 'result_extends', 'result_misses') == [before[0] + 2, before[1], before[2]]
+
+    # Appended rows, to a segment cached and to a new one, extend the result.
+    new = rows(1000, 10) + rows(7200, 10)
+    cached.insert_many('t', new)
+    found = sql.execute(statement)
+    assert sorted(r['ts'] for r in found) == sorted(r['ts'] for r in rows(0, 1000) + new if r['dev'] == 'd1')
+    assert counters('result_extends')[0] == before[1] + 1
+
+    # Rows taken away can't be extended over: the result is computed again.
+    sql.execute("DELETE FROM t WHERE ts < 500")
+    misses = counters('result_misses')[0]
+    found = sql.execute(statement)
+    assert sorted(r['ts'] for r in found) == sorted(r['ts'] for r in rows(500, 500) + new if r['dev'] == 'd1')
+    assert counters('result_misses')[0] == misses + 1
+
+    # Nor are ordered results.
+    ordered = "SELECT * FROM t WHERE dev = 'd2' ORDER BY ts DESC LIMIT 3"
+    assert [r['ts'] for r in sql.execute(ordered)] == [7206, 7202, 1006]
+    cached.insert_many('t', rows(8000, 4))
+    assert [r['ts'] for r in sql.execute(ordered)] == [8002, 7206, 7202]
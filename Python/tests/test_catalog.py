@@ -0,0 +1,58 @@
+"""
+The catalog of database and table definitions.
+"""
+import os
+
+import pytest
+
+from catalog import Catalog, WriteInfo, INFO
+from conftest import MakeTable
+from database import DB, Table
+
+
+def test_info(tmp_path):
+    path = str(tmp_path)
+    cat = Catalog()
+    with pytest.raises(FileNotFoundError):
+        cat.info(path)
+    WriteInfo(path, {'table': {'a': 'int'}})
+    assert cat.info(path) == {'table': {'a': 'int'}}
+    assert cat.info(path) is cat.info(path)
+    assert (cat.hits, cat.misses) == (2, 1)
+    # Rewritten, here with another codec, it is read again.
+    WriteInfo(path, {'table': {'a': 'int', 'b': 'str'}}, 'lzma')
+    assert cat.info(path) == {'table': {'a': 'int', 'b': 'str'}}
+    assert cat.misses == 2
+    WriteInfo(path, {'plain': True}, 'none')
+    with open(os.path.join(path, INFO), 'rb') as fp:
+        assert fp.read(1) == b'{'
+    assert cat.info(path) == {'plain': True}
+    cat.invalidate(path)
+    cat.info(path)
+    assert cat.misses == 4
+
+
+def test_tables(tmp_path):
+    cat = Catalog()
+    dbpath = str(tmp_path)
+    assert cat.tables(dbpath) == []
+    for name in ('b', 'a'):
+        os.mkdir(tmp_path / name)
+        WriteInfo(str(tmp_path / name), {})
+    os.mkdir(tmp_path / 'notatable')
+    assert cat.tables(dbpath) == ['a', 'b']
+    assert cat.tables(dbpath) == ['a', 'b'] and cat.hits == 1
+
+
+def test_tables_of_db(table, user):
+    MakeTable(table, 't1', {'ts': 'int'})
+    db = table.db
+    assert db.list(None, False) == ['t1']
+    # What another Table of the database makes and drops is seen at once.
+    other = Table(DB('db', user), {'cachesize': 0})
+    MakeTable(other, 't2', {'ts': 'int', 'dev': 'str'})
+    assert db.list(None, False) == ['t1', 't2']
+    assert db.list('t2', True) == {'t2': {'ts': 'int', 'dev': 'str'}}
+    assert db.list(['t1', 'nosuch'], False) == ['t1']
+    other.delete('t1', True)
+    assert db.list(None, False) == ['t2']
@@ -0,0 +1,76 @@
+"""
+The codecs records and info files are compressed with.
+"""
+import json
+
+import pytest
+
+from bench import Compare
+from codec import Available, Parse, Compress, Decompress, Unpack, Benchmark, CODECS
+from conftest import MakeTable
+from records import RecordStore
+from sql import SQL
+import exceptions
+
+DATA = json.dumps([{'ts': i, 'dev': 'device-%d' % (i % 10), 'v': i / 8} for i in range(200)]).encode()
+
+
+def test_parse():
+    assert Parse('none') == ('none', 0)
+    assert Parse('zlib') == ('zlib', 1) and Parse('zlib:9') == ('zlib', 9)
+    assert Parse('lzma') == ('lzma', 1)
+    for spec in ('gzip', 'zlib:10', 'zlib:x', 'bz2:0'):
+        with pytest.raises(exceptions.TypeError):
+            Parse(spec)
+    for name in CODECS:
+        if name not in Available():
+            with pytest.raises(exceptions.TypeError):
+                Parse(name)
+
+
+@pytest.mark.parametrize('name', Available())
+def test_round_trip(name):
+    packed = Compress(DATA, name)
+    assert Decompress(CODECS[name][0], packed) == DATA
+    assert Unpack(packed) == DATA
+    if name != 'none':
+        assert len(packed) < len(DATA)
+
+
+def test_unknown():
+    with pytest.raises(exceptions.TypeError):
+        Decompress(99, b'')
+    assert Unpack(b'{"a": 1}') == b'{"a": 1}'
+
+
+def test_mixed_store(tmp_path):
+    path = str(tmp_path / 'records.dat')
+    rows = [{'ts': i, 'text': 'abc' * (i % 100)} for i in range(300)]
+    offsets = []
+    # Every frame says how it was compressed, whatever the store uses now.
+    for n, name in enumerate(Available()):
+        store = RecordStore(path, name)
+        offsets += store.append_many(rows[n * 50:(n + 1) * 50])
+        store.close()
+    store = RecordStore(path, 'zlib:6')
+    assert store.read_many(offsets) == rows[:len(offsets)]
+
+
+def test_table_codec(table):
+    MakeTable(table, 't', {'ts': 'int', 'dev': 'str'}, {'codec': 'lzma:0'})
+    rows = [{'ts': i, 'dev': 'device-%d' % (i % 10) * 20} for i in range(500)]
+    table.insert_many('t', rows)
+    assert sorted(r['ts'] for r in SQL(table).execute("SELECT * FROM t WHERE dev = '%s'" % rows[3]['dev'])) == \
+        list(range(3, 500, 10))
+    report = table.codecs('t', 100, ['none', 'zlib:1', 'bz2'])
+    assert sorted(r['codec'] for r in report) == ['bz2:9', 'none', 'zlib:1']
+    assert report[-1]['codec'] == 'none' and report[-1]['ratio'] == 1.0
+    assert Benchmark([], ['zlib'], 0.0)[0]['ratio'] == 1.0
+
+
+def test_compare_throughput():
+    old = {'meta': {}, 'results': {'codecs': {'zlib:6': {'compress_mbs': 40.0, 'decompress_mbs': 200.0}}}}
+    faster = {'meta': {}, 'results': {'codecs': {'zlib:6': {'compress_mbs': 80.0, 'decompress_mbs': 400.0}}}}
+    # Codec MB/s is a throughput: a drop is a regression, a speed-up isn't.
+    assert Compare(old, faster) == 0
+    assert Compare(faster, old) == 2
@@ -0,0 +1,107 @@
+"""
+Index files growing as they fill, and the compaction rebuilding those
+mostly made of tombstones, in the foreground and by the Compactor.
+"""
+import time
+
+from conftest import MakeTable
+from database import DB, Table, Compactor
+from index import Index
+from sql import SQL
+from test_index import MakeIndex
+
+COLS = {'ts': 'int', 'dev': 'str', 'v': 'float'}
+
+
+def rows(first:int, n:int):
+    return [{'ts': i, 'dev': 'dev%d' % i, 'v': i / 2} for i in range(first, first + n)]
+
+
+def key(found):
+    return sorted(r['ts'] for r in found)
+
+
+def test_reader_follows_growth(tmp_path):
+    path = str(tmp_path / 'c.idx')
+    writer = MakeIndex(path, 'int')
+    reader = Index(path)
+    # Few values with many pointers grow the heap, and the file in place.
+    for i in range(0, 4000, 400):
+        values = [o % 3 for o in range(i, i + 400)]
+        assert not writer.reserve(values)
+        writer.insert_many(values, range(i, i + 400))
+    assert writer.size > 4096
+    assert list(reader.lookup(2)) == list(range(2, 4000, 3))
+    assert reader.size == writer.size
+
+
+def test_grow_and_compact(user):
+    user.idxsize = 4096
+    table = Table(DB('db', user), {'cachesize': 0})
+    MakeTable(table, 't', COLS)
+    for i in range(0, 3000, 300):
+        table.insert_many('t', rows(i, 300))
+    idx = table.connection('t').segments[None].indices['dev']
+    assert idx.size > 4096 and idx.count == 3000
+    sql = SQL(table)
+    assert key(sql.execute("SELECT * FROM t WHERE dev = 'dev2999'")) == [2999]
+
+    assert sql.execute('DELETE FROM t WHERE ts >= 500')[0]['deleted'] == 2500
+    # Under the ratio nothing is rebuilt; the pointers are reclaimed.
+    assert table.compact('t', 0.9) == 0
+    idx = table.connection('t').segments[None].indices['dev']
+    assert idx.ntomb == 2500 and idx.nrefs == 500
+    assert table.compact('t', 0.5) == len(COLS)
+    idx = table.connection('t').segments[None].indices['dev']
+    assert idx.ntomb == 0 and idx.nrefs == 500
+    # Ids are kept, as the str column files hold them.
+    assert idx.count == 3000 and idx.id('dev2999') == 2999
+
+    # The queries, whose indices were mapped before, see the files rebuilt.
+    assert key(sql.execute("SELECT * FROM t WHERE dev = 'dev2999'")) == []
+    assert key(sql.execute('SELECT * FROM t WHERE v >= 200')) == list(range(400, 500))
+    table.insert_many('t', rows(5000, 10))
+    again = Table(table.db, {'cachesize': 0})
+    assert key(SQL(again).execute('SELECT * FROM t')) == list(range(500)) + list(range(5000, 5010))
+
+
+def test_crash_after_rebuild(user, table):
+    """
+    A crash after indices were rebuilt, before the checkpoint that follows:
+    recovery rolls the rebuilt files back to the checkpoint before.
+    """
+    MakeTable(table, 't', COLS)
+    batch = [{'ts': i, 'dev': 'd%d' % (i % 7), 'v': float(i % 5)} for i in range(300)]
+    table.insert_many('t', batch[:100])
+    table.checkpoint('t')
+    table.insert_many('t', batch[100:200])
+    for idx in table.connection('t').segments[None].indices.values():
+        idx.rebuild()
+        idx.flush()
+    table.insert_many('t', batch[200:])
+
+    sql = SQL(Table(DB('db', user), {'cachesize': 0}))
+    for where, test in (("dev = 'd3' OR ts = 5", lambda r: r['dev'] == 'd3' or r['ts'] == 5),
+                        ("v = 2.0", lambda r: r['v'] == 2.0),
+                        ("ts >= 150 AND dev = 'd1'", lambda r: r['ts'] >= 150 and r['dev'] == 'd1')):
+        assert key(sql.execute('SELECT * FROM t WHERE ' + where)) == key(filter(test, batch)), where
+
+
+def test_compactor(table):
+    MakeTable(table, 't', COLS)
+    table.insert_many('t', rows(0, 1000))
+    compactor = Compactor(table, 0.05, 0.5)
+    compactor.start()
+    try:
+        SQL(table).execute('DELETE FROM t WHERE ts < 900')
+        idx = table.connection('t').segments[None].indices['ts']
+        for i in range(100):
+            if not idx.ntomb and idx.nrefs == 100:
+                break
+            time.sleep(0.05)
+            idx = table.connection('t').segments[None].indices['ts']
+        assert idx.ntomb == 0 and idx.nrefs == 100
+    finally:
+        compactor.stop()
+    assert not compactor.is_alive()
+    assert key(SQL(table).execute('SELECT * FROM t WHERE ts >= 0')) == list(range(900, 1000))
@@ -0,0 +1,116 @@
+"""
+Tombstone based DELETE and UPDATE, the snapshot a query reads and the
+compaction reclaiming what no query may still see.
+"""
+from array import array
+import random
+
+import pytest
+
+from conftest import MakeTable
+from database import Table
+from sql import SQL
+from test_sql import key
+from tombstones import Tombstones
+
+COLS = {'ts': 'int', 'dev': 'str', 'v': 'float', 'n': 'int'}
+
+
+def test_tombstones(tmp_path):
+    path = str(tmp_path / 'deleted.dat')
+    tomb = Tombstones(path)
+    assert tomb.size is None and tomb.count == 0
+    offsets = array('Q', range(0, 800, 8))
+    assert tomb.visible(offsets, 800, 0) == offsets
+    tomb.append([16, 0])
+    tomb.append([])
+    tomb.append([80])
+    assert tomb.count == 3
+    # A reader pinned before a delete still sees its records.
+    assert list(tomb.visible(offsets, 800, 0)) == list(offsets)
+    assert 0 not in tomb.visible(offsets, 800, 2) and 80 in tomb.visible(offsets, 800, 2)
+    assert list(tomb.visible(offsets, 40, 3)) == [8, 24, 32]
+    assert list(tomb.deleted(0, 3)) == [0, 16, 80] and list(tomb.deleted(2, 3)) == [80]
+    tomb.close()
+    # A torn last delete is dropped on reopening.
+    with open(path, 'ab') as fp:
+        fp.write(b'\x02\x00\x00\x00\x00\x00\x00\x00torn')
+    tomb = Tombstones(path)
+    assert tomb.count == 3 and list(tomb.deleted(0, 3)) == [0, 16, 80]
+    tomb.close()
+
+
+@pytest.fixture(params=[None, 'hour'], ids=['single', 'partitioned'])
+def loaded(request, table):
+    opts = {'timecol': 'ts'}
+    if request.param:
+        opts['partition'] = request.param
+    MakeTable(table, 't', COLS, opts, ordered=['n'])
+    rnd = random.Random(3)
+    rows = [{'ts': i * 5, 'dev': 'd%d' % rnd.randrange(5), 'v': round(rnd.random() * 100, 2),
+             'n': rnd.randrange(1000)} for i in range(2000)]
+    for i in range(0, len(rows), 500):
+        table.insert_many('t', rows[i:i+500])
+    return table, rows
+
+
+def test_delete_update(loaded):
+    table, rows = loaded
+    sql = SQL(table)
+    assert sql.execute("DELETE FROM t WHERE dev = 'd1' AND n < 500")[0]['deleted'] == \
+        len([r for r in rows if r['dev'] == 'd1' and r['n'] < 500])
+    rows = [r for r in rows if not (r['dev'] == 'd1' and r['n'] < 500)]
+    assert sql.execute("DELETE FROM t WHERE dev = 'd1' AND n < 500") == [{'deleted': 0}]
+
+    # The new versions may move to another partition.
+    assert sql.execute("UPDATE t SET ts = 9000, v = 1.5 WHERE n >= 900")[0]['updated'] == \
+        len([r for r in rows if r['n'] >= 900])
+    rows = [dict(r, ts=9000, v=1.5) if r['n'] >= 900 else r for r in rows]
+    assert sql.execute("UPDATE t SET dev = 'dx' WHERE dev = 'd2' OR ts = 9000")[0]['updated'] == \
+        len([r for r in rows if r['dev'] == 'd2' or r['ts'] == 9000])
+    rows = [dict(r, dev='dx') if r['dev'] == 'd2' or r['ts'] == 9000 else r for r in rows]
+
+    assert key(sql.execute('SELECT * FROM t')) == key(rows)
+    for where, test in (("dev = 'dx'", lambda r: r['dev'] == 'dx'),
+                        ("n >= 900", lambda r: r['n'] >= 900),
+                        ("ts >= 8000", lambda r: r['ts'] >= 8000),
+                        ("dev = 'd1'", lambda r: r['dev'] == 'd1')):
+        assert key(sql.execute('SELECT * FROM t WHERE ' + where)) == key(r for r in rows if test(r))
+
+    # Compacting changes nothing a query finds, nor does reopening.
+    table.compact('t', 0.01)
+    assert key(sql.execute("SELECT * FROM t WHERE dev = 'dx'")) == key(r for r in rows if r['dev'] == 'dx')
+    again = Table(table.db, {'cachesize': 0})
+    assert key(SQL(again).execute('SELECT * FROM t')) == key(rows)
+
+
+def test_snapshot(loaded):
+    table, rows = loaded
+    sql = SQL(table)
+    batches = sql.stream('SELECT * FROM t', 100)
+    got = next(batches)
+    # Changes made while the query reads aren't seen by it.
+    sql.execute("DELETE FROM t WHERE n >= 0")
+    table.insert_many('t', [{'ts': 1, 'dev': 'new', 'v': 0.0, 'n': 1}])
+    sql.execute("UPDATE t SET v = 2.5 WHERE dev = 'new'")
+    for batch in batches:
+        got.extend(batch)
+    assert key(got) == key(rows)
+    assert sql.execute('SELECT * FROM t') == [{'ts': 1, 'dev': 'new', 'v': 2.5, 'n': 1}]
+
+
+def test_reclaim_horizon(loaded):
+    table, rows = loaded
+    sql = SQL(table)
+    conn = table.connection('t')
+    snapshot = conn.pin()
+    deleted = sql.execute("DELETE FROM t WHERE dev = 'd3'")[0]['deleted']
+    # The pointers to the rows deleted stay while a reader may see them.
+    table.compact('t')
+    assert all(not s.meta.get('reclaimed') for s in conn.segments.values())
+    conn.unpin(snapshot)
+    table.compact('t')
+    assert sum(s.meta.get('reclaimed', 0) for s in conn.segments.values()) == \
+        sum(s.tombstones.count for s in conn.segments.values()) == deleted
+    assert key(sql.execute('SELECT * FROM t')) == key(r for r in rows if r['dev'] != 'd3')
+    assert sql.execute("SELECT * FROM t WHERE dev = 'd3'") == []
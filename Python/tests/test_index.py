@@ -0,0 +1,99 @@
+"""
+The mmap index against a dict of value to record offsets.
+"""
+import random
+
+import pytest
+
+from index import Index
+import exceptions
+
+
+def MakeIndex(path, coltype:str, size:int = 4096):
+    with open(path, 'wb') as fp:
+        fp.write(bytes(size))
+    return Index(str(path), coltype)
+
+
+def check(idx:Index, model:dict):
+    assert idx.count == len(model)
+    assert idx.nrefs == sum(len(o) for o in model.values())
+    for v, offsets in model.items():
+        assert sorted(idx.lookup(v)) == sorted(offsets)
+        assert idx.value(idx.id(v)) == v
+    assert sorted(idx.domain()) == sorted(model)
+
+
+@pytest.mark.parametrize('coltype,make', [('int', lambda r: r.randrange(-50, 50)),
+                                          ('float', lambda r: r.randrange(100) / 4),
+                                          ('str', lambda r: 'v%d' % r.randrange(100))])
+def test_insert_grow_delete_rebuild(tmp_path, coltype, make):
+    rnd = random.Random(3)
+    idx = MakeIndex(tmp_path / 'c.idx', coltype)
+    model = {}
+    offset = 0
+    ids = {}
+    for batch in range(20):
+        values = [make(rnd) for i in range(rnd.randrange(1, 200))]
+        offsets = list(range(offset, offset + len(values)))
+        offset += len(values)
+        # Room is made first, growing or rebuilding the file.
+        if idx.reserve(values):
+            idx = Index(str(tmp_path / 'c.idx'))
+        idx.insert_many(values, offsets)
+        for v, o in zip(values, offsets):
+            model.setdefault(v, []).append(o)
+        ids.update({v: idx.id(v) for v in values})
+    check(idx, model)
+    assert idx.size > 4096
+
+    gone = rnd.sample([(v, o) for v, offs in model.items() for o in offs], 300)
+    assert idx.delete_many([v for v, o in gone], [o for v, o in gone]) == 300
+    for v, o in gone:
+        model[v].remove(o)
+    assert idx.ntomb == 300
+    assert not idx.delete(gone[0][0], gone[0][1])
+    for v in [v for v, offs in model.items() if not offs]:
+        model[v] = []
+    assert {v: sorted(idx.lookup(v)) for v in model} == {v: sorted(o) for v, o in model.items()}
+
+    # A rebuild drops the tombstones and keeps every id.
+    idx.rebuild()
+    idx = Index(str(tmp_path / 'c.idx'))
+    assert idx.ntomb == 0
+    check(idx, model)
+    assert {v: idx.id(v) for v in ids} == ids
+    idx.close()
+
+
+def test_int_lookup_of_float(tmp_path):
+    idx = MakeIndex(tmp_path / 'c.idx', 'int')
+    idx.insert_many([1, 2, 2], [0, 8, 16])
+    assert list(idx.lookup(2.0)) == [8, 16]
+    # Not truncated to 1.
+    assert idx.id(1.5) is None
+    assert list(idx.lookup(1.5)) == []
+    assert idx.extent() == (1, 2)
+
+
+def test_reopen(tmp_path):
+    idx = MakeIndex(tmp_path / 'c.idx', 'str')
+    idx.insert_many(['a', 'b', 'a'], [0, 8, 16])
+    idx.flush()
+    idx.close()
+    idx = Index(str(tmp_path / 'c.idx'))
+    assert idx.coltype == 'str'
+    assert list(idx.lookup('a')) == [0, 16]
+
+
+def test_bad_files(tmp_path):
+    with open(tmp_path / 'small.idx', 'wb') as fp:
+        fp.write(bytes(64))
+    with pytest.raises(exceptions.IndexError):
+        Index(str(tmp_path / 'small.idx'), 'int')
+    with open(tmp_path / 'junk.idx', 'wb') as fp:
+        fp.write(b'junk' + bytes(8192))
+    with pytest.raises(exceptions.IndexError):
+        Index(str(tmp_path / 'junk.idx'), 'int')
+    with pytest.raises(exceptions.TypeError):
+        MakeIndex(tmp_path / 'new.idx', 'blob')
@@ -0,0 +1,99 @@
+"""
+The Indexer processes running the steps of programs, against the same
+programs run in this process.
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+
+import pytest
+
+from conftest import MakeTable
+from database import Table
+from pgm import Startup, Shutdown
+import pgm
+from sql import SQL
+from test_sql import COLS, WHERES, key
+
+
+@pytest.fixture(scope='module')
+def queues():
+    queues = Startup(2)
+    yield queues
+    Shutdown(queues)
+    # Each closes the indices and column scans it mapped.
+    assert [p.exitcode for p in queues[2]] == [0, 0]
+
+
+@pytest.fixture
+def tables(table, queues):
+    """
+    The same database read by a Table searching in this process and by
+    one handing the steps to the Indexers.
+    """
+    MakeTable(table, 't', COLS, {'timecol': 'ts', 'partition': 'hour'}, ordered=['n'])
+    rnd = random.Random(9)
+    rows = [{'ts': i * 5, 'dev': 'd%d' % rnd.randrange(5), 'v': round(rnd.random() * 100, 2),
+             'n': rnd.randrange(1000)} for i in range(2000)]
+    table.insert_many('t', rows)
+    return table, Table(table.db, {'cachesize': 0}, queues)
+
+
+def test_same_rows(tables):
+    local, remote = tables
+    for where, test in WHERES:
+        statement = 'SELECT * FROM t WHERE ' + where
+        assert key(SQL(remote).execute(statement)) == key(SQL(local).execute(statement)), where
+
+
+def test_concurrent(tables):
+    local, remote = tables
+    sql = SQL(remote)
+    statements = ['SELECT * FROM t WHERE ' + where for where, test in WHERES[:12]]
+    expected = [key(SQL(local).execute(s)) for s in statements]
+    failed = []
+
+    def run(n):
+        for i in range(len(statements)):
+            s = (n + i) % len(statements)
+            if key(sql.execute(statements[s])) != expected[s]:
+                failed.append(statements[s])
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not failed
+
+    async def gather():
+        return await asyncio.gather(*[sql.execute_async(s) for s in statements])
+
+    assert [key(rows) for rows in asyncio.run(gather())] == expected
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/maps'), reason='reads /proc/<pid>/maps')
+def test_dropped_files_unmapped(table, monkeypatch):
+    monkeypatch.setattr(pgm, 'SWEEP', 0.1)
+    queues = Startup(1)
+    try:
+        MakeTable(table, 't', COLS, {'timecol': 'ts', 'partition': 'hour'})
+        table.insert_many('t', [{'ts': i * 60, 'dev': 'd%d' % (i % 3), 'v': 1.0, 'n': i} for i in range(120)])
+        remote = Table(table.db, {'cachesize': 0}, queues)
+        assert len(SQL(remote).execute("SELECT * FROM t WHERE dev = 'd1'")) == 40
+        dropped = os.path.join(remote.connection('t').path, '0', '')
+        maps = '/proc/%d/maps' % queues[2][0].pid
+
+        def mapped():
+            with open(maps) as fp:
+                return dropped in fp.read()
+        assert mapped()
+        remote.expire('t', 3600)
+        deadline = time.monotonic() + 5
+        while mapped() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert not mapped()
+    finally:
+        Shutdown(queues)
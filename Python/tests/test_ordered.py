@@ -0,0 +1,90 @@
+"""
+The ordered index over an int or float column, against sorting the values.
+"""
+import random
+
+import pytest
+
+from ordered import OrderedIndex
+import exceptions
+import ordered
+
+
+def expected(model:list, low, high, lowincl:bool, highincl:bool):
+    return sorted(o for v, o in model
+                  if (low is None or v > low or (lowincl and v == low))
+                  and (high is None or v < high or (highincl and v == high)))
+
+
+def check(idx:OrderedIndex, model:list, rnd:random.Random):
+    assert idx.count == len(model)
+    for i in range(50):
+        low, high = sorted(rnd.uniform(-10, 110) for j in range(2))
+        if rnd.random() < 0.3:
+            low = round(low)
+            high = round(high)
+        if rnd.random() < 0.1:
+            low = None
+        if rnd.random() < 0.1:
+            high = None
+        lowincl, highincl = rnd.random() < 0.5, rnd.random() < 0.5
+        assert list(idx.range(low, high, lowincl, highincl)) == expected(model, low, high, lowincl, highincl)
+
+
+@pytest.mark.parametrize('coltype', ['int', 'float'])
+def test_range(tmp_path, coltype):
+    rnd = random.Random(6)
+    path = str(tmp_path / 'c.ord')
+    idx = OrderedIndex(path, coltype)
+    model = []
+    offset = 0
+    for batch in range(40):
+        n = rnd.choice([1, 10, 300, 700])
+        values = [rnd.randrange(100) if coltype == 'int' else rnd.uniform(0, 100) for i in range(n)]
+        offsets = list(range(offset, offset + n))
+        offset += n
+        idx.append(values, offsets)
+        model.extend(zip(values, offsets))
+    # Merged like a binary counter.
+    assert idx.runs <= len(model).bit_length()
+    check(idx, model, rnd)
+    assert list(idx.range(None, None)) == list(range(offset))
+    idx.close()
+    check(OrderedIndex(path), model, rnd)
+
+
+def test_rollback_and_rewrite(tmp_path, monkeypatch):
+    rnd = random.Random(2)
+    path = str(tmp_path / 'c.ord')
+    idx = OrderedIndex(path, 'int')
+    model = [(rnd.randrange(100), o) for o in range(1000)]
+    idx.append([v for v, o in model], [o for v, o in model])
+    state = idx.state()
+    idx.append([1, 2, 3], [5000, 5001, 5002])
+    assert idx.rollback(state)
+    check(idx, model, rnd)
+
+    # A file mostly made of runs merged away is rewritten; a reader opened
+    # before finds the runs again.
+    reader = OrderedIndex(path)
+    monkeypatch.setattr(ordered, '_RECLAIM', 0)
+    generation = idx.generation
+    more = [(rnd.randrange(100), o) for o in range(1000, 3000)]
+    for i in range(0, len(more), 100):
+        idx.append([v for v, o in more[i:i+100]], [o for v, o in more[i:i+100]])
+    model += more
+    assert idx.generation > generation
+    assert not idx.rollback(state)
+    check(reader, model, rnd)
+
+    idx.rebuild([7, 3], [1, 0])
+    assert idx.runs == 1 and list(reader.range(3, 7)) == [0, 1]
+
+
+def test_errors(tmp_path):
+    with pytest.raises(exceptions.TypeError):
+        OrderedIndex(str(tmp_path / 's.ord'), 'str')
+    with open(tmp_path / 'x.ord', 'wb') as fp:
+        fp.write(bytes(16))
+    with pytest.raises(exceptions.IndexError):
+        OrderedIndex(str(tmp_path / 'x.ord'))
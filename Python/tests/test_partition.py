@@ -0,0 +1,65 @@
+"""
+Tables partitioned into time buckets: the segments made, those a time
+range searches and the old ones dropped.
+"""
+from os.path import exists, join
+
+from conftest import MakeTable
+from database import Table
+from metrics import metrics
+from sql import SQL
+from test_wal import COLS, rows
+
+HOUR = 3600
+
+
+def test_segments(table):
+    MakeTable(table, 't', COLS, {'timecol': 'ts', 'partition': 'hour'})
+    table.insert_many('t', rows(HOUR - 10, 20) + rows(3 * HOUR + 5, 5))
+    conn = table.connection('t')
+    assert sorted(conn.segments) == [0, HOUR, 3 * HOUR]
+    meta = conn.segments[HOUR].meta
+    assert (meta['start'], meta['end'], meta['mints'], meta['maxts'], meta['rows']) == \
+        (HOUR, 2 * HOUR, HOUR, HOUR + 9, 10)
+    assert exists(join(conn.path, str(3 * HOUR), 'records.dat'))
+    assert not Table(table.db, {'cachesize': 0}).connection('t').segments[0].overlaps(HOUR, None)
+
+
+def test_pruned(table):
+    MakeTable(table, 't', COLS, {'timecol': 'ts', 'partition': 'hour'})
+    data = rows(0, 5 * HOUR)[::45]
+    table.insert_many('t', data)
+    sql = SQL(table)
+    steps = metrics.snapshot()['counters'].get('steps', 0)
+    found = sql.execute("SELECT * FROM t WHERE dev = 'd1' AND ts >= 3600 AND ts <= 7199")
+    assert sorted(r['ts'] for r in found) == [r['ts'] for r in data if r['dev'] == 'd1' and HOUR <= r['ts'] < 2 * HOUR]
+    # Only the one hour is searched, and all of its times match.
+    assert metrics.snapshot()['counters']['steps'] - steps == 1
+    assert sql.execute('SELECT * FROM t WHERE ts > 99999') == []
+
+
+def test_expire(table):
+    MakeTable(table, 't', COLS, {'timecol': 'ts', 'partition': 'hour'})
+    table.insert_many('t', rows(0, 3 * HOUR)[::100])
+    SQL(table).execute("SELECT * FROM t WHERE dev = 'd1'")
+    dropped = join(table.connection('t').path, '0', '')
+    assert any(p.startswith(dropped) for p in table._indexcache)
+    assert table.expire('t', HOUR + 1) == 1
+    assert table.expire('t', HOUR + 1) == 0
+    assert sorted(table.connection('t').segments) == [HOUR, 2 * HOUR]
+    assert min(r['ts'] for r in SQL(table).execute('SELECT * FROM t')) == HOUR
+    assert not exists(join(table.connection('t').path, '0'))
+    # The files of the partition dropped are let go of.
+    assert not any(p.startswith(dropped) for p in table._indexcache)
+    table.delete('t', True)
+    assert table._indexcache == {}
+
+
+def test_retention(table):
+    MakeTable(table, 't', COLS, {'timecol': 'ts', 'partition': 'hour', 'retention': 2 * HOUR})
+    for hour in range(6):
+        table.insert_many('t', rows(hour * HOUR, 10))
+    # The hours ending 2 hours or more before the latest time are dropped.
+    assert sorted(table.connection('t').segments) == [3 * HOUR, 4 * HOUR, 5 * HOUR]
+    again = Table(table.db, {'cachesize': 0})
+    assert sorted({r['ts'] // HOUR for r in SQL(again).execute('SELECT * FROM t')}) == [3, 4, 5]
@@ -0,0 +1,80 @@
+"""
+Search steps and the set operations combining their results.
+"""
+from array import array
+import random
+
+import pytest
+
+from test_index import MakeIndex
+from pgm import Evaluate, Select, Test, Intersect, Union, Difference
+import pgm
+
+# Comparisons answered over the dictionary, and their values per column type.
+SELECTS = {
+    'int': [('!=', 7), ('<', 10), ('<=', 10), ('>', 40.5), ('>=', 49), ('between', [5, 15]),
+            ('range', [5, 15, False, True]), ('range', [-3.5, 2.5, True, False]), ('*', None),
+            ('<', -100), ('>', 100), ('range', [49, 60, False, True])],
+    'float': [('!=', 2.5), ('<', 3.25), ('>=', 12.0), ('between', [1.0, 1.5]),
+              ('range', [0.0, 1.0, True, True]), ('*', None), ('>', 1e9)],
+    'str': [('!=', 'v5'), ('<', 'v3'), ('>=', 'v80'), ('between', ['v1', 'v2']),
+            ('range', ['v1', 'v3', False, False]), ('*', None), ('>', 'zz')],
+}
+
+
+def test_in_repeated_values(tmp_path):
+    idx = MakeIndex(tmp_path / 'c.idx', 'int')
+    idx.insert_many([1, 2, 1, 3], [0, 8, 16, 24])
+    assert list(Evaluate(idx, ('in', [1, 1]))) == [0, 16]
+    assert list(Evaluate(idx, ('in', [3, 1, 3, 9]))) == [0, 16, 24]
+    # Unique offsets, as the set operations assume.
+    found = Evaluate(idx, ('in', [1, 2, 1]))
+    assert list(Intersect(found, array('Q', [16, 24]))) == [16]
+    assert list(Difference(found, array('Q', [16]))) == [0, 8]
+
+
+def test_set_operations():
+    rnd = random.Random(1)
+    for n, m in ((0, 10), (5, 500), (300, 400), (1000, 20)):
+        a = sorted(rnd.sample(range(5000), n))
+        b = sorted(rnd.sample(range(5000), m))
+        A, B = array('Q', a), array('Q', b)
+        assert list(Intersect(A, B)) == sorted(set(a) & set(b))
+        assert list(Union(A, B)) == sorted(set(a) | set(b))
+        assert list(Difference(A, B)) == sorted(set(a) - set(b))
+
+
+@pytest.mark.parametrize('numpy', [True, False], ids=['numpy', 'python'])
+@pytest.mark.parametrize('coltype', ['int', 'float', 'str'])
+def test_select(tmp_path, monkeypatch, coltype, numpy):
+    if not numpy:
+        monkeypatch.setattr(pgm, 'np', None)
+    elif pgm.np is None:
+        pytest.skip('NumPy is not installed')
+    make = {'int': lambda i: i - 50, 'float': lambda i: i / 4, 'str': lambda i: 'v%d' % i}[coltype]
+    idx = MakeIndex(tmp_path / 'c.idx', coltype, 1 << 16)
+    values = [make(i) for i in range(100)]
+    idx.insert_many(values, range(0, 800, 8))
+    for n in (100, 120):
+        # The dictionary read before is extended with the values added since.
+        for cmp, value in SELECTS[coltype]:
+            test = Test(cmp, value)
+            assert [idx.value(i) for i in Select(idx, cmp, value)] == [v for v in values if test(v)]
+            assert list(Evaluate(idx, (cmp, value))) == [8 * i for i, v in enumerate(values) if test(v)]
+        values += [make(i) for i in range(n, n + 20)]
+        idx.insert_many(values[n:], range(8 * n, 8 * (n + 20), 8))
+    assert idx.extent() == (min(values), max(values))
+
+
+def test_select_after_rollback(tmp_path):
+    idx = MakeIndex(tmp_path / 'c.idx', 'int', 1 << 16)
+    idx.insert_many([1, 2, 3], [0, 8, 16])
+    count, heaptop = idx.count, idx.heaptop
+    assert Select(idx, '>', 1) == [1, 2]
+    idx.insert_many([10, 20], [24, 32])
+    assert Select(idx, '>', 1) == [1, 2, 3, 4]
+    idx.rollback(count, heaptop, 24)
+    assert Select(idx, '>', 1) == [1, 2] and idx.extent() == (1, 3)
+    # An id taken back and given out again to another value.
+    idx.insert_many([-5], [24])
+    assert Select(idx, '<', 1) == [3] and idx.extent() == (-5, 3)
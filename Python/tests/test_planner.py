@@ -0,0 +1,150 @@
+"""
+The planner: the steps it skips, orders, scans or filters, and the rows
+found, which it must not change.
+"""
+import random
+
+import pytest
+
+from conftest import MakeTable
+from sql import SQL
+import database
+
+COLS = {'ts': 'int', 'dev': 'str', 'n': 'int'}
+ROWS = 10000
+
+# Predicates, and the rows each selects.
+ATOMS = [
+    ("dev = 'r'", lambda r: r['dev'] == 'r'),
+    ("dev = 'd0'", lambda r: r['dev'] == 'd0'),
+    ("dev = 'zzz'", lambda r: False),
+    ("dev IN ('r', 'd1')", lambda r: r['dev'] in ('r', 'd1')),
+    ("n < 5", lambda r: r['n'] < 5),
+    ("n >= 0", lambda r: True),
+    ("n BETWEEN 100 AND 400", lambda r: 100 <= r['n'] <= 400),
+    ("ts BETWEEN 3000 AND 3100", lambda r: 3000 <= r['ts'] <= 3100),
+    ("ts >= 9990", lambda r: r['ts'] >= 9990),
+    ("ts < 0", lambda r: False),
+]
+
+
+@pytest.fixture(params=[None, 'hour'], ids=['single', 'partitioned'])
+def loaded(request, table):
+    """
+    A table of a time column, a device that is almost always 'd0' and a
+    uniform number, inserted in many small batches, and the rows.
+    """
+    opts = {'timecol': 'ts'}
+    if request.param:
+        opts['partition'] = request.param
+    MakeTable(table, 't', COLS, opts)
+    rnd = random.Random(11)
+    rows = [{'ts': i, 'dev': 'r' if i % 1000 == 0 else 'd1' if i % 997 == 0 else 'd0',
+             'n': rnd.randrange(1000)} for i in range(ROWS)]
+    for i in range(0, ROWS, 250):
+        table.insert_many('t', rows[i:i+250])
+    return table, rows
+
+
+def key(rows):
+    return sorted((r['ts'], r['dev'], r['n']) for r in rows)
+
+
+def methods(sql:SQL, where:str):
+    return {r['index']: r['method'] for r in sql.execute('EXPLAIN SELECT * FROM t WHERE ' + where)
+            if 'method' in r}
+
+
+@pytest.mark.parametrize('where,test,planned', [
+    ("n < 5 AND dev = 'd0'", lambda r: r['n'] < 5 and r['dev'] == 'd0',
+     {'n.idx': 'probe', 'dev.idx': 'filter'}),
+    ("dev = 'r' AND n >= 0", lambda r: r['dev'] == 'r',
+     {'n.idx': 'skipped', 'dev.idx': 'probe'}),
+    ("ts >= 0 AND dev = 'r'", lambda r: r['dev'] == 'r',
+     {'ts.idx': 'skipped', 'dev.idx': 'probe'}),
+    ("dev = 'zzz' AND n < 5", lambda r: False,
+     {'n.idx': 'skipped', 'dev.idx': 'skipped'}),
+    ("ts < 0 OR dev = 'r'", lambda r: r['dev'] == 'r',
+     {'ts.idx': 'skipped', 'dev.idx': 'probe'}),
+    ("dev = 'r' OR n < 3", lambda r: r['dev'] == 'r' or r['n'] < 3,
+     {'n.idx': 'probe', 'dev.idx': 'probe'}),
+], ids=lambda p: p if isinstance(p, str) else '')
+def test_methods(loaded, where, test, planned):
+    table, rows = loaded
+    sql = SQL(table)
+    assert methods(sql, where) == planned
+    assert key(sql.execute('SELECT * FROM t WHERE ' + where)) == key(r for r in rows if test(r))
+
+
+def test_scan(loaded):
+    table, rows = loaded
+    sql = SQL(table)
+    if table.connection('t').opts.get('partition'):
+        # A partition's blocks are too few for a scan to pay.
+        return
+    assert methods(sql, 'ts BETWEEN 3000 AND 3100') == {'ts.idx': 'scan'}
+    assert key(sql.execute('SELECT * FROM t WHERE ts BETWEEN 3000 AND 3100')) == key(rows[3000:3101])
+
+
+def test_order(loaded):
+    table, rows = loaded
+    steps = {r['index']: r['step'] for r in
+             SQL(table).execute("EXPLAIN SELECT * FROM t WHERE n BETWEEN 100 AND 400 AND dev = 'r'")
+             if 'method' in r}
+    # The most selective step first.
+    assert steps == {'dev.idx': 0, 'n.idx': 1}
+
+
+def test_unchanged(loaded, monkeypatch):
+    """
+    Random conditions find the same rows planned as they do run as compiled.
+    """
+    table, rows = loaded
+    sql = SQL(table)
+    shapes = [
+        ('%s AND %s AND %s', lambda a, b, c: a and b and c),
+        ('(%s OR %s) AND %s', lambda a, b, c: (a or b) and c),
+        ('%s AND NOT %s OR %s', lambda a, b, c: a and not b or c),
+        ('NOT (%s OR %s) AND %s', lambda a, b, c: not (a or b) and c),
+    ]
+    rnd = random.Random(2)
+    conditions = []
+    for i in range(40):
+        atoms = rnd.sample(ATOMS, 3)
+        text, combine = rnd.choice(shapes)
+        tests = [t for w, t in atoms]
+        conditions.append((text % tuple(w for w, t in atoms),
+                           lambda r, tests=tests, combine=combine: combine(*(t(r) for t in tests))))
+    planned = [sql.execute('SELECT * FROM t WHERE ' + where) for where, test in conditions]
+    monkeypatch.setattr(database, 'Plan', lambda ppgm, common, segs, segstats, cols: (ppgm, common, {}, []))
+    for (where, test), found in zip(conditions, planned):
+        assert key(found) == key(r for r in rows if test(r)), where
+        assert key(sql.execute('SELECT * FROM t WHERE ' + where)) == key(found), where
+
+
+@pytest.mark.parametrize('where,test', [
+    ("ts < 3600", lambda r: r['ts'] < 3600),
+    ("dev = 'r' AND ts < 5000", lambda r: r['dev'] == 'r' and r['ts'] < 5000),
+    ("n < 5", lambda r: r['n'] < 5),
+])
+def test_deleted_after_pin(loaded, monkeypatch, where, test):
+    """
+    Every row is deleted after a query pinned the table and before it is
+    planned: the statistics, emptied, must not skip what it still sees.
+    """
+    table, rows = loaded
+    conn = table.connection('t')
+    sql = SQL(table)
+    pin = conn.pin
+    deleted = []
+
+    def pinned():
+        snapshot = pin()
+        if not deleted:
+            deleted.append(None)
+            deleted[0] = sql.execute('DELETE FROM t WHERE n >= 0')
+        return snapshot
+    monkeypatch.setattr(conn, 'pin', pinned)
+    assert key(sql.execute('SELECT * FROM t WHERE ' + where)) == key(filter(test, rows))
+    assert deleted == [[{'deleted': ROWS}]]
+    assert sql.execute('SELECT * FROM t WHERE ' + where) == []
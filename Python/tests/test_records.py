@@ -0,0 +1,70 @@
+"""
+The append only record store.
+"""
+import os
+import random
+
+import pytest
+
+from records import RecordStore, HDRSIZE
+import exceptions
+
+
+def records(n:int, first:int = 0):
+    return [{'ts': i, 'dev': 'd%d' % (i % 7), 'text': 'x' * (i % 300)} for i in range(first, first + n)]
+
+
+def test_append_read(tmp_path):
+    path = str(tmp_path / 'records.dat')
+    store = RecordStore(path)
+    assert store.empty and store.size == HDRSIZE
+    first = store.append({'ts': -1})
+    assert first == HDRSIZE
+    rows = records(2000)
+    offsets = store.append_many(rows)
+    assert offsets == sorted(offsets) and offsets[0] > first and not store.empty
+    assert store.read(first) == {'ts': -1}
+    assert store.read(offsets[1234]) == rows[1234]
+
+    # In offset order whatever the order asked for, near ones read together.
+    rnd = random.Random(4)
+    picks = rnd.sample(range(len(rows)), 300)
+    assert store.read_many([offsets[i] for i in picks]) == [rows[i] for i in sorted(picks)]
+    assert store.read_many([offsets[0], offsets[-1]]) == [rows[0], rows[-1]]
+    assert store.read_many([]) == []
+    assert [r for o, r in store.scan()] == [{'ts': -1}] + rows
+    store.flush()
+    store.close()
+
+    store = RecordStore(path)
+    size = store.size
+    assert size == os.path.getsize(path)
+    assert store.append({'ts': 'last'}) == size
+    assert store.read(size) == {'ts': 'last'}
+    assert store.read_many(offsets[-1:]) == rows[-1:]
+
+
+def test_errors(tmp_path):
+    path = str(tmp_path / 'records.dat')
+    store = RecordStore(path)
+    offsets = store.append_many(records(10))
+    with pytest.raises(exceptions.TableError):
+        store.read(store.size)
+    with pytest.raises(exceptions.TableError):
+        store.read_many([offsets[0], store.size + 5])
+    # A damaged frame is found by its checksum.
+    with open(path, 'r+b') as fp:
+        fp.seek(offsets[3] + 12)
+        fp.write(b'#')
+    with pytest.raises(exceptions.TableError):
+        store.read(offsets[3])
+    with pytest.raises(exceptions.TableError):
+        store.read_many(offsets)
+    assert store.read(offsets[4]) == records(10)[4]
+    store.close()
+
+    other = str(tmp_path / 'other.dat')
+    with open(other, 'wb') as fp:
+        fp.write(b'not a record store')
+    with pytest.raises(exceptions.TableError):
+        RecordStore(other)
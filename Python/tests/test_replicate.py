@@ -0,0 +1,207 @@
+"""
+The change feed of a table and its replication to the sinks.
+"""
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from conftest import MakeTable
+from database import DB, Table
+from feed import Feed, feeds
+import feed as feedmod
+from replicate import Replicator, DirectorySink, SQLiteSink, ReadBatch
+from sql import SQL
+import exceptions
+
+COLS = {'ts': 'int', 'dev': 'str', 'v': 'float'}
+
+
+def rows(first:int, n:int):
+    return [{'ts': i * 60, 'dev': 'ab'[i % 2], 'v': float(i)} for i in range(first, first + n)]
+
+
+def changes(feed:Feed, after:int = 0):
+    return [(seq, {k: v for k, v in c.items() if k != 'lsn'}) for seq, c in feed.read(after, 1 << 30)]
+
+
+def shipped(sink, name:str = 't'):
+    return [(seq, {k: v for k, v in c.items() if k != 'lsn'})
+            for first, last, data in sink.batches(name) for seq, c in ReadBatch(data)]
+
+
+@pytest.fixture
+def fed(table):
+    MakeTable(table, 't', COLS, {'feed': True, 'timecol': 'ts', 'partition': 'hour'})
+    return table
+
+
+def test_feed(fed):
+    fed.insert_many('t', rows(0, 100))
+    assert SQL(fed).execute("DELETE FROM t WHERE dev = 'a'") == [{'deleted': 50}]
+    assert SQL(fed).execute("UPDATE t SET v = 1.5 WHERE ts < 600") == [{'updated': 5}]
+    got = changes(fed.connection('t').feed)
+    assert [seq for seq, c in got] == [1, 2, 3, 4]
+    assert got[0][1] == {'create': {'table': COLS, 'ordered': [],
+                                    'opts': fed.connection('t').opts}}
+    assert got[1][1] == {'insert': rows(0, 100)}
+    assert sorted(r['ts'] for r in got[2][1]['delete']) == [r['ts'] for r in rows(0, 100) if r['dev'] == 'a']
+    assert sorted(got[3][1]) == ['delete', 'insert']
+    assert [r['ts'] for r in got[3][1]['insert']] == [60, 180, 300, 420, 540]
+    assert all(r['v'] == 1.5 for r in got[3][1]['insert'])
+    # A table without the option has none.
+    MakeTable(fed, 'plain', COLS)
+    assert fed.connection('plain').feed is None
+    assert sorted(fed.db.list(None, False)) == ['plain', 't']
+
+
+@pytest.mark.parametrize('make', [DirectorySink, lambda path: SQLiteSink(path + '.db')], ids=['directory', 'sqlite'])
+def test_round_trip(fed, tmp_path, make):
+    fed.insert_many('t', rows(0, 300))
+    SQL(fed).execute("UPDATE t SET v = 0.5 WHERE dev = 'b'")
+    for i in range(10):
+        fed.insert_many('t', rows(300 + i * 10, 10))
+    sink = make(str(tmp_path / 'sink'))
+    r = Replicator(fed, 't', sink, batchbytes=2000, codec='lzma')
+    n = 0
+    while r.ship() is not None:
+        n += 1
+    feed = fed.connection('t').feed
+    # Large changes go alone, small ones several to a batch.
+    assert 1 < n < feed.seq
+    assert shipped(sink) == changes(feed)
+    assert sink.position('t') == feed.seq == feed.cursor('replica')
+    assert feed.backlog == 0
+
+    # A new Replicator carries on from the sink, even with the cursor behind.
+    fed.insert_many('t', rows(1000, 5))
+    feed.commit('replica', 2)
+    r = Replicator(fed, 't', sink)
+    assert feed.cursor('replica') == feed.seq - 1
+    r.start()
+    deadline = time.monotonic() + 5
+    while sink.position('t') < feed.seq and time.monotonic() < deadline:
+        time.sleep(0.05)
+    r.stop()
+    assert shipped(sink) == changes(feed)
+    sink.close()
+
+
+def test_trim_and_reopen(fed, tmp_path, monkeypatch):
+    monkeypatch.setattr(feedmod, 'FEEDFILE', 1500)
+    for i in range(30):
+        fed.insert_many('t', rows(i * 5, 5))
+    feed = fed.connection('t').feed
+    files = lambda: sorted(f for f in os.listdir(feed.path) if f.endswith('.feed'))
+    assert len(files()) > 2
+    slow = Replicator(fed, 't', DirectorySink(str(tmp_path / 'a')), cursor='slow', batchbytes=2000)
+    fast = Replicator(fed, 't', DirectorySink(str(tmp_path / 'b')), cursor='fast')
+    while fast.ship() is not None:
+        pass
+    # Kept for the slow reader.
+    assert changes(feed)[0][0] == 1
+    while slow.ship() is not None:
+        pass
+    # Only the file being appended to is left.
+    assert len(files()) == 1
+    assert changes(feed)[0][0] > 1
+    assert changes(feed, feed.cursor('slow')) == []
+    assert shipped(slow.sink) == shipped(fast.sink)
+    # The feed read back from its files.
+    fed.insert_many('t', rows(500, 3))
+    feed.sync()
+    again = Feed(feed.path)
+    assert (again.seq, again.lsn, again.cursor('slow'), again.backlog) == (feed.seq, feed.lsn, feed.cursor('slow'), feed.backlog)
+    assert again.read(0, 1 << 30) == feed.read(0, 1 << 30)
+    again.close()
+
+
+@pytest.mark.parametrize('size', [0, 3])
+def test_torn_header(tmp_path, monkeypatch, size):
+    monkeypatch.setattr(feedmod, 'FEEDFILE', 100)
+    feed = Feed(str(tmp_path / 'f'))
+    for lsn in range(1, 4):
+        feed.append(lsn, {'insert': rows(lsn, 2)})
+    feed.close()
+    # A file started just before a crash whose header never reached the disk.
+    last = sorted(f for f in os.listdir(feed.path) if f.endswith('.feed'))[-1]
+    os.truncate(os.path.join(feed.path, last), size)
+    again = Feed(feed.path)
+    assert again.seq == 2 and [s for s, c in changes(again)] == [1, 2]
+    assert again.append(4, {}) == 3 and changes(again, 2) == [(3, {})]
+    again.close()
+
+
+def test_recovery(user, fed):
+    fed.insert_many('t', rows(0, 10))
+    feed = fed.connection('t').feed
+    seq = feed.seq
+    fed.insert_many('t', rows(10, 3))
+    fed.insert_many('t', rows(13, 3))
+    feed.sync()
+    # The process died with the last change written to the log but only
+    # half of it to the feed.
+    path = os.path.join(feed.path, sorted(f for f in os.listdir(feed.path) if f.endswith('.feed'))[-1])
+    last = json.dumps(feed.read(seq + 1, 1 << 30)[0][1], separators=(',', ':'))
+    os.truncate(path, os.path.getsize(path) - len(last) + 5)
+    feeds._feeds.pop(feed.path).close()
+    again = Table(DB('db', user), {'cachesize': 0})
+    feed = again.connection('t').feed
+    assert [c for s, c in changes(feed, seq)] == [{'insert': rows(10, 3)}, {'insert': rows(13, 3)}]
+    # Nothing is added twice.
+    again = Table(DB('db', user), {'cachesize': 0})
+    assert again.connection('t').feed.seq == seq + 2
+
+
+def test_recovery_with_retention(user, table, monkeypatch):
+    MakeTable(table, 't', COLS, {'feed': True, 'timecol': 'ts', 'partition': 'hour', 'retention': 7200})
+    table.insert_many('t', rows(0, 120))
+    feed = table.connection('t').feed
+
+    def died(lsn, change):
+        raise OSError('died')
+    # The process died before the batch that expires partition 0 reached the feed.
+    monkeypatch.setattr(feed, 'append', died)
+    with pytest.raises(OSError):
+        table.insert_many('t', rows(180, 10))
+    monkeypatch.undo()
+    feeds._feeds.pop(feed.path).close()
+    again = Table(DB('db', user), {'cachesize': 0})
+    assert changes(again.connection('t').feed)[-1][1] == {'insert': rows(180, 10)}
+    assert sorted(again.connection('t').segments) == [3600, 10800]
+    assert len(SQL(again).execute('SELECT * FROM t WHERE ts >= 10800')) == 10
+
+
+def test_backpressure(table):
+    MakeTable(table, 't', COLS, {'feed': True, 'feedlag': 1000, 'feedwait': 0.2})
+    feed = table.connection('t').feed
+    # No reader yet: nothing holds the writers back.
+    for i in range(5):
+        table.insert_many('t', rows(0, 50))
+    feed.commit('replica', feed.seq)
+    with pytest.raises(exceptions.TableError):
+        for i in range(5):
+            table.insert_many('t', rows(0, 50))
+    # A waiting writer goes on once the reader catches up.
+    table.connection('t').opts['feedwait'] = 10
+    done = threading.Event()
+    writer = threading.Thread(target=lambda: (table.insert_many('t', rows(0, 1)), done.set()))
+    writer.start()
+    assert not done.wait(0.3)
+    feed.commit('replica', feed.seq)
+    writer.join(5)
+    assert done.is_set()
+
+
+def test_drop_and_create(fed):
+    fed.insert_many('t', rows(0, 10))
+    feed = fed.connection('t').feed
+    fed.delete('t', True)
+    assert changes(feed)[-1][1] == {'drop': True}
+    MakeTable(fed, 't', COLS, {'feed': True})
+    fed.insert_many('t', rows(0, 1))
+    got = changes(feeds.get(fed.db.path, 't'))
+    assert [sorted(c) for s, c in got] == [['create'], ['insert'], ['drop'], ['create'], ['insert']]
+    assert [s for s, c in got] == [1, 2, 3, 4, 5]
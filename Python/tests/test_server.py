@@ -0,0 +1,243 @@
+"""
+The HTTP endpoints of server.py, run in process with the FastAPI TestClient.
+"""
+import asyncio
+import json
+import time
+
+import pytest
+
+pytest.importorskip('fastapi')
+pytest.importorskip('httpx')
+from fastapi.testclient import TestClient
+from starlette.requests import Request
+
+import server
+from pgm import BATCHSIZE
+from replicate import DirectorySink, ReadBatch
+
+
+@pytest.fixture
+def client(user, monkeypatch):
+    """
+    A client of a server whose databases live in a fresh directory.
+    """
+    monkeypatch.setattr(server, 'user', user)
+    monkeypatch.setattr(server, 'tables', {})
+    monkeypatch.setattr(server, 'processors', {})
+    with TestClient(server.app) as c:
+        yield c
+
+
+def create(client, table:str = 't', columns:dict|None = None, **request):
+    req = {'database': 'db', 'table': table, 'columns': columns or {'ts': 'int', 'dev': 'str', 'v': 'float'}}
+    req.update(request)
+    return client.post('/create', params={'creq': json.dumps({'operation': 'table', 'request': req})})
+
+
+def insert(client, rows:list, table:str = 't'):
+    return client.post('/insert', params={'ireq': json.dumps({'database': 'db', 'table': table, 'rows': rows})})
+
+
+def sql(client, statement:str, **request):
+    return client.post('/sql', params={'sqlreq': json.dumps(dict(request, database='db', statement=statement))})
+
+
+def test_insert(client):
+    assert create(client).json() == {'created': 't'}
+    rows = [{'ts': i, 'dev': 'd%d' % (i % 3), 'v': i / 2} for i in range(50)]
+    r = insert(client, rows)
+    assert r.status_code == 200
+    assert r.json() == {'inserted': 50}
+    assert insert(client, [[50, 'd2', 1.0]]).json() == {'inserted': 1}
+    got = sql(client, "SELECT * FROM t WHERE dev = 'd1'").json()['rows']
+    assert sorted(r['ts'] for r in got) == [i for i in range(50) if i % 3 == 1]
+
+
+def test_insert_errors(client):
+    create(client)
+    # A bad row fails the whole batch.
+    r = insert(client, [{'ts': 1, 'dev': 'a', 'v': 1.0}, {'ts': 'x', 'dev': 'a', 'v': 1.0}])
+    assert r.status_code == 400
+    assert 'ts' in r.json()['detail']
+    assert insert(client, [{'ts': 1, 'v': 1.0}]).status_code == 400
+    assert insert(client, [{'ts': 1, 'dev': 'a', 'v': 1.0}], table='nosuch').status_code == 400
+    r = client.post('/insert', params={'ireq': json.dumps({'database': 'db', 'rows': []})})
+    assert r.status_code == 400
+    assert sql(client, 'SELECT * FROM t').json() == {'rows': []}
+
+
+def test_create_errors(client):
+    assert create(client).status_code == 200
+    assert create(client).status_code == 400
+    assert create(client, 'u', {'a b': 'int'}).status_code == 400
+    assert create(client, 'u', {'a': 'blob'}).status_code == 400
+    r = client.post('/create', params={'creq': json.dumps({'operation': 'index', 'request': {}})})
+    assert r.status_code == 400
+
+
+def test_admission(client, monkeypatch):
+    create(client)
+    rejected = server.metrics.snapshot()['counters'].get('rejected', 0)
+    # Too many writes is the client's doing, too many queries is ours.
+    monkeypatch.setattr(server, 'writes', server.Admission(0, 429))
+    r = insert(client, [{'ts': 1, 'dev': 'a', 'v': 1.0}])
+    assert r.status_code == 429
+    assert r.headers['retry-after'] == '1'
+    assert sql(client, "DELETE FROM t WHERE dev = 'a'").status_code == 429
+    assert sql(client, 'SELECT * FROM t').status_code == 200
+    monkeypatch.setattr(server, 'reads', server.Admission(0, 503))
+    assert sql(client, 'SELECT * FROM t').status_code == 503
+    assert sql(client, 'SELECT * FROM t', format='ndjson').status_code == 503
+    assert server.metrics.snapshot()['counters']['rejected'] == rejected + 4
+
+
+def test_errors(client):
+    create(client)
+    insert(client, [{'ts': 1, 'dev': 'a', 'v': 1.0}])
+    for statement in ['SELECT * FROM nosuch', 'SELECT nosuch FROM t', 'SELEKT * FROM t',
+                      "SELECT * FROM t WHERE ts = 'a'", "UPDATE t SET ts = 'a'",
+                      "UPDATE t SET nosuch = 1", "DELETE FROM t ORDER BY ts"]:
+        r = sql(client, statement)
+        assert r.status_code == 400, statement
+        assert r.json()['detail']
+    assert sql(client, 'SELECT * FROM nosuch', format='ndjson').status_code == 400
+    assert sql(client, 'SELECT * FROM t', format='xml').status_code == 400
+    r = client.post('/sql', params={'sqlreq': json.dumps({'database': 'db'})})
+    assert r.status_code == 400
+    # Nothing was changed, and the slots were all given back.
+    assert sql(client, 'SELECT * FROM t').json()['rows'] == [{'ts': 1, 'dev': 'a', 'v': 1.0}]
+    assert server.reads.count == 0 and server.writes.count == 0
+
+
+def test_delete_update(client):
+    create(client)
+    insert(client, [{'ts': i, 'dev': 'ab'[i % 2], 'v': 0.0} for i in range(10)])
+    assert sql(client, "DELETE FROM t WHERE dev = 'a'").json() == {'rows': [{'deleted': 5}]}
+    assert sql(client, "UPDATE t SET v = 2.5 WHERE ts < 5").json() == {'rows': [{'updated': 2}]}
+    got = sql(client, 'SELECT * FROM t ORDER BY ts').json()['rows']
+    assert [(r['ts'], r['v']) for r in got] == [(1, 2.5), (3, 2.5), (5, 0.0), (7, 0.0), (9, 0.0)]
+
+
+def load(client, n:int):
+    # The request is a query parameter, so the rows go a few hundred at a time.
+    for first in range(0, n, 200):
+        rows = [{'ts': i, 'dev': 'd%d' % (i % 3), 'v': i / 2} for i in range(first, min(n, first + 200))]
+        assert insert(client, rows).status_code == 200
+
+
+def streamed(client, fmt:str, statement:str = 'SELECT * FROM t'):
+    r = sql(client, statement, format=fmt)
+    assert r.status_code == 200
+    assert r.headers['content-type'] == server.STREAMTYPES[fmt]
+    return r
+
+
+def test_stream_ndjson(client):
+    create(client)
+    # Several batches, the last one part full.
+    n = BATCHSIZE * 3 + 17
+    load(client, n)
+    lines = streamed(client, 'ndjson').text.splitlines()
+    assert len(lines) == n
+    assert sorted(json.loads(line)['ts'] for line in lines) == list(range(n))
+    lines = streamed(client, 'ndjson', "SELECT ts FROM t WHERE dev = 'd1'").text.splitlines()
+    assert sorted(json.loads(line)['ts'] for line in lines) == list(range(1, n, 3))
+    assert streamed(client, 'ndjson', "SELECT * FROM t WHERE ts < 0").text == ''
+    # The Accept header picks the format when the request doesn't.
+    r = client.post('/sql', params={'sqlreq': json.dumps({'database': 'db', 'statement': 'SELECT * FROM t'})},
+                    headers={'accept': server.STREAMTYPES['ndjson']})
+    assert len(r.text.splitlines()) == n
+    assert server.reads.count == 0
+
+
+def test_stream_arrow(client):
+    pa = pytest.importorskip('pyarrow')
+    create(client)
+    n = BATCHSIZE * 3 + 17
+    load(client, n)
+    r = streamed(client, 'arrow')
+    result = pa.ipc.open_stream(r.content).read_all()
+    assert result.num_rows == n
+    assert sorted(result.column('ts').to_pylist()) == list(range(n))
+    r = streamed(client, 'arrow', "SELECT * FROM t WHERE ts < 0")
+    assert pa.ipc.open_stream(r.content).read_all().num_rows == 0
+
+
+def test_metrics(client):
+    create(client)
+    insert(client, [{'ts': 1, 'dev': 'a', 'v': 1.0}])
+    sql(client, "SELECT * FROM t WHERE dev = 'a'")
+    r = client.get('/metrics')
+    assert r.status_code == 200
+    assert r.headers['content-type'].startswith('text/plain')
+    lines = r.text.splitlines()
+    requests = [line for line in lines if line.startswith('ts2db_requests_total ')]
+    assert requests and int(requests[0].split()[1]) >= 3
+    assert '# TYPE ts2db_parse_seconds histogram' in lines
+    assert any(line.startswith('ts2db_steps_total ') for line in lines)
+    assert any(line.startswith('ts2db_parse_seconds_bucket{le="+Inf"}') for line in lines)
+
+
+def test_subscribe(client, monkeypatch):
+    """
+    The TestClient only hands back a response once it is complete, and a
+    subscription never is, so the stream is read from the handler itself.
+    """
+    create(client)
+    monkeypatch.setattr(server, 'SUBBACKLOG', 2)
+    request = Request({'type': 'http', 'method': 'GET', 'headers': [], 'query_string': b''})
+    
+    async def run():
+        req = json.dumps({'database': 'db', 'statement': "SELECT ts FROM t WHERE dev = 'a'"})
+        response = await server.subscribe_request(req, request)
+        assert response.media_type == 'text/event-stream'
+        body = response.body_iterator
+        got = [await anext(body)]
+        batches = [[{'ts': 1, 'dev': 'a', 'v': 1.0}, {'ts': 2, 'dev': 'b', 'v': 1.0}],
+                   [{'ts': 3, 'dev': 'b', 'v': 1.0}],
+                   [{'ts': 4, 'dev': 'a', 'v': 1.0}, {'ts': 5, 'dev': 'a', 'v': 1.0}]]
+        for rows in batches:
+            await server.insert_request(json.dumps({'database': 'db', 'table': 't', 'rows': rows}))
+        got += [await anext(body), await anext(body)]
+        # A subscriber SUBBACKLOG batches behind is dropped.
+        for ts in range(6, 9):
+            await server.insert_request(json.dumps({'database': 'db', 'table': 't',
+                                                    'rows': [{'ts': ts, 'dev': 'a', 'v': 1.0}]}))
+        await asyncio.sleep(0.1)
+        got += [event async for event in body]
+        return got
+    
+    got = asyncio.run(run())
+    subid = int(got[0].split('data: ')[1])
+    assert got[:3] == ['event: subscribed\ndata: %d\n\n' % (subid),
+                       'event: rows\ndata: [{"ts": 1}]\n\n',
+                       'event: rows\ndata: [{"ts": 4}, {"ts": 5}]\n\n']
+    assert got[-1] == 'event: lagging\ndata: %d\n\n' % (subid)
+    # Ending the stream ended the subscription.
+    assert server.tables['db'].subscriptions.count == 0
+    
+    r = client.get('/subscribe', params={'subreq': json.dumps({'database': 'db', 'statement': 'SELECT * FROM nosuch'})})
+    assert r.status_code == 400
+    r = client.get('/subscribe', params={'subreq': json.dumps({'database': 'db'})})
+    assert r.status_code == 400
+
+
+def test_replicate(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'replicateto', str(tmp_path / 'replicas'))
+    monkeypatch.setattr(server, 'replicators', {})
+    create(client, opts={'feed': True})
+    rows = [{'ts': 1, 'dev': 'a', 'v': 1.0}]
+    insert(client, rows)
+    try:
+        assert list(server.replicators) == [('db', 't')]
+        sink = DirectorySink(str(tmp_path / 'replicas' / 'db'))
+        deadline = time.monotonic() + 5
+        while sink.position('t') < 2 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        got = [c for first, last, data in sink.batches('t') for seq, c in ReadBatch(data)]
+        assert [sorted(c) for c in got] == [['create', 'lsn'], ['insert', 'lsn']]
+        assert got[1]['insert'] == rows
+    finally:
+        for r in server.replicators.values():
+            r.stop()
@@ -0,0 +1,127 @@
+"""
+SQL statements checked against a brute force filter of the rows inserted.
+"""
+import random
+import threading
+
+import pytest
+
+from conftest import MakeTable
+from database import Table
+from sql import SQL
+import exceptions
+
+COLS = {'ts': 'int', 'dev': 'str', 'v': 'float', 'n': 'int'}
+
+# WHERE clauses, and the rows each selects.
+WHERES = [
+    ("dev = 'd1'", lambda r: r['dev'] == 'd1'),
+    ("dev != 'd1'", lambda r: r['dev'] != 'd1'),
+    ("n < 300", lambda r: r['n'] < 300),
+    ("n >= 990", lambda r: r['n'] >= 990),
+    ("n BETWEEN 100 AND 200", lambda r: 100 <= r['n'] <= 200),
+    ("n > 100 AND n <= 200", lambda r: 100 < r['n'] <= 200),
+    ("v >= 10.5 AND v < 20", lambda r: 10.5 <= r['v'] < 20),
+    ("dev > 'd1' AND dev <= 'd3'", lambda r: 'd1' < r['dev'] <= 'd3'),
+    ("dev >= 'd1' AND dev < 'd3'", lambda r: 'd1' <= r['dev'] < 'd3'),
+    ("dev > 'd1' AND dev < 'd4'", lambda r: 'd1' < r['dev'] < 'd4'),
+    ("dev IN ('d0', 'd4')", lambda r: r['dev'] in ('d0', 'd4')),
+    ("dev IN ('d1', 'd1')", lambda r: r['dev'] == 'd1'),
+    ("n IN (7, 7, 8) AND dev IN ('d1', 'd2', 'd1')", lambda r: r['n'] in (7, 8) and r['dev'] in ('d1', 'd2')),
+    ("n IN (1, 2, 1, 3, 4, 5, 6, 7, 8, 9, 10) AND NOT dev IN ('d0', 'd0')",
+     lambda r: 1 <= r['n'] <= 10 and r['dev'] != 'd0'),
+    ("NOT dev = 'd2'", lambda r: r['dev'] != 'd2'),
+    ("dev = 'd1' OR n < 50", lambda r: r['dev'] == 'd1' or r['n'] < 50),
+    ("(dev = 'd1' OR dev = 'd2') AND NOT n > 500", lambda r: r['dev'] in ('d1', 'd2') and not r['n'] > 500),
+    ("ts >= 3600 AND ts < 7200 AND dev <> 'd0'", lambda r: 3600 <= r['ts'] < 7200 and r['dev'] != 'd0'),
+    ("n = 500.5", lambda r: False),
+    ("n = 500.0", lambda r: r['n'] == 500),
+    ("n != 500.5", lambda r: True),
+    ("n < 300.5", lambda r: r['n'] < 300.5),
+    ("n <= 300.5", lambda r: r['n'] <= 300.5),
+    ("n > 299.5", lambda r: r['n'] > 299.5),
+    ("n >= -0.5 AND n < 10.5", lambda r: -0.5 <= r['n'] < 10.5),
+    ("n BETWEEN 99.5 AND 200.5", lambda r: 99.5 <= r['n'] <= 200.5),
+    ("n BETWEEN 100.2 AND 100.8", lambda r: False),
+    ("n IN (5, 7.5, 9)", lambda r: r['n'] in (5, 9)),
+    ("ts < 3600.5", lambda r: r['ts'] < 3600.5),
+    ("n > 2000", lambda r: False),
+    ("dev = 'nosuch'", lambda r: False),
+]
+
+
+@pytest.fixture(params=[None, 'hour'], ids=['single', 'partitioned'])
+def loaded(request, table):
+    """
+    A table of random rows inserted in several batches, and the rows.
+    """
+    opts = {'timecol': 'ts'}
+    if request.param:
+        opts['partition'] = request.param
+    MakeTable(table, 't', COLS, opts, ordered=['n'])
+    rnd = random.Random(7)
+    rows = []
+    for b in range(5):
+        batch = [{'ts': (b * 400 + i) * 5, 'dev': 'd%d' % rnd.randrange(5),
+                  'v': round(rnd.random() * 100, 2), 'n': rnd.randrange(1000)} for i in range(400)]
+        table.insert_many('t', batch)
+        rows.extend(batch)
+    return table, rows
+
+
+def key(rows):
+    return sorted((r['ts'], r['dev'], r['v'], r['n']) for r in rows)
+
+
+@pytest.mark.parametrize('where,test', WHERES, ids=[w for w, t in WHERES])
+def test_where(loaded, where, test):
+    table, rows = loaded
+    got = SQL(table).execute('SELECT * FROM t WHERE ' + where)
+    assert key(got) == key(r for r in rows if test(r))
+
+
+def test_range_str_types_checked(loaded):
+    table, rows = loaded
+    with pytest.raises(exceptions.SQLError):
+        SQL(table).execute("SELECT * FROM t WHERE dev > 1 AND dev <= 'd3'")
+    with pytest.raises(exceptions.SQLError):
+        SQL(table).execute("SELECT * FROM t WHERE n > 'a' AND n < 5")
+
+
+def test_concurrent_connect(loaded):
+    """
+    Requests run in threads; the first ones may connect the table at once.
+    """
+    table, rows = loaded
+    expected = key(r for r in rows if r['n'] < 300)
+    for attempt in range(5):
+        fresh = Table(table.db, {'cachesize': 0})
+        barrier = threading.Barrier(4)
+        found = []
+
+        def run():
+            barrier.wait()
+            found.append(key(SQL(fresh).execute('SELECT * FROM t WHERE n < 300')))
+
+        threads = [threading.Thread(target=run) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert found == [expected] * 4
+
+
+@pytest.mark.parametrize('col', ['ts', 'dev', 'v', 'n'])
+def test_order_limit(loaded, col):
+    table, rows = loaded
+    byts = {r['ts']: r for r in rows}
+    for desc in (False, True):
+        for limit in (None, 0, 1, 37, 5000):
+            statement = "SELECT %s, ts FROM t WHERE dev != 'd0' ORDER BY %s %s" % (col, col, 'DESC' if desc else 'ASC')
+            if limit is not None:
+                statement += ' LIMIT %d' % limit
+            got = SQL(table).execute(statement)
+            expected = sorted((r[col] for r in rows if r['dev'] != 'd0'), reverse=desc)[:limit]
+            assert [r[col] for r in got] == expected, statement
+            # Rows whose values tie may come in any order, but whole.
+            assert all(set(r) == {col, 'ts'} and byts[r['ts']][col] == r[col] for r in got)
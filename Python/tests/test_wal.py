@@ -0,0 +1,111 @@
+"""
+The write ahead log, and a table recovering from it after a crash.
+"""
+import os
+import time
+
+from conftest import MakeTable
+from database import DB, Table
+from sql import SQL
+from wal import Wal, ReadCheckpoint
+
+COLS = {'ts': 'int', 'dev': 'str', 'v': 'float'}
+
+
+def rows(first:int, n:int):
+    return [{'ts': i, 'dev': 'd%d' % (i % 4), 'v': i / 4} for i in range(first, first + n)]
+
+
+def test_log(tmp_path):
+    path = str(tmp_path / 'wal.log')
+    wal = Wal(path, 10)
+    assert wal.append({'rows': [1]}) == 11
+    assert wal.append({'rows': [2]}, sync=False) == 12
+    assert wal.pending
+    wal.close()
+    # A torn entry at the end is dropped.
+    with open(path, 'ab') as fp:
+        fp.write(b'\x40\x00\x00\x00torn')
+    wal = Wal(path, 10)
+    assert list(wal.entries(10)) == [(11, {'rows': [1]}), (12, {'rows': [2]})]
+    assert list(wal.entries(11)) == [(12, {'rows': [2]})]
+    assert wal.append({'rows': [3]}) == 13
+    wal.truncate()
+    assert wal.size == 0 and list(wal.entries(0)) == []
+    assert wal.append({}) == 14
+    wal.close()
+    # A log whose header never reached the disk is empty.
+    os.truncate(path, 3)
+    wal = Wal(path, 20)
+    assert wal.size == 0 and list(wal.entries(0)) == [] and wal.append({}) == 21
+
+
+def crash(user):
+    """
+    Open the database again as a process starting after a crash would,
+    leaving the old handles as they are.
+    """
+    return Table(DB('db', user), {'cachesize': 0})
+
+
+def test_recover(user, table):
+    MakeTable(table, 't', COLS, {'timecol': 'ts', 'partition': 'hour', 'rollups': {'v': ['minute']}})
+    table.insert_many('t', rows(0, 500))
+    table.checkpoint('t')
+    table.insert_many('t', rows(500, 5000))
+    SQL(table).execute("DELETE FROM t WHERE dev = 'd1'")
+    SQL(table).execute("UPDATE t SET v = 0.5 WHERE ts < 100")
+    assert table.connection('t').wal.size > 0
+    want = sorted(map(repr, SQL(table).execute('SELECT * FROM t')))
+    sums = SQL(table).execute('SELECT SUM(v) FROM t GROUP BY TIME(60)')
+
+    # Half an entry written when the process died.
+    with open(os.path.join(table.db.path, 't', 'wal.log'), 'ab') as fp:
+        fp.write(b'\xff\x00\x00\x00\x01\x02')
+    again = crash(user)
+    assert sorted(map(repr, SQL(again).execute('SELECT * FROM t'))) == want
+    assert SQL(again).execute('SELECT SUM(v) FROM t GROUP BY TIME(60)') == sums
+    # Recovery checkpointed, and the table carries on.
+    assert again.connection('t').wal.size == 0
+    again.insert_many('t', rows(9000, 10))
+    assert len(SQL(crash(user)).execute("SELECT * FROM t WHERE ts >= 9000")) == 10
+
+
+def test_lost_entry(user, table):
+    """
+    An entry of a log not synced lost in a crash, while the records,
+    indices and rollups of its batch reached the disk, some of them torn.
+    """
+    MakeTable(table, 't', COLS, {'timecol': 'ts', 'partition': 'hour', 'walsync': 5,
+                                 'rollups': {'v': ['minute']}})
+    table.insert_many('t', rows(0, 500))
+    table.checkpoint('t')
+    want = sorted(map(repr, SQL(table).execute('SELECT * FROM t')))
+    sums = SQL(table).execute('SELECT SUM(v) FROM t GROUP BY TIME(60)')
+    table.insert_many('t', rows(500, 100) + rows(4000, 10))
+    path = os.path.join(table.db.path, 't')
+    size = dict(ReadCheckpoint(path)['segments'])[0]['records']
+
+    os.truncate(os.path.join(path, 'wal.log'), 8)
+    os.truncate(os.path.join(path, '0', 'records.dat'), size + 10)
+    with open(os.path.join(path, '0', 'segment.json'), 'wb') as fp:
+        fp.write(b'{"start": 0, "en')
+    again = crash(user)
+    assert sorted(map(repr, SQL(again).execute('SELECT * FROM t'))) == want
+    assert SQL(again).execute('SELECT SUM(v) FROM t GROUP BY TIME(60)') == sums
+    assert sorted(again.connection('t').segments) == [0]
+    again.insert_many('t', rows(500, 10))
+    assert len(SQL(crash(user)).execute("SELECT * FROM t WHERE ts >= 500")) == 10
+
+
+def test_walsync_timer(table):
+    MakeTable(table, 't', COLS, {'walsync': 0.2})
+    table.insert_many('t', rows(0, 10))
+    table.insert_many('t', rows(10, 10))
+    wal = table.connection('t').wal
+    # Left to the timer, as nothing else is written.
+    assert wal.pending
+    deadline = time.monotonic() + 5
+    while wal.pending and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not wal.pending
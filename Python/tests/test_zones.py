@@ -0,0 +1,104 @@
+"""
+Block zone maps and Bloom filters, and the column scans they let skip
+blocks.
+"""
+from os.path import join
+import random
+
+import pytest
+
+from conftest import MakeTable
+from pgm import Test
+from zones import Bloom, MayHold, Match, ZoneMap, ZoneScan, ZONES
+
+COLS = {'ts': 'int', 'dev': 'str', 'v': 'float'}
+BLOCKS = 8
+BLOCKROWS = 250
+
+
+def test_bloom():
+    values = ['dev%d' % i for i in range(500)]
+    bits = Bloom(values + values[:10])
+    assert all(MayHold(bits, v) for v in values)
+    false = sum(MayHold(bits, 'other%d' % i) for i in range(5000))
+    assert false < 5000 * 0.03
+    assert not MayHold(Bloom([]), 'a')
+
+
+@pytest.mark.parametrize('cmp,value,match', [
+    ('=', 10, True), ('=', 9, False), ('=', 21, False),
+    ('!=', 10, True), ('in', [1, 25], False), ('in', [1, 20], True),
+    ('<', 10, False), ('<=', 10, True), ('>', 20, False), ('>=', 20, True),
+    ('between', [0, 9], False), ('between', [20, 30], True),
+    ('range', [20, 30, False, True], False), ('range', [20, 30, True, True], True),
+    ('range', [0, 10, True, False], False), ('range', [0, 10, True, True], True),
+    ('range', [12.5, 13.5, False, False], True), ('*', None, True),
+])
+def test_match_minmax(cmp, value, match):
+    assert Match((10, 20), cmp, value) is match
+
+
+def test_match_bloom():
+    bits = Bloom(['a', 'b'])
+    assert Match(bits, '=', 'a') and not Match(bits, '=', 'zz')
+    assert Match(bits, 'in', ['zz', 'b']) and not Match(bits, 'in', ['zz', 'yy'])
+    # Nothing is known of the order of the values.
+    assert Match(bits, '<', 'a') and Match(bits, 'range', ['x', 'y', True, True])
+    assert Match(None, '=', 1) and not Match((5, 5), '!=', 5)
+
+
+def test_zonemap(tmp_path):
+    path = str(tmp_path / ZONES)
+    zones = ZoneMap(path)
+    zones.append({'ts': [5, 1, 9], 'dev': ['a', 'b'], 'v': [0.5, -1.0]}, COLS)
+    zones.append({'ts': [10, 20], 'dev': ['c'], 'v': [2.0]}, COLS)
+    entries = zones.entries()
+    assert entries[0]['ts'] == (1, 9) and entries[1]['v'] == (2.0, 2.0)
+    assert zones.blocks('ts', '>', 9) == [1] and zones.blocks('dev', '=', 'a') == [0]
+    zones.close()
+    # An entry still being written is not a block yet.
+    with open(path, 'ab') as fp:
+        fp.write(b'\x40\x00\x00\x00\x00\x00\x00\x00partial')
+    zones = ZoneMap(path)
+    assert len(zones.entries()) == 2 and zones.blocks('ts', '<', 100) == [0, 1]
+    zones.close()
+
+
+@pytest.fixture
+def blocks(table):
+    """
+    A table of BLOCKS insert batches, each a block of the column files with
+    its own times and devices, and the rows.
+    """
+    MakeTable(table, 't', COLS, {'timecol': 'ts'})
+    rnd = random.Random(5)
+    rows = []
+    for b in range(BLOCKS):
+        batch = [{'ts': b * 1000 + rnd.randrange(1000), 'dev': 'd%d-%d' % (b, rnd.randrange(3)),
+                  'v': rnd.random()} for i in range(BLOCKROWS)]
+        table.insert_many('t', batch)
+        rows.extend(batch)
+    return table.connection('t').segments[None], rows
+
+
+@pytest.mark.parametrize('col,cmp,value,read', [
+    ('ts', '<', 1500, 2),
+    ('ts', 'range', [2000, 3999, True, True], 2),
+    ('ts', 'range', [1999, 2000, False, False], 0),
+    ('ts', '>=', 0, BLOCKS),
+    ('dev', '=', 'd3-1', 1),
+    ('dev', 'in', ['d0-0', 'd7-2'], 2),
+    ('v', '>', 0.5, BLOCKS),
+])
+def test_scan(blocks, col, cmp, value, read):
+    seg, rows = blocks
+    test = Test(cmp, value)
+    offsets = seg.scan(col, cmp, value, test)
+    assert sorted(r[col] for r in seg.records.read_many(offsets)) == \
+        sorted(r[col] for r in rows if test(r[col]))
+    # Only the blocks that may match are decoded; a Bloom filter may let
+    # another through.
+    assert seg.blockrows(col, cmp, value) in (read * BLOCKROWS, (read + 1) * BLOCKROWS)
+    scan = ZoneScan(join(seg.path, col + '.col'))
+    assert list(scan.scan(cmp, value, test)) == list(offsets)
+    assert scan.pages in (read, read + 1)